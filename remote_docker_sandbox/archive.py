@@ -0,0 +1,147 @@
+import io
+import posixpath
+import tarfile
+from time import time
+from dataclasses import dataclass, field
+from collections.abc import Iterator, Iterable
+from typing import Any
+from beartype import beartype
+
+
+ARCHIVE_CHUNK_BYTES = 2**20
+
+
+@beartype
+class IteratorReader(io.RawIOBase):
+    """
+    A binary file-like object reading from an iterator of byte chunks.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while len(self.pending) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = chunk
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+@beartype
+@dataclass
+class _ChunkWriter:
+    """
+    A write-only file-like object whose written data is taken back with `take`.
+    """
+
+    chunks: list[bytes] = field(default_factory=lambda: [])
+
+    def write(self, data: Any) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> list[bytes]:
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+
+@beartype
+def archive_name(path: str) -> str:
+    """
+    The name under which the absolute container path `path` is stored in the archives,
+    which are extracted to and made relative to the container's root.
+    """
+
+    return posixpath.normpath(path).lstrip("/")
+
+
+@beartype
+def stream_archive(
+    files: Iterable[tuple[str, bytes]], mode: int = 0o644
+) -> Iterator[bytes]:
+    """
+    Streams a tar archive with a regular file for every (absolute path, content) pair.
+    Missing parent directories are created by docker when extracting it.
+
+    The contents are sent in slices of at most `ARCHIVE_CHUNK_BYTES`, without copying
+    them into an archive first.
+    """
+
+    now = int(time())
+    size = 0
+    for path, content in files:
+        info = tarfile.TarInfo(archive_name(path))
+        info.size = len(content)
+        info.mode = mode
+        info.mtime = now
+        header = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+        yield header
+        for start in range(0, len(content), ARCHIVE_CHUNK_BYTES):
+            yield content[start : start + ARCHIVE_CHUNK_BYTES]
+        padding = tarfile.NUL * (-len(content) % tarfile.BLOCKSIZE)
+        yield padding
+        size += len(header) + len(content) + len(padding)
+    # The end of archive marker, and the padding of the last record, like `TarFile.close`.
+    size += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -size % tarfile.RECORDSIZE)
+
+
+@beartype
+def merge_archives(archives: list[tuple[str, Iterator[bytes]]]) -> Iterator[bytes]:
+    """
+    Streams one tar archive with the contents of `archives`, which are (path, chunks)
+    pairs where chunks is an archive of the path as returned by docker, whose members are
+    named after the path's last component. In the merged archive, they are named after
+    the whole path instead, see `archive_name`.
+
+    Only one member of one archive is held in memory at a time.
+    """
+
+    writer = _ChunkWriter()
+    with tarfile.open(fileobj=writer, mode="w|") as merged:  # type: ignore
+        for path, chunks in archives:
+            prefix = archive_name(path)
+            basename = posixpath.basename(prefix)
+            with tarfile.open(fileobj=IteratorReader(chunks), mode="r|") as tar:  # type: ignore
+                for member in tar:
+                    relative_name = member.name
+                    if relative_name == basename or relative_name.startswith(
+                        basename + "/"
+                    ):
+                        relative_name = relative_name[len(basename) :]
+                    else:
+                        relative_name = "/" + relative_name
+                    member.name = prefix + relative_name
+                    merged.addfile(
+                        member, tar.extractfile(member) if member.isfile() else None
+                    )
+                    yield from writer.take()
+    yield from writer.take()
+
+
+@beartype
+def read_archive(fileobj: Any) -> dict[str, bytes]:
+    """
+    Returns the (absolute path, content) pairs of the regular files in the tar archive
+    read from the binary file-like object `fileobj`.
+    """
+
+    files = {}
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            file = tar.extractfile(member)
+            assert file is not None
+            files["/" + member.name.lstrip("/")] = file.read()
+    return files
@@ -0,0 +1,403 @@
+from uuid import uuid4
+from time import monotonic
+from tempfile import SpooledTemporaryFile
+import asyncio
+import os
+from collections.abc import AsyncIterator
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.async_rest_client_base import (
+    AsyncJsonRESTClient,
+    DEFAULT_MAX_CONCURRENT_REQUESTS_PER_SERVER,
+)
+from remote_docker_sandbox.rest_client_base import DEFAULT_CONNECTION_POOL_SIZE
+from remote_docker_sandbox.client import (
+    CompletedProcess,
+    StreamingProcess,
+    get_server_urls,
+    choose_server_url,
+    report_start_response,
+    record_call_outcome,
+    should_retry_start,
+    start_error,
+    seconds_until_available,
+    MAX_START_WAIT_SECONDS,
+    MAX_CREATE_RETRIES,
+    parse_run_command_response,
+    parse_run_commands_sequentially_response,
+    BatchItem,
+    batch_items_json,
+    parse_run_batch_response,
+    output_limit_kwargs,
+    container_path,
+    upload_files_archive,
+    parse_upload_response,
+    resettable_kwargs,
+    cache_init_kwargs,
+    parse_reset_response,
+    downloaded_files_by_requested_path,
+)
+from remote_docker_sandbox.archive import read_archive
+
+
+# Downloaded archives bigger than this are spooled to a temporary file instead of memory
+# until they are extracted.
+DOWNLOAD_SPOOL_MAX_MEMORY_BYTES = int(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_DOWNLOAD_SPOOL_MAX_MEMORY_BYTES", str(2**24))
+)
+
+
+@beartype
+class AsyncStreamingProcess(StreamingProcess):
+    """
+    The asyncio twin of `StreamingProcess`: iterate over it with `async for`, or `await`
+    its `wait()`.
+    """
+
+    def __init__(
+        self,
+        items: AsyncIterator[Any],
+        ignore_failed_server_calls: bool = True,
+        caller: str = "AsyncRemoteDockerSandbox",
+    ) -> None:
+        super().__init__(
+            iter([]), ignore_failed_server_calls=ignore_failed_server_calls, caller=caller
+        )
+        self.async_items = items
+
+    async def __aiter__(self) -> AsyncIterator[tuple[str, str]]:
+        async for item in self.async_items:
+            output = self._parse_item(item)
+            if output is not None:
+                yield output
+            if self._invalid:
+                return
+        self._check_finished()
+
+    async def wait(self) -> CompletedProcess:  # type: ignore
+        return self._completed_process([output async for output in self])
+
+
+@beartype
+class AsyncRemoteDockerSandbox(AsyncJsonRESTClient):
+    """
+    The asyncio twin of `RemoteDockerSandbox`.
+
+    The container is started by `async with AsyncRemoteDockerSandbox(...) as sandbox:` or
+    by `await sandbox.start()`. If neither is done, the first call that needs the container
+    starts it. Concurrent calls all wait for the same start.
+    """
+
+    container_name: str
+
+    def __init__(
+        self,
+        server_urls: str | list[str] | None = None,
+        init_command: str | None = None,
+        ignore_failed_server_calls: bool = True,
+        memory_gb: int | float = 1,
+        cpus: int = 1,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS_PER_SERVER,
+        resettable: bool = False,
+        connection_pool_size: int = DEFAULT_CONNECTION_POOL_SIZE,
+        cache_init: bool = True,
+    ) -> None:
+        self.server_urls = get_server_urls(server_urls)
+        super().__init__(
+            server_url=choose_server_url(
+                self.server_urls, memory_gb=memory_gb, cpus=cpus
+            ),
+            ignore_failed_server_calls=ignore_failed_server_calls,
+            max_concurrent_requests=max_concurrent_requests,
+            connection_pool_size=connection_pool_size,
+        )
+
+        self.container_name = f"docker-sandbox-{uuid4()}"
+        self.init_command = init_command
+        self.memory_gb = memory_gb
+        self.cpus = cpus
+        self.resettable = resettable
+        self.cache_init = cache_init
+        self.started = False
+        self._start_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        if self.started:
+            return
+        # The calls made while the sandbox starts wait for it, and only then use
+        # `server_url`, which changes while servers are tried.
+        async with self._start_lock:
+            if self.started:
+                return
+            await self._start()
+            self.started = True
+
+    async def _start(self) -> None:
+        # Busy servers are retried after the time they ask for, or another server is
+        # used in the meantime. Failed starts are retried on another server.
+        deadline = monotonic() + MAX_START_WAIT_SECONDS
+        failed_server_urls = []
+        while True:
+            await asyncio.sleep(
+                min(
+                    seconds_until_available(self.server_url),
+                    max(deadline - monotonic(), 0),
+                )
+            )
+            try:
+                start_response = await self.call_server(
+                    function="start_container",
+                    container_name=self.container_name,
+                    init_command=self.init_command,
+                    memory_gb=self.memory_gb,
+                    cpus=self.cpus,
+                    **resettable_kwargs(self.resettable),
+                    **cache_init_kwargs(self.cache_init),
+                )
+            except Exception as e:
+                # Only raised if not ignore_failed_server_calls.
+                start_response = {"error": f"Error communicating with server: {e}"}
+            if (
+                not should_retry_start(self.server_url, start_response)
+                or monotonic() >= deadline
+            ):
+                break
+            if start_error(start_response) is not None:
+                await self._stop_abandoned_start()
+                failed_server_urls.append(self.server_url)
+                if len(failed_server_urls) >= MAX_CREATE_RETRIES:
+                    break
+            self.server_url = choose_server_url(
+                self.server_urls,
+                memory_gb=self.memory_gb,
+                cpus=self.cpus,
+                avoid=failed_server_urls,
+            )
+
+        report_start_response(
+            self.server_url,
+            start_response,
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+        )
+
+    def record_call_outcome(
+        self, function: str, status_code: int | None, error: str | None = None
+    ) -> None:
+        record_call_outcome(self.server_url, function, status_code, error)
+
+    async def _stop_abandoned_start(self) -> None:
+        """
+        See `RemoteDockerSandbox._stop_abandoned_start`.
+        """
+
+        try:
+            await self.call_server(
+                function="stop_container", container_name=self.container_name
+            )
+        except Exception as e:
+            print(
+                f"Error stopping container {self.container_name} on server {self.server_url} after its start failed: {e}"
+            )
+
+    async def run_command(
+        self,
+        command: str,
+        timeout_seconds: float | int = 1,
+        max_output_bytes: int | None = None,
+    ) -> CompletedProcess:
+        await self.start()
+
+        response = await self.call_server(
+            function="run_command",
+            container_name=self.container_name,
+            command=command,
+            timeout_seconds=timeout_seconds,
+            **output_limit_kwargs(max_output_bytes),
+        )
+
+        return parse_run_command_response(
+            response,
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+            caller="AsyncRemoteDockerSandbox",
+        )
+
+    async def run_command_streaming(
+        self,
+        command: str,
+        timeout_seconds: float | int = 1,
+        max_output_bytes: int | None = None,
+    ) -> AsyncStreamingProcess:
+        """
+        Like `run_command`, but returns an `AsyncStreamingProcess` to iterate over the
+        command's output while it runs.
+        """
+
+        await self.start()
+
+        return AsyncStreamingProcess(
+            self.call_server_streaming(
+                function="run_command",
+                container_name=self.container_name,
+                command=command,
+                timeout_seconds=timeout_seconds,
+                **output_limit_kwargs(max_output_bytes),
+            ),
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+        )
+
+    async def run_commands_sequentially(
+        self,
+        commands: list[str],
+        total_timeout_seconds: float | int = 5,
+        per_command_timeout_seconds: float | int = 4,
+    ) -> list[CompletedProcess]:
+        await self.start()
+
+        response = await self.call_server(
+            function="run_commands_sequentially",
+            container_name=self.container_name,
+            commands=commands,
+            total_timeout_seconds=total_timeout_seconds,
+            per_command_timeout_seconds=per_command_timeout_seconds,
+        )
+
+        return parse_run_commands_sequentially_response(
+            response,
+            n_commands=len(commands),
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+            caller="AsyncRemoteDockerSandbox",
+        )
+
+    async def upload_file(self, filename: str, content: str | bytes) -> CompletedProcess:
+        return await self.upload_files({filename: content})
+
+    async def upload_files(self, files: dict[str, str | bytes]) -> CompletedProcess:
+        await self.start()
+
+        response = await self.call_server_upload(
+            upload_files_archive(files),
+            function="upload_archive",
+            container_name=self.container_name,
+            path="/",
+        )
+        return parse_upload_response(
+            response,
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+            caller="AsyncRemoteDockerSandbox",
+        )
+
+    async def download_files(self, paths: list[str]) -> dict[str, bytes]:
+        await self.start()
+
+        with SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_MEMORY_BYTES) as archive:
+            error = await self.call_server_download(
+                archive,
+                function="download_archive",
+                container_name=self.container_name,
+                paths=[container_path(path) for path in paths],
+            )
+            if error is not None:
+                return {}
+
+            try:
+                archive.seek(0)
+                files = read_archive(archive)
+            except Exception as e:
+                if not self.ignore_failed_server_calls:
+                    raise e
+                print(
+                    f"AsyncRemoteDockerSandbox.download_files: Error reading the archive: {e}"
+                )
+                return {}
+
+        return downloaded_files_by_requested_path(files, paths)
+
+    async def reset(self) -> CompletedProcess:
+        """
+        See `RemoteDockerSandbox.reset`. Processes that `init_command` left running are
+        killed too and not restarted.
+        """
+
+        await self.start()
+
+        response = await self.call_server(
+            function="reset_container", container_name=self.container_name
+        )
+        return parse_reset_response(
+            response,
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+            caller="AsyncRemoteDockerSandbox",
+        )
+
+    async def cleanup(self) -> None:
+        if not self.started:
+            return
+        await self.call_server(
+            function="stop_container", container_name=self.container_name
+        )
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, traceback) -> None:
+        await self.cleanup()
+
+
+@beartype
+async def run_batch(
+    server_url: str, items: list[BatchItem], ignore_failed_server_calls: bool = True
+) -> list[CompletedProcess]:
+    """
+    The asyncio version of `remote_docker_sandbox.client.run_batch`.
+    """
+
+    client = AsyncJsonRESTClient(
+        server_url=server_url, ignore_failed_server_calls=ignore_failed_server_calls
+    )
+    response = await client.call_server(
+        function="run_batch", items=batch_items_json(items)
+    )
+    return parse_run_batch_response(
+        response,
+        n_items=len(items),
+        ignore_failed_server_calls=ignore_failed_server_calls,
+    )
+
+
+@beartype
+async def iter_batch(
+    server_url: str, items: list[BatchItem], ignore_failed_server_calls: bool = True
+) -> AsyncIterator[tuple[int, CompletedProcess]]:
+    """
+    The asyncio version of `remote_docker_sandbox.client.iter_batch`.
+    """
+
+    client = AsyncJsonRESTClient(
+        server_url=server_url, ignore_failed_server_calls=ignore_failed_server_calls
+    )
+    remaining_indices = set(range(len(items)))
+    async for item in client.call_server_streaming(
+        function="run_batch", items=batch_items_json(items)
+    ):
+        if isinstance(item, dict) and item.get("index") in remaining_indices:
+            remaining_indices.remove(item["index"])
+            yield item["index"], parse_run_command_response(
+                item.get("result"),
+                ignore_failed_server_calls=ignore_failed_server_calls,
+                caller="iter_batch",
+            )
+            continue
+
+        error_message = f"iter_batch: Got invalid streamed item from server: {item}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+
+    for index in sorted(remaining_indices):
+        yield index, CompletedProcess(
+            returncode=1,
+            stdout="",
+            stderr="Received invalid response from the remote docker server.",
+        )
@@ -0,0 +1,627 @@
+import asyncio
+import traceback
+import json
+import ssl
+import os
+from weakref import WeakKeyDictionary
+from urllib.parse import urlsplit, urlencode
+from contextlib import asynccontextmanager, AbstractAsyncContextManager
+from dataclasses import dataclass, field
+from collections.abc import AsyncIterator, Iterator
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.rest_client_base import (
+    DEFAULT_CONNECTION_POOL_SIZE,
+    busy_response,
+)
+from remote_docker_sandbox.tracing import (
+    current_request_id,
+    new_request_id,
+    request_headers,
+    tracer,
+)
+from remote_docker_sandbox.wire_format import (
+    JSON_CONTENT_TYPE,
+    accept_headers,
+    supported_encodings,
+    encode_body,
+    decode_body,
+    remember_server_accept_encodings,
+    server_accept_encodings,
+)
+
+
+DEFAULT_MAX_CONCURRENT_REQUESTS_PER_SERVER = int(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_MAX_CONCURRENT_REQUESTS_PER_SERVER", "1024")
+)
+
+
+# Streamed response bodies are read in chunks of at most this size.
+BODY_CHUNK_BYTES = 65536
+
+# How long reading a streamed response may wait for the next bytes, like the timeout
+# between two received bytes of the sync client's streamed calls.
+STREAM_READ_TIMEOUT_SECONDS = 600
+
+
+class AsyncHTTPError(Exception):
+    pass
+
+
+class StaleConnectionError(ConnectionError):
+    """
+    The server closed the connection before the request could reach it: it couldn't be
+    written, or the connection was closed before any byte of a response.
+    """
+
+
+@beartype
+@dataclass
+class AsyncHTTPConnectionPool:
+    """
+    A minimal asyncio HTTP/1.1 client for one server: keeps up to `max_idle_connections`
+    keep-alive connections and lets at most `max_concurrent_requests` requests be in
+    flight at once, the others wait for a slot.
+    """
+
+    server_url: str
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS_PER_SERVER
+    max_idle_connections: int = DEFAULT_CONNECTION_POOL_SIZE
+    connections_opened: int = 0
+    requests: int = 0
+    _idle_connections: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = (
+        field(default_factory=lambda: [])
+    )
+    _semaphore: asyncio.Semaphore | None = None
+
+    def __post_init__(self) -> None:
+        url = urlsplit(self.server_url)
+        if url.scheme not in ["http", "https"] or url.hostname is None:
+            raise ValueError(f"Invalid server url: {self.server_url}")
+        self._host: str = url.hostname
+        self._use_ssl = url.scheme == "https"
+        self._port: int = (
+            url.port if url.port is not None else (443 if self._use_ssl else 80)
+        )
+        self._path_prefix = url.path.rstrip("/")
+        self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        body: bytes | Iterator[bytes] = b"",
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, dict[str, str], bytes]:
+        """
+        Sends the request, with a chunked body if `body` is an iterator of chunks, and
+        returns the status, the headers and the body of the response.
+        """
+
+        if headers is None:
+            headers = {}
+        assert self._semaphore is not None
+        async with self._semaphore:
+            self.requests += 1
+            if isinstance(body, bytes):
+                reader, writer, reused = await self._get_connection()
+            else:
+                # Can't be sent again if an idle connection turns out to be closed.
+                reader, writer = await self._open_connection()
+                reused = False
+            try:
+                response = await self._send(reader, writer, method, path, body, headers)
+            except StaleConnectionError as e:
+                writer.close()
+                if not reused:
+                    raise e
+                # The server may have closed the idle keep-alive connection in the meantime,
+                # so retry once on a fresh connection. Other errors aren't retried, since
+                # the server may have run the call already.
+                reader, writer = await self._open_connection()
+                try:
+                    response = await self._send(
+                        reader, writer, method, path, body, headers
+                    )
+                except BaseException:
+                    writer.close()
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+
+            status, response_headers, response_body, keep_alive = response
+            if keep_alive and len(self._idle_connections) < self.max_idle_connections:
+                self._idle_connections.append((reader, writer))
+            else:
+                writer.close()
+
+            return status, response_headers, response_body
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        path: str,
+        body: bytes = b"",
+        headers: dict[str, str] | None = None,
+        read_timeout_seconds: int | float = STREAM_READ_TIMEOUT_SECONDS,
+    ) -> AbstractAsyncContextManager[tuple[int, dict[str, str], AsyncIterator[bytes]]]:
+        """
+        Like `request`, but gives the status, the headers, and the chunks of the response
+        body as they arrive. The connection goes back to the pool only if the body was
+        read to its end.
+        """
+
+        if headers is None:
+            headers = {}
+        assert self._semaphore is not None
+        async with self._semaphore:
+            self.requests += 1
+            reader, writer, reused = await self._get_connection()
+            try:
+                try:
+                    status, response_headers, keep_alive = await asyncio.wait_for(
+                        self._send_head(reader, writer, method, path, body, headers),
+                        timeout=read_timeout_seconds,
+                    )
+                except StaleConnectionError as e:
+                    writer.close()
+                    if not reused:
+                        raise e
+                    # Like in `request`.
+                    reader, writer = await self._open_connection()
+                    status, response_headers, keep_alive = await asyncio.wait_for(
+                        self._send_head(reader, writer, method, path, body, headers),
+                        timeout=read_timeout_seconds,
+                    )
+
+                finished = False
+
+                async def chunks() -> AsyncIterator[bytes]:
+                    nonlocal finished
+                    async for chunk in self._body_chunks(
+                        reader, response_headers, read_timeout_seconds
+                    ):
+                        yield chunk
+                    finished = True
+
+                yield status, response_headers, chunks()
+            except BaseException:
+                writer.close()
+                raise
+
+            if (
+                finished
+                and keep_alive
+                and len(self._idle_connections) < self.max_idle_connections
+            ):
+                self._idle_connections.append((reader, writer))
+            else:
+                writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent_requests": self.max_concurrent_requests,
+            "connections_opened": self.connections_opened,
+            "requests": self.requests,
+            "idle_connections": len(self._idle_connections),
+        }
+
+    async def close(self) -> None:
+        while len(self._idle_connections) > 0:
+            _, writer = self._idle_connections.pop()
+            writer.close()
+
+    async def _get_connection(
+        self,
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        while len(self._idle_connections) > 0:
+            reader, writer = self._idle_connections.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._open_connection()
+        return reader, writer, False
+
+    async def _open_connection(
+        self,
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(
+            self._host,
+            self._port,
+            ssl=ssl.create_default_context() if self._use_ssl else None,
+            limit=2**24,
+        )
+        self.connections_opened += 1
+        return reader, writer
+
+    async def _send(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        body: bytes | Iterator[bytes],
+        headers: dict[str, str],
+    ) -> tuple[int, dict[str, str], bytes, bool]:
+        status, response_headers, keep_alive = await self._send_head(
+            reader, writer, method, path, body, headers
+        )
+        response_body = b"".join(
+            [chunk async for chunk in self._body_chunks(reader, response_headers)]
+        )
+        return status, response_headers, response_body, keep_alive
+
+    async def _send_head(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        body: bytes | Iterator[bytes],
+        headers: dict[str, str],
+    ) -> tuple[int, dict[str, str], bool]:
+        """
+        Sends the request and reads the status line and the headers of the response.
+        """
+
+        request_headers = {
+            "Host": f"{self._host}:{self._port}",
+            **(
+                {"Content-Length": str(len(body))}
+                if isinstance(body, bytes)
+                else {"Transfer-Encoding": "chunked"}
+            ),
+            "Connection": "keep-alive",
+            **headers,
+        }
+        head = f"{method} {self._path_prefix}{path} HTTP/1.1\r\n" + "".join(
+            f"{key}: {value}\r\n" for key, value in request_headers.items()
+        )
+        try:
+            if isinstance(body, bytes):
+                writer.write(head.encode("latin-1") + b"\r\n" + body)
+            else:
+                writer.write(head.encode("latin-1") + b"\r\n")
+                for chunk in body:
+                    if len(chunk) > 0:
+                        writer.writelines(
+                            [f"{len(chunk):x}\r\n".encode(), chunk, b"\r\n"]
+                        )
+                        await writer.drain()
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except ConnectionError as e:
+            raise StaleConnectionError(f"Error sending the request: {e}") from e
+
+        try:
+            status_line = await reader.readuntil(b"\r\n")
+        except asyncio.IncompleteReadError as e:
+            if len(e.partial) > 0:
+                raise
+            raise StaleConnectionError(
+                "The server closed the connection without answering."
+            ) from e
+        version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+
+        response_headers: dict[str, str] = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            key, value = line.decode("latin-1").split(":", 1)
+            response_headers[key.strip().lower()] = value.strip()
+
+        # A body that lasts until the connection closes leaves nothing to reuse.
+        keep_alive = (
+            version == "HTTP/1.1"
+            and response_headers.get("connection", "").lower() != "close"
+            and (
+                "content-length" in response_headers
+                or response_headers.get("transfer-encoding", "").lower() == "chunked"
+            )
+        )
+
+        return int(status), response_headers, keep_alive
+
+    async def _body_chunks(
+        self,
+        reader: asyncio.StreamReader,
+        response_headers: dict[str, str],
+        read_timeout_seconds: int | float | None = None,
+    ) -> AsyncIterator[bytes]:
+        async def read(awaitable: Any) -> bytes:
+            if read_timeout_seconds is None:
+                return await awaitable
+            return await asyncio.wait_for(awaitable, timeout=read_timeout_seconds)
+
+        if "content-length" in response_headers:
+            remaining = int(response_headers["content-length"])
+            while remaining > 0:
+                chunk = await read(reader.read(min(remaining, BODY_CHUNK_BYTES)))
+                if len(chunk) == 0:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await read(reader.readuntil(b"\r\n"))).split(b";")[0], 16)
+                if size == 0:
+                    # Skip the (usually empty) trailers.
+                    while await read(reader.readuntil(b"\r\n")) != b"\r\n":
+                        pass
+                    return
+                yield await read(reader.readexactly(size))
+                await read(reader.readexactly(2))
+        else:
+            while len(chunk := await read(reader.read(BODY_CHUNK_BYTES))) > 0:
+                yield chunk
+
+
+# asyncio streams are bound to their event loop, so the process-wide pools are per loop.
+_pools: WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, AsyncHTTPConnectionPool]
+] = WeakKeyDictionary()
+
+
+@beartype
+def get_async_pool(
+    server_url: str,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS_PER_SERVER,
+    max_idle_connections: int = DEFAULT_CONNECTION_POOL_SIZE,
+) -> AsyncHTTPConnectionPool:
+    """
+    Returns the connection pool for `server_url` in the running event loop, creating it
+    the first time the server is used from this loop.
+    """
+
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    if server_url not in pools:
+        pools[server_url] = AsyncHTTPConnectionPool(
+            server_url=server_url,
+            max_concurrent_requests=max_concurrent_requests,
+            max_idle_connections=max_idle_connections,
+        )
+    return pools[server_url]
+
+
+@beartype
+def async_connection_pool_stats() -> dict[str, dict]:
+    return {
+        server_url: pool.stats()
+        for server_url, pool in _pools.get(asyncio.get_running_loop(), {}).items()
+    }
+
+
+@beartype
+class AsyncJsonRESTClient:
+    server_url: str
+
+    def __init__(
+        self,
+        server_url: str | None = None,
+        ignore_failed_server_calls: bool = True,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS_PER_SERVER,
+        connection_pool_size: int = DEFAULT_CONNECTION_POOL_SIZE,
+    ) -> None:
+        if server_url is None:
+            server_url = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_URL")
+
+        if server_url is None:
+            raise ValueError(
+                "To initialize a AsyncJsonRESTClient, you must provide a server url, either with the server_url argument to the contructor or the REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable."
+            )
+
+        self.server_url = server_url
+        self.ignore_failed_server_calls = ignore_failed_server_calls
+        self.max_concurrent_requests = max_concurrent_requests
+        self.connection_pool_size = connection_pool_size
+
+    def record_call_outcome(
+        self, function: str, status_code: int | None, error: str | None = None
+    ) -> None:
+        """
+        Like `JsonRESTClient.record_call_outcome`.
+        """
+
+    @property
+    def pool(self) -> AsyncHTTPConnectionPool:
+        return get_async_pool(
+            self.server_url,
+            max_concurrent_requests=self.max_concurrent_requests,
+            max_idle_connections=self.connection_pool_size,
+        )
+
+    async def call_server(self, **kwargs) -> Any:
+        # Compressed if the server said it can read it, see wire_format.
+        body, headers = encode_body(
+            kwargs, JSON_CONTENT_TYPE, server_accept_encodings(self.server_url)
+        )
+        return await self._call(
+            "/process",
+            body=body,
+            headers={**headers, **accept_headers(supported_encodings())},
+            function=str(kwargs.get("function", "")),
+        )
+
+    async def call_server_upload(self, data: bytes | Iterator[bytes], **kwargs) -> Any:
+        """
+        Like `call_server`, but sends `data` as the raw request body, chunked if it is an
+        iterator of chunks, and `kwargs`, which must be strings, in the query string.
+        """
+
+        return await self._call(
+            f"/upload?{urlencode(kwargs)}",
+            body=data,
+            headers={
+                "Content-Type": "application/octet-stream",
+                **accept_headers(supported_encodings()),
+            },
+            function=str(kwargs.get("function", "")),
+        )
+
+    async def call_server_streaming(self, **kwargs) -> AsyncIterator[Any]:
+        """
+        Like `call_server`, but yields the items of a streamed (newline delimited json)
+        response as they arrive. Errors are yielded as {"error": ...} items.
+        """
+
+        try:
+            async with self.pool.stream(
+                "POST",
+                "/process_stream",
+                body=json.dumps(kwargs).encode(),
+                headers={
+                    "Content-Type": "application/json",
+                    **request_headers(current_request_id.get() or new_request_id()),
+                },
+            ) as (status_code, _, chunks):
+                self.record_call_outcome(str(kwargs.get("function", "")), status_code)
+                if status_code != 200:
+                    response = b"".join([chunk async for chunk in chunks])
+                    error_message = f"Error communicating with server.\nStatus code: {status_code}.\nResponse: {response.decode(errors='replace')}"
+                    if not self.ignore_failed_server_calls:
+                        raise AsyncHTTPError(error_message)
+                    print(error_message)
+                    yield {"error": error_message}
+                    return
+
+                pending = bytearray()
+                async for chunk in chunks:
+                    pending.extend(chunk)
+                    *lines, rest = pending.split(b"\n")
+                    pending = bytearray(rest)
+                    for line in lines:
+                        if len(line) > 0:
+                            yield json.loads(line)
+                if len(pending.strip()) > 0:
+                    yield json.loads(pending)
+        except Exception as e:
+            self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = f"Error while streaming from server: {e} {traceback.format_exc()}"
+            print(error_message)
+            yield {"error": error_message}
+
+    async def call_server_download(self, file: Any, **kwargs) -> dict | None:
+        """
+        Like `call_server`, but writes the raw response body to the binary file-like
+        object `file` as it arrives, and returns None, or an {"error": ...} dict.
+        """
+
+        try:
+            async with self.pool.stream(
+                "POST",
+                "/download",
+                body=json.dumps(kwargs).encode(),
+                headers={
+                    "Content-Type": "application/json",
+                    **request_headers(current_request_id.get() or new_request_id()),
+                },
+            ) as (status_code, _, chunks):
+                self.record_call_outcome(str(kwargs.get("function", "")), status_code)
+                if status_code == 200:
+                    async for chunk in chunks:
+                        file.write(chunk)
+                    return None
+                response = b"".join([chunk async for chunk in chunks])
+        except Exception as e:
+            self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = (
+                f"Error communicating with server: {e} {traceback.format_exc()}"
+            )
+            print(error_message)
+            return {"error": error_message}
+
+        error_message = f"Error communicating with server.\nStatus code: {status_code}.\nResponse: {response.decode(errors='replace')}"
+        if not self.ignore_failed_server_calls:
+            raise AsyncHTTPError(error_message)
+        print(error_message)
+        return {"error": error_message}
+
+    async def _call(
+        self,
+        path: str,
+        body: bytes | Iterator[bytes],
+        headers: dict[str, str],
+        function: str = "",
+    ) -> Any:
+        request_id = current_request_id.get() or new_request_id()
+        token = current_request_id.set(request_id)
+        try:
+            return await self._traced_call(request_id, path, body, headers, function)
+        finally:
+            current_request_id.reset(token)
+
+    async def _traced_call(
+        self,
+        request_id: str,
+        path: str,
+        body: bytes | Iterator[bytes],
+        headers: dict[str, str],
+        function: str = "",
+    ) -> Any:
+        try:
+            # Includes the wait for a slot in the connection pool.
+            with tracer.span(
+                "client.round_trip", server_url=self.server_url, path=path.split("?")[0]
+            ):
+                status_code, response_headers, response_body = await asyncio.wait_for(
+                    self.pool.request(
+                        "POST",
+                        path,
+                        body=body,
+                        headers={**headers, **request_headers(request_id)},
+                    ),
+                    timeout=600,  # we want this big enough to virtually never happen, but we want this because otherwise the training script can freeze forever
+                )
+        except Exception as e:
+            self.record_call_outcome(function, None, f"{e}")
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = (
+                f"Error communicating with server: {e} {traceback.format_exc()}"
+            )
+            print(error_message)
+            return {"error": error_message}
+        self.record_call_outcome(function, status_code)
+
+        try:
+            remember_server_accept_encodings(
+                self.server_url, response_headers.get("accept-encoding")
+            )
+            with tracer.span("client.decode"):
+                response = decode_body(
+                    response_body,
+                    response_headers.get("content-type"),
+                    response_headers.get("content-encoding"),
+                )
+        except Exception as e:
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = (
+                f"Error communicating with server: {e} {traceback.format_exc()}"
+            )
+            print(error_message)
+            return {"error": error_message}
+
+        # Returned whatever ignore_failed_server_calls is, for the caller to retry later or
+        # on another server.
+        busy = busy_response(status_code, response)
+        if busy is not None:
+            return busy
+
+        if status_code != 200:
+            error_message = f"Error communicating with server.\nStatus code: {status_code}.\nResponse json: {response}"
+            if self.ignore_failed_server_calls:
+                print(error_message)
+                return {"error": error_message}
+            else:
+                raise AsyncHTTPError(error_message)
+
+        return response
@@ -0,0 +1,467 @@
+import os
+import sys
+import json
+import math
+import socket
+import platform
+import subprocess
+import importlib.metadata
+from argparse import ArgumentParser, Namespace
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from time import perf_counter, sleep
+from typing import Any
+import requests
+from beartype import beartype
+
+from remote_docker_sandbox.client import RemoteDockerSandbox
+from remote_docker_sandbox.fake_docker_backend import FakeDockerBackend
+from remote_docker_sandbox.server import DockerSandboxServer, parse_shape
+
+
+# The results compared by `find_regressions`, and whether higher values are better.
+COMPARED_RESULTS = {
+    ("create_seconds", "p50"): False,
+    ("create_seconds", "p95"): False,
+    ("exec_seconds", "p50"): False,
+    ("exec_seconds", "p95"): False,
+    ("exec_seconds", "p99"): False,
+    ("throughput", "commands_per_second"): True,
+    ("throughput", "sandboxes_per_second"): True,
+    ("server_rss_bytes", "peak"): False,
+}
+
+
+@beartype
+def percentile(sorted_values: list[float], q: int | float) -> float | None:
+    """
+    The nearest-rank `q`-th percentile, with `q` between 0 and 100.
+    """
+
+    if len(sorted_values) == 0:
+        return None
+    rank = max(math.ceil(q / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+@beartype
+def summarize(values: list[float]) -> dict[str, Any]:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if len(values) > 0 else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1] if len(values) > 0 else None,
+    }
+
+
+@beartype
+def rss_bytes(pid: int) -> int | None:
+    """
+    The resident set size of the process, or None if it can't be read (e.g. not on linux).
+    """
+
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+@beartype
+@dataclass
+class RssSampler:
+    """
+    Samples the resident set size of the process `pid` every `interval_seconds` in a
+    background thread.
+    """
+
+    pid: int
+    interval_seconds: int | float = 0.1
+    samples: list[int] = field(default_factory=lambda: [])
+    _stopped: Any = field(default_factory=lambda: Event())
+    _thread: Thread | None = None
+
+    def start(self) -> None:
+        self._sample()
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> dict[str, int | None]:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+        return {
+            "start": self.samples[0] if len(self.samples) > 0 else None,
+            "peak": max(self.samples) if len(self.samples) > 0 else None,
+            "end": self.samples[-1] if len(self.samples) > 0 else None,
+        }
+
+    def _loop(self) -> None:
+        while not self._stopped.wait(timeout=self.interval_seconds):
+            self._sample()
+
+    def _sample(self) -> None:
+        rss = rss_bytes(self.pid)
+        if rss is not None:
+            self.samples.append(rss)
+
+
+@beartype
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@beartype
+def fake_docker_arguments(arguments: Namespace) -> list[str]:
+    """
+    The command line arguments that make the server started by `start_server` use the
+    same fake docker backend and server settings as `arguments`.
+    """
+
+    result = [
+        "--create-latency-seconds", str(arguments.create_latency_seconds),
+        "--start-latency-seconds", str(arguments.start_latency_seconds),
+        "--exec-latency-seconds", str(arguments.exec_latency_seconds),
+        "--exec-output-bytes", str(arguments.exec_output_bytes),
+        "--remove-latency-seconds", str(arguments.remove_latency_seconds),
+        "--jitter", str(arguments.jitter),
+        "--seed", str(arguments.seed),
+        "--threads", str(arguments.threads),
+        "--warm-pool-size", str(arguments.warm_pool_size),
+    ]
+    for shape in arguments.warm_pool_shape:
+        result += ["--warm-pool-shape", shape]
+    return result
+
+
+@beartype
+def start_server(
+    arguments: Namespace, port: int, startup_timeout_seconds: int | float = 60
+) -> subprocess.Popen:
+    """
+    Starts a `DockerSandboxServer` with a `FakeDockerBackend` in a child process, so that
+    its memory can be measured on its own, and waits until it answers.
+    """
+
+    return start_process(
+        ["-m", "remote_docker_sandbox.benchmark", "--serve", "--port", str(port)]
+        + fake_docker_arguments(arguments),
+        port=port,
+        startup_timeout_seconds=startup_timeout_seconds,
+    )
+
+
+@beartype
+def start_gateway(
+    backend_urls: list[str],
+    port: int,
+    threads: int,
+    startup_timeout_seconds: int | float = 60,
+) -> subprocess.Popen:
+    """
+    Starts a `SandboxGateway` in front of `backend_urls` in a child process, and waits
+    until it answers.
+    """
+
+    command = ["-m", "remote_docker_sandbox.gateway", "--host", "127.0.0.1"]
+    command += ["--port", str(port), "--threads", str(threads)]
+    for backend_url in backend_urls:
+        command += ["--backend-url", backend_url]
+    return start_process(
+        command, port=port, startup_timeout_seconds=startup_timeout_seconds
+    )
+
+
+@beartype
+def start_process(
+    arguments: list[str], port: int, startup_timeout_seconds: int | float
+) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable] + arguments,
+        # The results are written to stdout, so the server logs go to stderr.
+        stdout=sys.stderr,
+    )
+
+    deadline = perf_counter() + startup_timeout_seconds
+    while True:
+        if process.poll() is not None:
+            raise Exception(
+                f"The benchmark server on port {port} exited with code {process.returncode} during startup."
+            )
+        try:
+            requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1).raise_for_status()
+            return process
+        except requests.RequestException:
+            if perf_counter() > deadline:
+                stop_server(process)
+                raise TimeoutError(
+                    f"The benchmark server on port {port} didn't answer within {startup_timeout_seconds} seconds."
+                )
+            sleep(0.05)
+
+
+@beartype
+def stop_server(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+@beartype
+def run_client(
+    server_urls: list[str], commands_per_client: int, command: str, timeout_seconds: int | float
+) -> dict[str, Any]:
+    """
+    Creates a sandbox, runs `command` in it `commands_per_client` times, and removes it.
+    The create time lasts until the sandbox ran a first command, since starting the
+    container happens in the background on the server.
+    """
+
+    result: dict[str, Any] = {
+        "create_seconds": None,
+        "exec_seconds": [],
+        "cleanup_seconds": None,
+        "errors": [],
+    }
+    try:
+        start_time = perf_counter()
+        sandbox = RemoteDockerSandbox(
+            server_urls=server_urls, ignore_failed_server_calls=False
+        )
+        first_output = sandbox.run_command("true", timeout_seconds=timeout_seconds)
+        if first_output.returncode != 0:
+            raise Exception(f"Sandbox failed to start: {first_output.stderr}")
+        result["create_seconds"] = perf_counter() - start_time
+
+        try:
+            for _ in range(commands_per_client):
+                start_time = perf_counter()
+                output = sandbox.run_command(command, timeout_seconds=timeout_seconds)
+                if output.returncode == 0:
+                    result["exec_seconds"].append(perf_counter() - start_time)
+                else:
+                    result["errors"].append(
+                        f"Command exited with code {output.returncode}: {output.stderr}"
+                    )
+        finally:
+            start_time = perf_counter()
+            sandbox.cleanup()
+            result["cleanup_seconds"] = perf_counter() - start_time
+    except Exception as e:
+        result["errors"].append(str(e))
+    return result
+
+
+@beartype
+def run_benchmark(arguments: Namespace) -> dict[str, Any]:
+    """
+    Runs `arguments.backends` servers, and the clients either on all of them, or on a
+    gateway in front of them with `arguments.gateway`. The memory reported as the
+    server's is the one of the process the clients talk to.
+    """
+
+    ports = [free_port() for _ in range(arguments.backends)]
+    if arguments.port is not None:
+        ports[0] = arguments.port
+    backend_urls = [f"http://127.0.0.1:{port}" for port in ports]
+    processes = []
+    try:
+        backend_processes = []
+        for port in ports:
+            backend_processes.append(start_server(arguments, port))
+            processes.append(backend_processes[-1])
+        if arguments.gateway:
+            gateway_port = free_port()
+            processes.append(
+                start_gateway(backend_urls, port=gateway_port, threads=arguments.threads)
+            )
+            server_urls = [f"http://127.0.0.1:{gateway_port}"]
+        else:
+            server_urls = backend_urls
+
+        rss_sampler = RssSampler(pid=processes[-1].pid)
+        backend_rss_samplers = [
+            RssSampler(pid=process.pid) for process in backend_processes
+        ]
+        for sampler in [rss_sampler] + backend_rss_samplers:
+            sampler.start()
+        start_time = perf_counter()
+        with ThreadPoolExecutor(max_workers=arguments.concurrency) as executor:
+            client_results = list(
+                executor.map(
+                    lambda _: run_client(
+                        server_urls,
+                        commands_per_client=arguments.commands_per_client,
+                        command=arguments.command,
+                        timeout_seconds=arguments.command_timeout_seconds,
+                    ),
+                    range(arguments.clients),
+                )
+            )
+        wall_seconds = perf_counter() - start_time
+        server_rss_bytes = rss_sampler.stop()
+        backend_rss_bytes = [sampler.stop() for sampler in backend_rss_samplers]
+    finally:
+        for process in processes:
+            stop_server(process)
+
+    exec_seconds = [
+        seconds for result in client_results for seconds in result["exec_seconds"]
+    ]
+    created = [
+        result["create_seconds"]
+        for result in client_results
+        if result["create_seconds"] is not None
+    ]
+    errors = [error for result in client_results for error in result["errors"]]
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "version": package_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            key: value
+            for key, value in vars(arguments).items()
+            if key not in ["serve", "output", "baseline", "max_regression"]
+        },
+        "wall_seconds": wall_seconds,
+        "create_seconds": summarize(created),
+        "exec_seconds": summarize(exec_seconds),
+        "cleanup_seconds": summarize(
+            [
+                result["cleanup_seconds"]
+                for result in client_results
+                if result["cleanup_seconds"] is not None
+            ]
+        ),
+        "throughput": {
+            "commands_per_second": len(exec_seconds) / wall_seconds,
+            "sandboxes_per_second": len(created) / wall_seconds,
+        },
+        "server_rss_bytes": server_rss_bytes,
+        "backend_rss_bytes": backend_rss_bytes if arguments.gateway else None,
+        "errors": len(errors),
+        # A few of them, they are usually all the same.
+        "error_samples": errors[:5],
+    }
+
+
+@beartype
+def package_version() -> str | None:
+    try:
+        return importlib.metadata.version("remote-docker-sandbox")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+@beartype
+def find_regressions(
+    baseline: dict[str, Any], results: dict[str, Any], max_regression: float
+) -> list[str]:
+    """
+    The results that are worse than in `baseline` by more than the fraction
+    `max_regression` of the baseline value.
+    """
+
+    regressions = []
+    for (group, key), higher_is_better in COMPARED_RESULTS.items():
+        baseline_value = baseline.get(group, {}).get(key)
+        value = results.get(group, {}).get(key)
+        if baseline_value is None or value is None or baseline_value == 0:
+            continue
+        change = (value - baseline_value) / baseline_value
+        if (-change if higher_is_better else change) > max_regression:
+            regressions.append(
+                f"{group}.{key}: {value:.6g} vs {baseline_value:.6g} in the baseline ({change:+.1%})."
+            )
+    return regressions
+
+
+@beartype
+def serve(arguments: Namespace) -> None:
+    server = DockerSandboxServer(
+        docker=FakeDockerBackend(
+            create_latency_seconds=arguments.create_latency_seconds,
+            start_latency_seconds=arguments.start_latency_seconds,
+            exec_latency_seconds=arguments.exec_latency_seconds,
+            exec_output_bytes=arguments.exec_output_bytes,
+            remove_latency_seconds=arguments.remove_latency_seconds,
+            jitter=arguments.jitter,
+            seed=arguments.seed,
+        ),
+        host="127.0.0.1",
+        port=arguments.port,
+        threads=arguments.threads,
+        warm_pool_size=arguments.warm_pool_size,
+        warm_pool_shapes=[parse_shape(shape) for shape in arguments.warm_pool_shape],
+        remove_orphans_at_startup=False,
+    )
+    server.serve()
+
+
+@beartype
+def main() -> None:
+    parser = ArgumentParser(
+        description="Benchmark a local DockerSandboxServer that uses a fake docker backend, which only sleeps for the given latencies, with concurrent RemoteDockerSandbox clients. Prints the results as json."
+    )
+    parser.add_argument("--clients", type=int, default=64, help="Number of sandboxes created in total.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of sandboxes used at the same time.")
+    parser.add_argument("--commands-per-client", type=int, default=20)
+    parser.add_argument("--command", type=str, default="echo hi")
+    parser.add_argument("--command-timeout-seconds", type=float, default=60)
+    parser.add_argument("--create-latency-seconds", type=float, default=0.05)
+    parser.add_argument("--start-latency-seconds", type=float, default=0.05)
+    parser.add_argument("--exec-latency-seconds", type=float, default=0.01)
+    parser.add_argument("--exec-output-bytes", type=int, default=3)
+    parser.add_argument("--remove-latency-seconds", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latencies are multiplied by a random factor between 1 - jitter and 1 + jitter.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=256, help="Threads of the server.")
+    parser.add_argument("--warm-pool-size", type=int, default=0)
+    parser.add_argument("--warm-pool-shape", type=str, action="append", default=[])
+    parser.add_argument("--backends", type=int, default=1, help="Number of servers. The clients are given all of them, or only the gateway with --gateway.")
+    parser.add_argument("--gateway", action="store_true", help="Run the clients through a gateway in front of the servers.")
+    parser.add_argument("--port", type=int, default=None, help="Port of the first server. Defaults to a free port.")
+    parser.add_argument("--output", type=str, default=None, help="Also write the results to this json file.")
+    parser.add_argument("--baseline", type=str, default=None, help="The results of a previous run to compare with. Exits with code 1 if any result got worse by more than --max-regression.")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--serve", action="store_true", help="Only run the server, used by the benchmark for its child process.")
+    arguments = parser.parse_args()
+
+    if arguments.serve:
+        serve(arguments)
+        return
+
+    results = run_benchmark(arguments)
+    print(json.dumps(results, indent=2))
+    if arguments.output is not None:
+        with open(arguments.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(baseline, results, arguments.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import codecs
+from dataclasses import dataclass, field
+from typing import Any
+from beartype import beartype
+
+
+@beartype
+def translate_newlines(text: str) -> str:
+    """
+    The newline translation `subprocess.run(..., text=True)` does, so that output read as
+    bytes looks the same as output of the docker CLI read in text mode.
+    """
+
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+@beartype
+def truncation_marker(n_truncated_bytes: int) -> str:
+    return f"\n[... {n_truncated_bytes} bytes truncated ...]\n"
+
+
+@beartype
+@dataclass
+class CappedOutput:
+    """
+    Collects a command's output while holding at most about `max_bytes` of it: the first
+    `max_bytes // 2` bytes and the last `max_bytes - max_bytes // 2` bytes are kept, the
+    middle is dropped and only counted. `max_bytes=None` keeps everything.
+    """
+
+    max_bytes: int | None = None
+    total_bytes: int = 0
+    _head: bytearray = field(default_factory=lambda: bytearray())
+    _tail: bytearray = field(default_factory=lambda: bytearray())
+    _head_decoder: Any = field(
+        default_factory=lambda: codecs.getincrementaldecoder("utf-8")(errors="replace")
+    )
+
+    @property
+    def head_budget(self) -> int | None:
+        return None if self.max_bytes is None else self.max_bytes // 2
+
+    @property
+    def tail_budget(self) -> int:
+        assert self.max_bytes is not None
+        return self.max_bytes - self.max_bytes // 2
+
+    @property
+    def truncated_bytes(self) -> int:
+        return self.total_bytes - len(self._head) - len(self._tail)
+
+    def append(self, data: bytes) -> str:
+        """
+        Adds `data` and returns the part of it that went to the head, decoded, so that
+        streaming callers can forward it right away. Whatever isn't returned here is only
+        available from `tail_text` once the command is done.
+        """
+
+        self.total_bytes += len(data)
+
+        head_budget = self.head_budget
+        if head_budget is None:
+            self._head.extend(data)
+            return self._head_decoder.decode(data)
+
+        to_head = data[: max(head_budget - len(self._head), 0)]
+        self._head.extend(to_head)
+        self._tail.extend(data[len(to_head) :])
+        # Trim lazily so that appending stays amortized O(len(data)).
+        if len(self._tail) > 2 * self.tail_budget:
+            del self._tail[: len(self._tail) - self.tail_budget]
+        return self._head_decoder.decode(to_head)
+
+    def tail_text(self) -> str:
+        """
+        The decoded output that `append` didn't return, with a truncation marker in front
+        if some of the output was dropped.
+        """
+
+        if self.max_bytes is None:
+            return self._head_decoder.decode(b"", final=True)
+        return self._decode_rest(self._head_decoder)
+
+    def text(self) -> str:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        head = decoder.decode(bytes(self._head))
+        if self.max_bytes is None:
+            return head + decoder.decode(b"", final=True)
+        return head + self._decode_rest(decoder)
+
+    def _decode_rest(self, head_decoder: Any) -> str:
+        """
+        The tail, decoded after the head `head_decoder` decoded. Without truncation the
+        two are decoded as one, so a character split between them stays whole. With
+        truncation, the partial characters at the end of the head and at the start of
+        the tail are dropped with the middle.
+        """
+
+        if len(self._tail) > self.tail_budget:
+            del self._tail[: len(self._tail) - self.tail_budget]
+        if self.truncated_bytes == 0:
+            return head_decoder.decode(bytes(self._tail), final=True)
+
+        n_head_partial = len(head_decoder.getstate()[0])
+        head_decoder.reset()
+        # Continuation bytes, 0b10xxxxxx, of a character that started in the middle.
+        n_tail_partial = 0
+        while n_tail_partial < min(len(self._tail), 3) and (
+            self._tail[n_tail_partial] & 0xC0 == 0x80
+        ):
+            n_tail_partial += 1
+        return truncation_marker(
+            self.truncated_bytes + n_head_partial + n_tail_partial
+        ) + bytes(self._tail[n_tail_partial:]).decode(errors="replace")
@@ -0,0 +1,212 @@
+import os
+import random
+from collections import deque
+from collections.abc import Callable
+from threading import Lock, Thread
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.rest_client_base import get_session
+
+
+DEFAULT_BASE_BACKOFF_SECONDS = float(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_BASE_BACKOFF_SECONDS", "5")
+)
+DEFAULT_MAX_BACKOFF_SECONDS = float(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_MAX_BACKOFF_SECONDS", "300")
+)
+
+
+@beartype
+def probe_server(server_url: str, timeout_seconds: int | float = 5) -> bool:
+    try:
+        response = get_session(server_url).post(
+            f"{server_url}/process",
+            json={"function": "add_one", "x": 0},
+            timeout=timeout_seconds,
+        )
+        return response.status_code == 200 and response.json() == "1"
+    except Exception:
+        return False
+
+
+@beartype
+@dataclass
+class CircuitBreaker:
+    """
+    The health of one server. "closed": the server is used. "open": it isn't, until
+    `open_until`, after which it gets probed. "half_open": the probe passed and the
+    server is used again, and the next call decides whether it closes or opens again.
+    """
+
+    state: str = "closed"
+    outcomes: Any = None  # deque of the last calls' outcomes, True for a success
+    consecutive_failures: int = 0
+    consecutive_opens: int = 0
+    open_until: float = 0.0
+    successes: int = 0
+    failures: int = 0
+    last_error: str | None = None
+
+    def failure_rate(self) -> float | None:
+        if self.outcomes is None or len(self.outcomes) == 0:
+            return None
+        return sum(1 for success in self.outcomes if not success) / len(self.outcomes)
+
+
+@beartype
+@dataclass
+class ServerHealth:
+    """
+    One `CircuitBreaker` per server. A closed breaker opens after
+    `consecutive_failures_threshold` failures in a row, or when at least
+    `failure_rate_threshold` of its last `window_size` calls failed, once there were
+    `min_calls` of them. A half open breaker opens again after one failure.
+
+    An open breaker stays open for `base_backoff_seconds`, doubled every time it opens
+    again without having closed in between, up to `max_backoff_seconds`, and jittered.
+    Then a background thread probes the server until it answers, and the breaker goes
+    half open.
+    """
+
+    window_size: int = 20
+    min_calls: int = 5
+    failure_rate_threshold: float = 0.5
+    consecutive_failures_threshold: int = 3
+    base_backoff_seconds: int | float = DEFAULT_BASE_BACKOFF_SECONDS
+    max_backoff_seconds: int | float = DEFAULT_MAX_BACKOFF_SECONDS
+    probe: Callable[[str], bool] = probe_server
+    breakers: dict[str, CircuitBreaker] = field(default_factory=lambda: {})
+    _probing: set[str] = field(default_factory=lambda: set())
+    _lock: Any = field(default_factory=lambda: Lock())
+
+    def record_success(self, server_url: str) -> None:
+        with self._lock:
+            breaker = self._breaker(server_url)
+            breaker.outcomes.append(True)
+            breaker.successes += 1
+            breaker.consecutive_failures = 0
+            # Open breakers are still tried when all the servers are failing.
+            if breaker.state != "closed":
+                print(f"Server {server_url} is healthy again.")
+                breaker.state = "closed"
+                breaker.consecutive_opens = 0
+
+    def record_failure(self, server_url: str, error: str) -> None:
+        with self._lock:
+            breaker = self._breaker(server_url)
+            breaker.outcomes.append(False)
+            breaker.failures += 1
+            breaker.consecutive_failures += 1
+            breaker.last_error = error
+            if not self._should_open(breaker):
+                return
+            self._open(server_url, breaker)
+            start_probing = server_url not in self._probing
+            self._probing.add(server_url)
+
+        if start_probing:
+            Thread(target=self._probe_until_healthy, args=(server_url,), daemon=True).start()
+
+    def is_available(self, server_url: str) -> bool:
+        with self._lock:
+            return self._breaker(server_url).state != "open"
+
+    def seconds_until_retry(self, server_url: str) -> float:
+        """
+        How long until an open breaker gets probed, 0 if it isn't open.
+        """
+
+        with self._lock:
+            breaker = self._breaker(server_url)
+            if breaker.state != "open":
+                return 0.0
+            return max(breaker.open_until - monotonic(), 0.0)
+
+    def states(self, server_urls: list[str] | None = None) -> dict[str, dict]:
+        with self._lock:
+            if server_urls is None:
+                server_urls = list(self.breakers.keys())
+            now = monotonic()
+            return {
+                server_url: {
+                    "state": breaker.state,
+                    "failure_rate": breaker.failure_rate(),
+                    "consecutive_failures": breaker.consecutive_failures,
+                    "consecutive_opens": breaker.consecutive_opens,
+                    "seconds_until_retry": (
+                        max(breaker.open_until - now, 0.0)
+                        if breaker.state == "open"
+                        else 0.0
+                    ),
+                    "successes": breaker.successes,
+                    "failures": breaker.failures,
+                    "last_error": breaker.last_error,
+                }
+                for server_url, breaker in (
+                    (url, self._breaker(url)) for url in server_urls
+                )
+            }
+
+    def _breaker(self, server_url: str) -> CircuitBreaker:
+        if server_url not in self.breakers:
+            self.breakers[server_url] = CircuitBreaker(
+                outcomes=deque(maxlen=self.window_size)
+            )
+        return self.breakers[server_url]
+
+    def _should_open(self, breaker: CircuitBreaker) -> bool:
+        if breaker.state == "half_open":
+            return True
+        if breaker.state == "open":
+            return False
+        if breaker.consecutive_failures >= self.consecutive_failures_threshold:
+            return True
+        failure_rate = breaker.failure_rate()
+        return (
+            len(breaker.outcomes) >= self.min_calls
+            and failure_rate is not None
+            and failure_rate >= self.failure_rate_threshold
+        )
+
+    def _open(self, server_url: str, breaker: CircuitBreaker) -> None:
+        breaker.consecutive_opens += 1
+        backoff_seconds = min(
+            self.base_backoff_seconds * 2 ** (breaker.consecutive_opens - 1),
+            self.max_backoff_seconds,
+        ) * random.uniform(1, 1.5)
+        breaker.state = "open"
+        breaker.open_until = monotonic() + backoff_seconds
+        breaker.outcomes.clear()
+        breaker.consecutive_failures = 0
+        print(
+            f"Not using server {server_url} for {backoff_seconds:.1f} seconds because its calls failed. Last error: {breaker.last_error}"
+        )
+
+    def _probe_until_healthy(self, server_url: str) -> None:
+        while True:
+            with self._lock:
+                breaker = self._breaker(server_url)
+                if breaker.state != "open":
+                    self._probing.discard(server_url)
+                    return
+                wait_seconds = breaker.open_until - monotonic()
+            if wait_seconds > 0:
+                sleep(wait_seconds)
+                continue
+
+            healthy = self.probe(server_url)
+            with self._lock:
+                breaker = self._breaker(server_url)
+                if breaker.state != "open":
+                    continue
+                if healthy:
+                    breaker.state = "half_open"
+                else:
+                    breaker.last_error = "Health probe failed."
+                    self._open(server_url, breaker)
+
+
+server_health = ServerHealth()
@@ -1,11 +1,23 @@
 import os
+import random
 from uuid import uuid4
+from time import monotonic, sleep
 from shlex import quote
 import base64
+import posixpath
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterator
+from typing import Any
 from beartype import beartype
 
-from remote_docker_sandbox.rest_client_base import JsonRESTClient
+from remote_docker_sandbox.rest_client_base import (
+    JsonRESTClient,
+    DEFAULT_CONNECTION_POOL_SIZE,
+)
+from remote_docker_sandbox.server_selection import load_balancer
+from remote_docker_sandbox.circuit_breaker import server_health
+from remote_docker_sandbox.archive import stream_archive, read_archive
 
 
 @dataclass
@@ -17,11 +29,459 @@ class CompletedProcess:
 
 server_url_counter = 0
 
-blacklisted_server_urls = []
+# Server url -> monotonic time until which the server said it is too busy to start sandboxes.
+busy_server_urls: dict[str, float] = {}
 
 
 MAX_CREATE_RETRIES = 64
 
+# The WORKDIR of the sandbox image, which relative paths of uploaded and downloaded files
+# are relative to, like for commands.
+SANDBOX_WORKING_DIRECTORY = "/app"
+
+# "load": pick the least loaded server, see `LoadBalancer`. "round_robin": cycle through
+# the servers.
+SERVER_SELECTION = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_SELECTION", "load")
+
+# How long creating a sandbox keeps retrying while the servers answer that they are busy.
+MAX_START_WAIT_SECONDS = float(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_MAX_START_WAIT_SECONDS", "600")
+)
+
+
+@beartype
+def get_server_urls(server_urls: str | list[str] | None) -> list[str]:
+    if isinstance(server_urls, str):
+        server_urls = [server_urls]
+
+    if server_urls is None:
+        server_urls = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_URL")
+        if server_urls is not None:
+            server_urls = server_urls.split(",")
+
+    if server_urls is None:
+        raise ValueError(
+            "To initialize a JsonRESTClient, you must provide a server url, either with the server_url argument to the contructor or the REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable."
+        )
+
+    return server_urls
+
+
+@beartype
+def choose_server_url(
+    server_urls: list[str],
+    memory_gb: int | float = 1,
+    cpus: int = 1,
+    avoid: list[str] | None = None,
+) -> str:
+    """
+    Chooses among the servers whose circuit breaker isn't open (see `ServerHealth`) and
+    that aren't busy, preferring the ones not in `avoid`.
+    """
+
+    global server_url_counter
+
+    healthy_server_urls = [url for url in server_urls if server_health.is_available(url)]
+    if len(healthy_server_urls) == 0:
+        # All the servers are failing, take the one that gets retried first.
+        return min(server_urls, key=seconds_until_available)
+    preferred_server_urls = [
+        url for url in healthy_server_urls if url not in (avoid or [])
+    ] or healthy_server_urls
+
+    now = monotonic()
+    available_server_urls = [
+        url for url in preferred_server_urls if busy_server_urls.get(url, now) <= now
+    ]
+    if len(available_server_urls) == 0:
+        # All the servers are busy, take the one that should be free again first.
+        return min(preferred_server_urls, key=lambda url: busy_server_urls[url])
+
+    if SERVER_SELECTION == "load" and len(available_server_urls) > 1:
+        server_url = load_balancer.choose(
+            available_server_urls, memory_gb=memory_gb, cpus=cpus
+        )
+        if server_url is not None:
+            return server_url
+
+    server_url_counter %= len(server_urls)
+    while server_urls[server_url_counter] not in available_server_urls:
+        server_url_counter = (server_url_counter + 1) % len(server_urls)
+
+    server_url = server_urls[server_url_counter]
+    server_url_counter = (server_url_counter + 1) % len(server_urls)
+    return server_url
+
+
+@beartype
+def get_server_health(server_urls: list[str] | None = None) -> dict[str, dict]:
+    """
+    The circuit breaker state of every server this process used, or of `server_urls`:
+    "closed" (used), "open" (not used for "seconds_until_retry" seconds, then probed), or
+    "half_open" (probed successfully, used on trial), with recent failure statistics.
+    """
+
+    return server_health.states(server_urls)
+
+
+@beartype
+def busy_retry_after_seconds(response: Any) -> float | None:
+    """
+    How long to wait before retrying, if `response` says that the server is busy.
+    """
+
+    if isinstance(response, dict) and response.get("busy") is True:
+        return float(response["retry_after_seconds"])
+    return None
+
+
+@beartype
+def mark_server_busy(server_url: str, retry_after_seconds: int | float) -> None:
+    # Jittered, so that the clients that were turned down together don't all come back
+    # at the same time.
+    busy_server_urls[server_url] = monotonic() + retry_after_seconds * random.uniform(
+        1, 1.5
+    )
+
+
+@beartype
+def seconds_until_not_busy(server_url: str) -> float:
+    return max(busy_server_urls.get(server_url, 0.0) - monotonic(), 0.0)
+
+
+@beartype
+def seconds_until_available(server_url: str) -> float:
+    return max(
+        seconds_until_not_busy(server_url), server_health.seconds_until_retry(server_url)
+    )
+
+
+@beartype
+def start_error(start_response: Any) -> str | None:
+    """
+    The error if the response to start_container is one, None if the sandbox started or
+    the server was busy.
+    """
+
+    if busy_retry_after_seconds(start_response) is not None:
+        return None
+    if isinstance(start_response, dict) and "error" in start_response:
+        return str(start_response["error"])
+    # How the server reports an exception raised by start_container.
+    if (
+        isinstance(start_response, list)
+        and len(start_response) == 2
+        and isinstance(start_response[0], dict)
+        and "error" in start_response[0]
+    ):
+        return str(start_response[0]["error"])
+    return None
+
+
+@beartype
+def should_retry_start(server_url: str, start_response: Any) -> bool:
+    """
+    Records how starting a sandbox on `server_url` went, and returns whether to try again,
+    on this server if it was busy, or on another one if it failed.
+    """
+
+    retry_after_seconds = busy_retry_after_seconds(start_response)
+    if retry_after_seconds is not None:
+        mark_server_busy(server_url, retry_after_seconds)
+        return True
+
+    error = start_error(start_response)
+    if error is not None:
+        server_health.record_failure(server_url, error)
+        return True
+
+    server_health.record_success(server_url)
+    return False
+
+
+@beartype
+def record_call_outcome(
+    server_url: str, function: str, status_code: int | None, error: str | None = None
+) -> None:
+    """
+    Counts a call to a sandbox's server for the server's circuit breaker, like the gateway
+    does for its backends: not getting an answer, or a 5xx answer other than busy, is a
+    failure. Starts are left to `should_retry_start`, which also sees their errors.
+    """
+
+    if function == "start_container":
+        return
+    if status_code is None:
+        server_health.record_failure(server_url, str(error))
+    elif status_code >= 500 and status_code != 503:
+        server_health.record_failure(server_url, f"Status code {status_code}.")
+    elif status_code < 500:
+        server_health.record_success(server_url)
+
+
+@beartype
+def report_start_response(
+    server_url: str, start_response: Any, ignore_failed_server_calls: bool = True
+) -> None:
+    if busy_retry_after_seconds(start_response) is not None:
+        error_message = f"The servers were too busy to start the sandbox for more than {MAX_START_WAIT_SECONDS} seconds. Last response from {server_url}: {start_response['error']}"
+        if not ignore_failed_server_calls:
+            raise TimeoutError(error_message)
+        print(error_message)
+        return
+
+    error = start_error(start_response)
+    if error is not None:
+        error_message = f"Error creating sandbox. Last tried on server {server_url}: {error}"
+        if not ignore_failed_server_calls:
+            raise Exception(error_message)
+        print(error_message)
+
+
+@beartype
+def is_valid_completed_process_json(response: Any) -> bool:
+    return (
+        isinstance(response, dict)
+        and set(response.keys()) == {"returncode", "stdout", "stderr"}
+        and isinstance(response["returncode"], int)
+        and isinstance(response["stdout"], str)
+        and isinstance(response["stderr"], str)
+    )
+
+
+@beartype
+def parse_run_command_response(
+    response: Any, ignore_failed_server_calls: bool, caller: str = "RemoteDockerSandbox"
+) -> CompletedProcess:
+    if not is_valid_completed_process_json(response):
+        error_message = f"{caller}.run_command: Got invalid response from server. The response json is: {response}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+        return CompletedProcess(
+            returncode=1,
+            stdout="",
+            stderr="Received invalid response from the remote docker server.",
+        )
+
+    return CompletedProcess(**response)
+
+
+@beartype
+def parse_run_commands_sequentially_response(
+    response: Any,
+    n_commands: int,
+    ignore_failed_server_calls: bool,
+    caller: str = "RemoteDockerSandbox",
+) -> list[CompletedProcess]:
+    invalid_response = not (
+        isinstance(response, list)
+        and all(is_valid_completed_process_json(r) for r in response)
+    )
+    if invalid_response:
+        error_message = f"{caller}.run_commands_sequentially: Got invalid response from server. The response json is: {response}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+        return [
+            CompletedProcess(
+                returncode=1,
+                stdout="",
+                stderr="Received invalid response from the remote docker server.",
+            )
+            for _ in range(n_commands)
+        ]
+
+    return [CompletedProcess(**r) for r in response]
+
+
+@beartype
+def output_limit_kwargs(max_output_bytes: int | None) -> dict:
+    # Only sent when set, so that servers without output limits still understand the call.
+    if max_output_bytes is None:
+        return {}
+    return {"max_output_bytes": max_output_bytes}
+
+
+@beartype
+def container_path(path: str) -> str:
+    return posixpath.normpath(posixpath.join(SANDBOX_WORKING_DIRECTORY, path))
+
+
+@beartype
+def upload_files_archive(files: dict[str, str | bytes]) -> Iterator[bytes]:
+    # Text is only encoded when its file is sent.
+    return stream_archive(
+        (container_path(path), content.encode() if isinstance(content, str) else content)
+        for path, content in files.items()
+    )
+
+
+@beartype
+def parse_upload_response(
+    response: Any, ignore_failed_server_calls: bool, caller: str = "RemoteDockerSandbox"
+) -> CompletedProcess:
+    # upload_archive returns nothing when it succeeds.
+    if response is not None:
+        error_message = f"{caller}.upload_files: Error uploading files. The response json is: {response}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+        return CompletedProcess(
+            returncode=1,
+            stdout="",
+            stderr=f"Error uploading files to the remote docker server: {response}",
+        )
+
+    return CompletedProcess(returncode=0, stdout="", stderr="")
+
+
+@beartype
+def resettable_kwargs(resettable: bool) -> dict:
+    # Only sent when set, so that servers that can't reset containers still understand
+    # the call.
+    if not resettable:
+        return {}
+    return {"resettable": True}
+
+
+@beartype
+def cache_init_kwargs(cache_init: bool) -> dict:
+    # Only sent when not the default, for the same reason as `resettable_kwargs`.
+    if cache_init:
+        return {}
+    return {"cache_init": False}
+
+
+@beartype
+def parse_reset_response(
+    response: Any, ignore_failed_server_calls: bool, caller: str = "RemoteDockerSandbox"
+) -> CompletedProcess:
+    # reset_container returns nothing when it succeeds.
+    if response is not None:
+        error_message = f"{caller}.reset: Error resetting the sandbox. The response json is: {response}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+        return CompletedProcess(
+            returncode=1,
+            stdout="",
+            stderr=f"Error resetting the sandbox on the remote docker server: {response}",
+        )
+
+    return CompletedProcess(returncode=0, stdout="", stderr="")
+
+
+@beartype
+def downloaded_files_by_requested_path(
+    files: dict[str, bytes], paths: list[str]
+) -> dict[str, bytes]:
+    """
+    Renames the files of a downloaded archive, which are named after their absolute
+    path in the container, after the path they were requested with, e.g. "src/main.py"
+    or, when "src" was requested, "src/main.py" too, instead of "/app/src/main.py".
+    """
+
+    renamed = {}
+    for path in paths:
+        absolute_path = container_path(path)
+        for name, content in files.items():
+            if name == absolute_path:
+                renamed[path] = content
+            elif name.startswith(absolute_path.rstrip("/") + "/"):
+                relative_name = name[len(absolute_path.rstrip("/")) + 1 :]
+                renamed[posixpath.join(path, relative_name)] = content
+    return renamed
+
+
+@beartype
+class StreamingProcess:
+    """
+    Iterates over `(stream, text)` pairs, where `stream` is "stdout" or "stderr", as the
+    remote command produces output. Once the iteration is done, `returncode` and the
+    number of bytes the server dropped from the middle of each stream are set.
+
+    Usage:
+    process = sandbox.run_command_streaming("make")
+    for stream, text in process:
+        print(text, end="")
+    print(process.returncode)
+    """
+
+    returncode: int | None
+    stdout_truncated_bytes: int
+    stderr_truncated_bytes: int
+
+    def __init__(
+        self,
+        items: Iterator[Any],
+        ignore_failed_server_calls: bool = True,
+        caller: str = "RemoteDockerSandbox",
+    ) -> None:
+        self.items = items
+        self.ignore_failed_server_calls = ignore_failed_server_calls
+        self.caller = caller
+        self.returncode = None
+        self.stdout_truncated_bytes = 0
+        self.stderr_truncated_bytes = 0
+        self._invalid = False
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        for item in self.items:
+            output = self._parse_item(item)
+            if output is not None:
+                yield output
+            if self._invalid:
+                return
+        self._check_finished()
+
+    def _parse_item(self, item: Any) -> tuple[str, str] | None:
+        """
+        The (stream, text) pair of a streamed item, None for the last item, which sets
+        `returncode`. An invalid item ends the process.
+        """
+
+        if isinstance(item, dict) and isinstance(item.get("stdout"), str):
+            return "stdout", item["stdout"]
+        if isinstance(item, dict) and isinstance(item.get("stderr"), str):
+            return "stderr", item["stderr"]
+        if isinstance(item, dict) and isinstance(item.get("returncode"), int):
+            self.returncode = item["returncode"]
+            self.stdout_truncated_bytes = item.get("stdout_truncated_bytes", 0)
+            self.stderr_truncated_bytes = item.get("stderr_truncated_bytes", 0)
+            return None
+
+        error_message = f"{self.caller}.run_command_streaming: Got invalid response from server. The response json is: {item}"
+        if not self.ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+        self.returncode = 1
+        self._invalid = True
+        return "stderr", "Received invalid response from the remote docker server."
+
+    def _check_finished(self) -> None:
+        if self.returncode is None:
+            error_message = f"{self.caller}.run_command_streaming: The server closed the stream before sending the return code."
+            if not self.ignore_failed_server_calls:
+                raise ValueError(error_message)
+            print(error_message)
+            self.returncode = 1
+
+    def _completed_process(self, outputs: list[tuple[str, str]]) -> CompletedProcess:
+        assert self.returncode is not None
+        return CompletedProcess(
+            returncode=self.returncode,
+            stdout="".join(text for stream, text in outputs if stream == "stdout"),
+            stderr="".join(text for stream, text in outputs if stream == "stderr"),
+        )
+
+    def wait(self) -> CompletedProcess:
+        """
+        Consumes the rest of the output and returns it as a `CompletedProcess`.
+        """
+
+        return self._completed_process(list(self))
+
 
 @beartype
 class RemoteDockerSandbox(JsonRESTClient):
@@ -34,84 +494,133 @@ class RemoteDockerSandbox(JsonRESTClient):
         ignore_failed_server_calls: bool = True,
         memory_gb: int | float = 1,
         cpus: int = 1,
+        resettable: bool = False,
+        connection_pool_size: int = DEFAULT_CONNECTION_POOL_SIZE,
+        cache_init: bool = True,
     ) -> None:
-        if isinstance(server_urls, str):
-            server_urls = [server_urls]
-
-        if server_urls is None:
-            server_urls = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_URL")
-            if server_urls is not None:
-                server_urls = server_urls.split(",")
-
-        if server_urls is None:
-            raise ValueError(
-                "To initialize a JsonRESTClient, you must provide a server url, either with the server_url argument to the contructor or the REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable."
-            )
-
-        global server_url_counter
-        global blacklisted_server_urls
-
-        assert set(server_urls) != set(blacklisted_server_urls), (
-            "All server URLs are blacklisted."
-        )
+        """
+        With `resettable`, the server snapshots the sandbox once it started, and `reset`
+        brings it back to that state much faster than starting a new sandbox.
 
-        while server_urls[server_url_counter] in blacklisted_server_urls:
-            server_url_counter = (server_url_counter + 1) % len(server_urls)
+        Servers with an init image cache (`--init-image-cache-gb`) may start the sandbox
+        from an image saved after `init_command` ran in an earlier sandbox, instead of
+        running it. That image only has files, so processes `init_command` starts, e.g.
+        daemons, aren't running. Pass `cache_init=False` to always run `init_command`.
+        """
 
+        server_urls = get_server_urls(server_urls)
         super().__init__(
-            server_url=server_urls[server_url_counter],
+            server_url=choose_server_url(server_urls, memory_gb=memory_gb, cpus=cpus),
             ignore_failed_server_calls=ignore_failed_server_calls,
+            connection_pool_size=connection_pool_size,
         )
-        server_url_counter = (server_url_counter + 1) % len(server_urls)
 
         self.container_name = f"docker-sandbox-{uuid4()}"
 
-        start_response = self.call_server(
-            function="start_container",
-            container_name=self.container_name,
-            init_command=init_command,
-            memory_gb=memory_gb,
-            cpus=cpus,
+        # Busy servers are retried after the time they ask for, or another server is
+        # used in the meantime. Failed starts are retried on another server.
+        deadline = monotonic() + MAX_START_WAIT_SECONDS
+        failed_server_urls = []
+        while True:
+            sleep(
+                min(
+                    seconds_until_available(self.server_url),
+                    max(deadline - monotonic(), 0),
+                )
+            )
+            try:
+                start_response = self.call_server(
+                    function="start_container",
+                    container_name=self.container_name,
+                    init_command=init_command,
+                    memory_gb=memory_gb,
+                    cpus=cpus,
+                    **resettable_kwargs(resettable),
+                    **cache_init_kwargs(cache_init),
+                )
+            except Exception as e:
+                # Only raised if not ignore_failed_server_calls.
+                start_response = {"error": f"Error communicating with server: {e}"}
+            if (
+                not should_retry_start(self.server_url, start_response)
+                or monotonic() >= deadline
+            ):
+                break
+            if start_error(start_response) is not None:
+                self._stop_abandoned_start()
+                failed_server_urls.append(self.server_url)
+                if len(failed_server_urls) >= MAX_CREATE_RETRIES:
+                    break
+            self.use_server_url(
+                choose_server_url(
+                    server_urls, memory_gb=memory_gb, cpus=cpus, avoid=failed_server_urls
+                )
+            )
+
+        report_start_response(
+            self.server_url,
+            start_response,
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
         )
 
-        error = isinstance(start_response, dict) and set(start_response.keys()) == {
-            "error"
-        }
-        if error:
+    def record_call_outcome(
+        self, function: str, status_code: int | None, error: str | None = None
+    ) -> None:
+        record_call_outcome(self.server_url, function, status_code, error)
+
+    def _stop_abandoned_start(self) -> None:
+        """
+        Best effort stop of the container on the current server after its start failed,
+        since the server may have created it anyway, e.g. if the response timed out, and
+        nothing else would stop it there.
+        """
+
+        try:
+            self.call_server(function="stop_container", container_name=self.container_name)
+        except Exception as e:
             print(
-                f"ERROR CREATING SANDBOX WITH SERVER URL {self.server_url}!! THIS SERVER WILL NEVER BE USED AGAIN!!"
+                f"Error stopping container {self.container_name} on server {self.server_url} after its start failed: {e}"
             )
-            blacklisted_server_urls.append(self.server_url)
 
     def run_command(
-        self, command: str, timeout_seconds: float | int = 1
+        self,
+        command: str,
+        timeout_seconds: float | int = 1,
+        max_output_bytes: int | None = None,
     ) -> CompletedProcess:
         response = self.call_server(
             function="run_command",
             container_name=self.container_name,
             command=command,
             timeout_seconds=timeout_seconds,
+            **output_limit_kwargs(max_output_bytes),
         )
 
-        invalid_response = not (
-            isinstance(response, dict)
-            and set(response.keys()) == {"returncode", "stdout", "stderr"}
-            and isinstance(response["returncode"], int)
-            and (response["stdout"], str)
-            and isinstance(response["stderr"], str)
+        return parse_run_command_response(
+            response, ignore_failed_server_calls=self.ignore_failed_server_calls
         )
-        if invalid_response:
-            error_message = f"RemoteDockerSandbox.run_command: Got invalid response from server. The response json is: {response}"
-            if not self.ignore_failed_server_calls:
-                raise ValueError(error_message)
-            print(error_message)
-            return CompletedProcess(
-                returncode=1,
-                stdout="",
-                stderr="Received invalid response from the remote docker server.",
-            )
 
-        return CompletedProcess(**response)
+    def run_command_streaming(
+        self,
+        command: str,
+        timeout_seconds: float | int = 1,
+        max_output_bytes: int | None = None,
+    ) -> "StreamingProcess":
+        """
+        Like `run_command`, but returns a `StreamingProcess` to iterate over the
+        command's output while it runs.
+        """
+
+        return StreamingProcess(
+            self.call_server_streaming(
+                function="run_command",
+                container_name=self.container_name,
+                command=command,
+                timeout_seconds=timeout_seconds,
+                **output_limit_kwargs(max_output_bytes),
+            ),
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
+        )
 
     def run_commands_sequentially(
         self,
@@ -127,43 +636,87 @@ class RemoteDockerSandbox(JsonRESTClient):
             per_command_timeout_seconds=per_command_timeout_seconds,
         )
 
-        invalid_response = not (
-            isinstance(response, list)
-            and all(
-                isinstance(r, dict)
-                and set(r.keys()) == {"returncode", "stdout", "stderr"}
-                and isinstance(r["returncode"], int)
-                and (r["stdout"], str)
-                and isinstance(r["stderr"], str)
-                for r in response
-            )
+        return parse_run_commands_sequentially_response(
+            response,
+            n_commands=len(commands),
+            ignore_failed_server_calls=self.ignore_failed_server_calls,
         )
-        if invalid_response:
-            error_message = f"RemoteDockerSandbox.run_commands_sequentially: Got invalid response from server. The response json is: {response}"
-            if not self.ignore_failed_server_calls:
-                raise ValueError(error_message)
-            print(error_message)
-            return [
-                CompletedProcess(
-                    returncode=1,
-                    stdout="",
-                    stderr="Received invalid response from the remote docker server.",
-                )
-                for _ in commands
-            ]
 
-        return [CompletedProcess(**r) for r in response]
+    def upload_file(self, filename: str, content: str | bytes) -> CompletedProcess:
+        """
+        Writes one file, see `upload_files`. This used to run `upload_file_command`, which
+        failed if the parent directory was missing, and kept the mode of a file it
+        overwrote. Relative paths are still relative to the working directory, /app.
+        """
+
+        return self.upload_files({filename: content})
+
+    def upload_files(self, files: dict[str, str | bytes]) -> CompletedProcess:
+        """
+        Writes all the files, a dict mapping paths to their contents, with a single tar
+        archive that the server extracts into the container. The archive is streamed as
+        it is built. Missing parent directories are created, and the files are written
+        with mode 644, replacing existing ones. Relative paths are relative to the
+        sandbox's working directory.
+        """
 
-    def upload_file(self, filename: str, content: str) -> CompletedProcess:
-        return self.run_command(
-            RemoteDockerSandbox.upload_file_command(filename=filename, content=content)
+        response = self.call_server_upload(
+            upload_files_archive(files),
+            function="upload_archive",
+            container_name=self.container_name,
+            path="/",
+        )
+        return parse_upload_response(
+            response, ignore_failed_server_calls=self.ignore_failed_server_calls
         )
 
+    def download_files(self, paths: list[str]) -> dict[str, bytes]:
+        """
+        Returns the contents of the files at `paths`, and of all the files in the
+        directories at `paths`, as a dict mapping each file's path to its contents.
+        """
+
+        response = self.call_server_download(
+            function="download_archive",
+            container_name=self.container_name,
+            paths=[container_path(path) for path in paths],
+        )
+        if isinstance(response, dict):
+            return {}
+
+        try:
+            with response:
+                files = read_archive(response.raw)
+        except Exception as e:
+            if not self.ignore_failed_server_calls:
+                raise e
+            print(f"RemoteDockerSandbox.download_files: Error reading the archive: {e}")
+            return {}
+
+        return downloaded_files_by_requested_path(files, paths)
+
     @staticmethod
     def upload_file_command(filename: str, content: str) -> str:
         encoded_data = base64.b64encode(content.encode()).decode()
         return f"echo {encoded_data} | base64 -d > {quote(filename)}"
 
+    def reset(self) -> CompletedProcess:
+        """
+        Kills all the processes of the sandbox and restores its files to what they were
+        right after it started and ran `init_command`, keeping the same container. The
+        sandbox must have been created with `resettable=True`.
+
+        Processes that `init_command` left running, e.g. daemons, are killed too and not
+        restarted.
+        """
+
+        response = self.call_server(
+            function="reset_container", container_name=self.container_name
+        )
+        return parse_reset_response(
+            response, ignore_failed_server_calls=self.ignore_failed_server_calls
+        )
+
     def cleanup(self) -> None:
         self.call_server(function="stop_container", container_name=self.container_name)
 
@@ -172,3 +725,137 @@ class RemoteDockerSandbox(JsonRESTClient):
     
     def __exit__(self, exception_type, exception_value, traceback) -> None:
         self.cleanup()
+
+
+BatchItem = tuple[str, str, float | int]  # (container_name, command, timeout_seconds)
+
+
+@beartype
+def batch_items_json(items: list[BatchItem]) -> list[dict]:
+    return [
+        {
+            "container_name": container_name,
+            "command": command,
+            "timeout_seconds": timeout_seconds,
+        }
+        for container_name, command, timeout_seconds in items
+    ]
+
+
+@beartype
+def parse_run_batch_response(
+    response: Any, n_items: int, ignore_failed_server_calls: bool
+) -> list[CompletedProcess]:
+    if not (isinstance(response, list) and len(response) == n_items):
+        error_message = f"run_batch: Got invalid response from server. The response json is: {response}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+        response = [None for _ in range(n_items)]
+
+    return [
+        parse_run_command_response(
+            r, ignore_failed_server_calls=ignore_failed_server_calls, caller="run_batch"
+        )
+        for r in response
+    ]
+
+
+@beartype
+def run_batch(
+    server_url: str, items: list[BatchItem], ignore_failed_server_calls: bool = True
+) -> list[CompletedProcess]:
+    """
+    Runs many commands, possibly in different containers, on one server with a single
+    request. The server runs them concurrently and the results are returned in order.
+    """
+
+    client = JsonRESTClient(
+        server_url=server_url, ignore_failed_server_calls=ignore_failed_server_calls
+    )
+    response = client.call_server(function="run_batch", items=batch_items_json(items))
+    return parse_run_batch_response(
+        response,
+        n_items=len(items),
+        ignore_failed_server_calls=ignore_failed_server_calls,
+    )
+
+
+@beartype
+def iter_batch(
+    server_url: str, items: list[BatchItem], ignore_failed_server_calls: bool = True
+) -> Iterator[tuple[int, CompletedProcess]]:
+    """
+    Like `run_batch`, but yields (index in `items`, result) pairs as the commands
+    complete on the server.
+    """
+
+    client = JsonRESTClient(
+        server_url=server_url, ignore_failed_server_calls=ignore_failed_server_calls
+    )
+    remaining_indices = set(range(len(items)))
+    for item in client.call_server_streaming(
+        function="run_batch", items=batch_items_json(items)
+    ):
+        if isinstance(item, dict) and item.get("index") in remaining_indices:
+            remaining_indices.remove(item["index"])
+            yield item["index"], parse_run_command_response(
+                item.get("result"),
+                ignore_failed_server_calls=ignore_failed_server_calls,
+                caller="iter_batch",
+            )
+            continue
+
+        error_message = f"iter_batch: Got invalid streamed item from server: {item}"
+        if not ignore_failed_server_calls:
+            raise ValueError(error_message)
+        print(error_message)
+
+    for index in sorted(remaining_indices):
+        yield index, CompletedProcess(
+            returncode=1,
+            stdout="",
+            stderr="Received invalid response from the remote docker server.",
+        )
+
+
+@beartype
+def run_command_in_sandboxes(
+    sandboxes: list[RemoteDockerSandbox],
+    commands: list[str],
+    timeout_seconds: float | int = 1,
+) -> list[CompletedProcess]:
+    """
+    Runs `commands[i]` in `sandboxes[i]` for every i, with one `run_batch` request per
+    server instead of one request per sandbox.
+    """
+
+    assert len(sandboxes) == len(commands)
+
+    server_url_to_indices: dict[str, list[int]] = {}
+    for i, sandbox in enumerate(sandboxes):
+        server_url_to_indices.setdefault(sandbox.server_url, []).append(i)
+
+    def run_on_server(server_url: str) -> list[CompletedProcess]:
+        indices = server_url_to_indices[server_url]
+        return run_batch(
+            server_url,
+            [
+                (sandboxes[i].container_name, commands[i], timeout_seconds)
+                for i in indices
+            ],
+            ignore_failed_server_calls=all(
+                sandboxes[i].ignore_failed_server_calls for i in indices
+            ),
+        )
+
+    results: list[CompletedProcess | None] = [None for _ in sandboxes]
+    with ThreadPoolExecutor(max_workers=max(len(server_url_to_indices), 1)) as executor:
+        for server_url, server_results in zip(
+            server_url_to_indices.keys(),
+            executor.map(run_on_server, server_url_to_indices.keys()),
+        ):
+            for i, result in zip(server_url_to_indices[server_url], server_results):
+                results[i] = result
+
+    return results  # type: ignore
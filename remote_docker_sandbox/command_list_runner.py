@@ -0,0 +1,177 @@
+import re
+from uuid import uuid4
+from dataclasses import dataclass, field
+from collections.abc import Callable, Iterator
+from beartype import beartype
+
+from remote_docker_sandbox.capped_output import CappedOutput
+from remote_docker_sandbox.docker_backend import ExecChunk
+
+
+# Runs its arguments after the first three one after the other, every one in its own
+# `/bin/bash -c` like a separate `docker exec` would, killed after the per command timeout
+# or the rest of the total timeout, both in microseconds. After every command, it prints
+# "\n<sentinel> <exit code> <1 if timed out else 0>\n" to stdout and "\n<sentinel>\n" to
+# stderr. Commands that don't start before the total timeout aren't run at all.
+# $EPOCHREALTIME (bash 5) keeps the time keeping free of process spawns.
+RUNNER_SCRIPT = r"""
+sentinel=$1
+total_us=$2
+per_command_us=$3
+shift 3
+start_us=${EPOCHREALTIME/./}
+for command in "$@"; do
+    remaining_us=$((total_us - (${EPOCHREALTIME/./} - start_us)))
+    if ((remaining_us <= 0)); then
+        break
+    fi
+    limit_us=$((remaining_us < per_command_us ? remaining_us : per_command_us))
+    printf -v limit '%d.%06d' $((limit_us / 1000000)) $((limit_us % 1000000))
+    before_us=${EPOCHREALTIME/./}
+    timeout -s KILL "$limit" /bin/bash -c "$command" < /dev/null
+    returncode=$?
+    timed_out=0
+    if ((returncode == 137 && ${EPOCHREALTIME/./} - before_us >= limit_us)); then
+        timed_out=1
+    fi
+    printf '\n%s %d %d\n' "$sentinel" "$returncode" "$timed_out"
+    printf '\n%s\n' "$sentinel" >&2
+done
+"""
+
+# How much longer than the total timeout the runner's exec may take before it is given
+# up on, for starting the exec and killing the last command.
+RUNNER_GRACE_SECONDS = 5
+
+TIMED_OUT_RESULT = {"returncode": 1, "stdout": "", "stderr": "timed out"}
+
+
+@beartype
+def runner_command(
+    sentinel: str,
+    commands: list[str],
+    total_timeout_seconds: int | float,
+    per_command_timeout_seconds: int | float,
+) -> list[str]:
+    """
+    The command to exec in the container to run `commands` with `RUNNER_SCRIPT`. The
+    commands are passed as arguments, so they need no quoting.
+    """
+
+    return [
+        "/bin/bash",
+        "-c",
+        RUNNER_SCRIPT,
+        "run_commands_sequentially",
+        sentinel,
+        str(max(int(total_timeout_seconds * 1_000_000), 0)),
+        str(max(int(per_command_timeout_seconds * 1_000_000), 0)),
+    ] + commands
+
+
+@beartype
+@dataclass
+class _SplitStream:
+    """
+    One of the runner's output streams, split into the outputs of the successive commands
+    at the sentinels that end them. Only the last `lookbehind` bytes are kept uncapped,
+    since a sentinel must be searched across chunk boundaries.
+    """
+
+    pattern: re.Pattern
+    max_bytes: int | None
+    lookbehind: int
+    outputs: list[CappedOutput] = field(default_factory=lambda: [])
+    # The groups of the sentinels found so far, one tuple per finished command.
+    frames: list[tuple[bytes, ...]] = field(default_factory=lambda: [])
+    _pending: bytearray = field(default_factory=lambda: bytearray())
+
+    def __post_init__(self) -> None:
+        self.outputs.append(CappedOutput(max_bytes=self.max_bytes))
+
+    def feed(self, chunk: bytes) -> None:
+        self._pending.extend(chunk)
+        while (match := self.pattern.search(self._pending)) is not None:
+            self.outputs[-1].append(bytes(self._pending[: match.start()]))
+            self.frames.append(match.groups())
+            end = match.end()
+            del match
+            del self._pending[:end]
+            self.outputs.append(CappedOutput(max_bytes=self.max_bytes))
+
+        if len(self._pending) > self.lookbehind:
+            self.outputs[-1].append(bytes(self._pending[: -self.lookbehind]))
+            del self._pending[: -self.lookbehind]
+
+
+@beartype
+def run_command_list(
+    exec_streaming: Callable[..., Iterator[ExecChunk]],
+    container_name: str,
+    commands: list[str],
+    total_timeout_seconds: int | float,
+    per_command_timeout_seconds: int | float,
+    max_output_bytes: int | None = None,
+    postprocess_output: Callable[[str], str] = lambda text: text,
+) -> list[dict]:
+    """
+    Runs `commands` one after the other in a single exec, and returns the same results as
+    running them with one exec each: a {"returncode": ..., "stdout": ..., "stderr": ...}
+    dict per command, the output of a timed out command being replaced with "timed out".
+
+    `exec_streaming` and `postprocess_output` are those of a `DockerBackend`.
+    """
+
+    if len(commands) == 0:
+        return []
+
+    sentinel = f"__remote_docker_sandbox_{uuid4().hex}__"
+    lookbehind = len(sentinel) + 64
+    streams = {
+        "stdout": _SplitStream(
+            pattern=re.compile(rb"\n" + sentinel.encode() + rb" (\d+) ([01])\n"),
+            max_bytes=max_output_bytes,
+            lookbehind=lookbehind,
+        ),
+        "stderr": _SplitStream(
+            pattern=re.compile(rb"\n" + sentinel.encode() + rb"\n"),
+            max_bytes=max_output_bytes,
+            lookbehind=lookbehind,
+        ),
+    }
+
+    try:
+        for stream, data in exec_streaming(
+            container_name,
+            runner_command(
+                sentinel,
+                commands,
+                total_timeout_seconds=total_timeout_seconds,
+                per_command_timeout_seconds=per_command_timeout_seconds,
+            ),
+            timeout_seconds=total_timeout_seconds + RUNNER_GRACE_SECONDS,
+        ):
+            if stream != "returncode":
+                assert isinstance(data, bytes)
+                streams[stream].feed(data)
+    except TimeoutError:
+        pass  # the commands that didn't finish are reported as timed out below
+
+    stdout, stderr = streams["stdout"], streams["stderr"]
+    results = []
+    for i in range(len(commands)):
+        if i >= len(stdout.frames) or i >= len(stderr.frames):
+            results.append(dict(TIMED_OUT_RESULT))
+            continue
+        returncode, timed_out = stdout.frames[i]
+        if timed_out == b"1":
+            results.append(dict(TIMED_OUT_RESULT))
+            continue
+        results.append(
+            {
+                "returncode": int(returncode),
+                "stdout": postprocess_output(stdout.outputs[i].text()),
+                "stderr": postprocess_output(stderr.outputs[i].text()),
+            }
+        )
+    return results
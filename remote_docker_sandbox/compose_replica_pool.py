@@ -0,0 +1,237 @@
+from threading import Lock, Condition, Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from collections.abc import Callable
+from time import monotonic
+import traceback
+import atexit
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.rest_server_base import ServerBusy
+
+
+@beartype
+@dataclass
+class ComposeReplicaPool:
+    """
+    Leases the replicas of a docker compose service out one at a time, and scales the
+    service with the demand.
+
+    Released replicas are reset with `reset_replica(name)` and go back to the free list,
+    most recently used first, instead of the stack being torn down. A replica whose reset
+    fails is removed with `remove_replicas(names)`, and recreated by the next scale up.
+
+    The service is kept at the leased replicas plus the waiting leases plus
+    `spare_replicas`, between `min_replicas` and `max_replicas`. It grows as soon as it
+    needs to, and shrinks by removing free replicas once it was bigger than needed for
+    `scale_down_after_seconds`. `scale(replicas)` must scale the service and return the
+    names of all its replicas.
+    """
+
+    scale: Callable[[int], list[str]]
+    reset_replica: Callable[[str], None]
+    remove_replicas: Callable[[list[str]], None]
+    min_replicas: int = 0
+    max_replicas: int = 64
+    spare_replicas: int = 1
+    scale_down_after_seconds: int | float = 60
+    check_interval_seconds: int | float = 5
+    max_lease_wait_seconds: int | float = 30
+    busy_retry_after_seconds: int | float = 10
+    reset_concurrency: int = 8
+    leases: int = 0
+    waited_leases: int = 0
+    rejected_leases: int = 0
+    resets: int = 0
+    failed_resets: int = 0
+    scale_ups: int = 0
+    scale_downs: int = 0
+    failed_scales: int = 0
+    _replicas: set[str] = field(default_factory=lambda: set())
+    _free: list[str] = field(default_factory=lambda: [])
+    _leased: set[str] = field(default_factory=lambda: set())
+    _resetting: set[str] = field(default_factory=lambda: set())
+    _waiting: int = 0
+    _all_needed_at: float = field(default_factory=lambda: monotonic())
+    _lock: Any = field(default_factory=lambda: Lock())
+    _replica_freed: Any = None
+    _scale_needed: Any = field(default_factory=lambda: Event())
+    _stopped: Any = field(default_factory=lambda: Event())
+    _reset_executor: ThreadPoolExecutor | None = None
+    _thread: Thread | None = None
+
+    def __post_init__(self) -> None:
+        self._replica_freed = Condition(self._lock)
+        self._reset_executor = ThreadPoolExecutor(max_workers=self.reset_concurrency)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._scale_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self._scale_needed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def lease(self) -> str:
+        """
+        Returns the name of a free replica, which the caller has until it `release`s it,
+        waiting up to `max_lease_wait_seconds` for one, after which it raises ServerBusy.
+        """
+
+        deadline = monotonic() + self.max_lease_wait_seconds
+        with self._lock:
+            if len(self._free) == 0:
+                self.waited_leases += 1
+            self._waiting += 1
+            self._scale_needed.set()
+            try:
+                while len(self._free) == 0:
+                    remaining_seconds = deadline - monotonic()
+                    if remaining_seconds <= 0:
+                        self.rejected_leases += 1
+                        raise ServerBusy(
+                            f"Server busy: no docker compose replica became free within {self.max_lease_wait_seconds} seconds. {len(self._leased)} of at most {self.max_replicas} replicas are leased.",
+                            retry_after_seconds=self.busy_retry_after_seconds,
+                        )
+                    self._replica_freed.wait(timeout=remaining_seconds)
+            finally:
+                self._waiting -= 1
+            replica_name = self._free.pop()
+            self._leased.add(replica_name)
+            self.leases += 1
+            return replica_name
+
+    def release(self, replica_name: str) -> None:
+        """
+        Resets the replica in the background and then puts it back on the free list.
+        """
+
+        with self._lock:
+            if replica_name not in self._leased:
+                return
+            self._leased.discard(replica_name)
+            self._resetting.add(replica_name)
+        assert self._reset_executor is not None
+        self._reset_executor.submit(self._reset, replica_name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "replicas": len(self._replicas),
+                "leased": len(self._leased),
+                "free": len(self._free),
+                "resetting": len(self._resetting),
+                "waiting": self._waiting,
+                "utilization": (
+                    len(self._leased) / len(self._replicas)
+                    if len(self._replicas) > 0
+                    else 0.0
+                ),
+                "min_replicas": self.min_replicas,
+                "max_replicas": self.max_replicas,
+                "leases": self.leases,
+                "waited_leases": self.waited_leases,
+                "rejected_leases": self.rejected_leases,
+                "resets": self.resets,
+                "failed_resets": self.failed_resets,
+                "scale_ups": self.scale_ups,
+                "scale_downs": self.scale_downs,
+                "failed_scales": self.failed_scales,
+            }
+
+    def _reset(self, replica_name: str) -> None:
+        try:
+            self.reset_replica(replica_name)
+        except Exception as e:
+            print(
+                f"Error resetting docker compose replica {replica_name}, removing it: {e}\n{traceback.format_exc()}"
+            )
+            with self._lock:
+                self._resetting.discard(replica_name)
+                self._replicas.discard(replica_name)
+                self.failed_resets += 1
+            try:
+                self.remove_replicas([replica_name])
+            except Exception as e:
+                print(f"Error removing docker compose replica {replica_name}: {e}")
+            self._scale_needed.set()
+            return
+
+        with self._lock:
+            self._resetting.discard(replica_name)
+            self.resets += 1
+            if replica_name in self._replicas:
+                self._free.append(replica_name)
+                self._replica_freed.notify()
+
+    def _scale_loop(self) -> None:
+        # The replicas left over by a previous run may be dirty.
+        first_scale = True
+        while not self._stopped.is_set():
+            self._scale_needed.clear()
+            try:
+                self._scale_once(first_scale=first_scale)
+                first_scale = False
+            except Exception as e:
+                print(f"Error scaling the docker compose service: {e}")
+                with self._lock:
+                    self.failed_scales += 1
+            self._scale_needed.wait(timeout=self.check_interval_seconds)
+
+    def _scale_once(self, first_scale: bool) -> None:
+        with self._lock:
+            needed = min(
+                max(
+                    len(self._leased) + self._waiting + self.spare_replicas,
+                    self.min_replicas,
+                ),
+                self.max_replicas,
+            )
+            now = monotonic()
+            if needed >= len(self._replicas):
+                self._all_needed_at = now
+            to_remove = []
+            if (
+                needed < len(self._replicas)
+                and now - self._all_needed_at >= self.scale_down_after_seconds
+            ):
+                # The least recently used free replicas.
+                count = min(len(self._replicas) - needed, len(self._free))
+                to_remove = self._free[:count]
+                del self._free[:count]
+                self._replicas.difference_update(to_remove)
+            replicas = len(self._replicas)
+
+        if not first_scale and needed <= replicas and len(to_remove) == 0:
+            return
+
+        if len(to_remove) > 0:
+            # Removed by name first, since which replicas compose would remove is up to it.
+            self.remove_replicas(to_remove)
+        replica_names = self.scale(max(needed, replicas))
+
+        with self._lock:
+            if len(to_remove) > 0:
+                self.scale_downs += 1
+            new_replicas = [
+                name for name in replica_names if name not in self._replicas
+            ]
+            if len(new_replicas) > 0 and not first_scale:
+                self.scale_ups += 1
+            self._replicas.update(new_replicas)
+            if not first_scale:
+                self._free.extend(new_replicas)
+                self._replica_freed.notify_all()
+            else:
+                self._resetting.update(new_replicas)
+
+        if first_scale:
+            assert self._reset_executor is not None
+            for replica_name in new_replicas:
+                self._reset_executor.submit(self._reset, replica_name)
@@ -0,0 +1,196 @@
+from threading import Lock, Event, Thread
+from dataclasses import dataclass, field
+from collections.abc import Callable
+from time import monotonic
+import atexit
+from typing import Any
+from beartype import beartype
+
+
+@beartype
+@dataclass
+class ContainerLifecycle:
+    """
+    Tracks when every container was last used, and removes containers in the background:
+    the ones passed to `remove`, in batches of at most `batch_size` per
+    `remove_containers(names)` call, and, if `idle_ttl_seconds` isn't None, the ones that
+    haven't been used for that long, which are handed to `stop_idle_container(name)`.
+
+    A container counts as used when it is tracked, and when a `using` block for it starts
+    or ends. It is never idle while such a block is running.
+
+    Containers can also be used outside of this lifecycle, e.g. by other worker processes.
+    Then every `using` block calls `on_use(name, 1)` when it starts and `on_use(name, -1)`
+    when it ends, and before a container is stopped as idle, `idle_seconds(name)` tells
+    for how long it really was idle, None if it was stopped already.
+    """
+
+    remove_containers: Callable[[list[str]], None]
+    stop_idle_container: Callable[[str], None]
+    idle_ttl_seconds: int | float | None = None
+    check_interval_seconds: int | float = 10
+    batch_size: int = 100
+    on_use: Callable[[str, int], None] | None = None
+    idle_seconds: Callable[[str], float | None] | None = None
+    idle_containers_stopped: int = 0
+    containers_removed: int = 0
+    failed_removals: int = 0
+    _last_used: dict[str, float] = field(default_factory=lambda: {})
+    _active: dict[str, int] = field(default_factory=lambda: {})
+    _to_remove: list[str] = field(default_factory=lambda: [])
+    _lock: Any = field(default_factory=lambda: Lock())
+    _wakeup: Any = field(default_factory=lambda: Event())
+    _stopped: Any = field(default_factory=lambda: Event())
+    _thread: Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self) -> None:
+        """
+        Stops the background thread and removes the containers still waiting for removal.
+        """
+
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._remove_pending()
+
+    def track(self, container_name: str) -> None:
+        with self._lock:
+            self._last_used[container_name] = monotonic()
+
+    def forget(self, container_name: str) -> None:
+        with self._lock:
+            self._last_used.pop(container_name, None)
+            self._active.pop(container_name, None)
+
+    def using(self, container_name: str) -> "_Using":
+        return _Using(lifecycle=self, container_name=container_name)
+
+    def _touch(self, container_name: str, active_delta: int) -> None:
+        if self.on_use is not None:
+            self.on_use(container_name, active_delta)
+        with self._lock:
+            # Containers that were never tracked or are already forgotten stay so.
+            if container_name not in self._last_used:
+                return
+            self._last_used[container_name] = monotonic()
+            active = self._active.get(container_name, 0) + active_delta
+            if active > 0:
+                self._active[container_name] = active
+            else:
+                self._active.pop(container_name, None)
+
+    def remove(self, container_name: str) -> None:
+        with self._lock:
+            self._to_remove.append(container_name)
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "idle_ttl_seconds": self.idle_ttl_seconds,
+                "tracked_containers": len(self._last_used),
+                "active_containers": len(self._active),
+                "pending_removals": len(self._to_remove),
+                "idle_containers_stopped": self.idle_containers_stopped,
+                "containers_removed": self.containers_removed,
+                "failed_removals": self.failed_removals,
+            }
+
+    def _loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(timeout=self.check_interval_seconds)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            self._stop_idle_containers()
+            self._remove_pending()
+
+    def _stop_idle_containers(self) -> None:
+        if self.idle_ttl_seconds is None:
+            return
+
+        now = monotonic()
+        with self._lock:
+            idle = [
+                container_name
+                for container_name, last_used in self._last_used.items()
+                if container_name not in self._active
+                and now - last_used >= self.idle_ttl_seconds
+            ]
+            for container_name in idle:
+                del self._last_used[container_name]
+
+        if self.idle_seconds is not None:
+            idle = [
+                container_name
+                for container_name in idle
+                if self._idle_elsewhere(container_name, now)
+            ]
+
+        for container_name in idle:
+            print(
+                f"Stopping container {container_name}, which was idle for more than {self.idle_ttl_seconds} seconds."
+            )
+            try:
+                self.stop_idle_container(container_name)
+            except Exception as e:
+                print(f"Error stopping idle container {container_name}: {e}")
+            with self._lock:
+                self.idle_containers_stopped += 1
+
+    def _idle_elsewhere(self, container_name: str, now: float) -> bool:
+        assert self.idle_seconds is not None
+        assert self.idle_ttl_seconds is not None
+        try:
+            idle_seconds = self.idle_seconds(container_name)
+        except Exception as e:
+            print(f"Error getting how long container {container_name} was idle: {e}")
+            idle_seconds = 0.0
+        if idle_seconds is None:
+            return False
+        if idle_seconds >= self.idle_ttl_seconds:
+            return True
+        # Checked again once it may have been idle for long enough.
+        with self._lock:
+            self._last_used.setdefault(container_name, now - idle_seconds)
+        return False
+
+    def _remove_pending(self) -> None:
+        while True:
+            with self._lock:
+                batch = self._to_remove[: self.batch_size]
+                self._to_remove = self._to_remove[self.batch_size :]
+            if len(batch) == 0:
+                return
+            try:
+                self.remove_containers(batch)
+                failed = False
+            except Exception as e:
+                print(f"Error removing containers {', '.join(batch)}: {e}")
+                failed = True
+            with self._lock:
+                if failed:
+                    self.failed_removals += len(batch)
+                else:
+                    self.containers_removed += len(batch)
+
+
+@beartype
+@dataclass
+class _Using:
+    lifecycle: ContainerLifecycle
+    container_name: str
+
+    def __enter__(self) -> None:
+        self.lifecycle._touch(self.container_name, active_delta=1)
+
+    def __exit__(self, *exception_info: Any) -> None:
+        self.lifecycle._touch(self.container_name, active_delta=-1)
@@ -0,0 +1,67 @@
+from beartype import beartype
+
+
+# Where the snapshot is kept in the container. Must not be under one of the reset paths.
+SNAPSHOT_DIRECTORY = "/var/lib/remote_docker_sandbox"
+
+DEFAULT_RESET_PATHS = ["/app", "/tmp", "/root", "/home"]
+
+# Archives the paths given as arguments after the first two, which are the snapshot
+# directory and whether to keep an existing snapshot, and remembers all of them, so that
+# the ones created later are removed.
+SNAPSHOT_SCRIPT = r"""
+snapshot_directory=$1
+keep_existing=$2
+shift 2
+if [ "$keep_existing" = 1 ] && [ -f "$snapshot_directory/snapshot.tar" ]; then
+    exit 0
+fi
+mkdir -p "$snapshot_directory" || exit
+existing_paths=()
+for path in "$@"; do
+    if [ -e "$path" ]; then
+        existing_paths+=("${path#/}")
+    fi
+done
+printf '%s\n' "$@" > "$snapshot_directory/paths" &&
+    tar -C / --create --file "$snapshot_directory/snapshot.tar" -T /dev/null "${existing_paths[@]}"
+"""
+
+# Kills every process but the container's init and this shell, then replaces the
+# snapshotted paths with the snapshot. Paths that are mount points are emptied instead.
+# Only files are restored: the processes started before the snapshot, e.g. daemons
+# started by an init command, stay killed.
+RESET_SCRIPT = r"""
+snapshot_directory=$1
+if [ ! -f "$snapshot_directory/snapshot.tar" ]; then
+    echo "The container has no snapshot to reset to. It must be started with resettable=True." >&2
+    exit 1
+fi
+kill -9 -1 2>/dev/null
+while read -r path; do
+    rm -rf "$path" 2>/dev/null || find "$path" -mindepth 1 -delete 2>/dev/null
+done < "$snapshot_directory/paths"
+tar -C / --extract --preserve-permissions --same-owner --file "$snapshot_directory/snapshot.tar"
+"""
+
+
+@beartype
+def snapshot_command(paths: list[str], keep_existing: bool = False) -> list[str]:
+    """
+    The command snapshotting `paths` in a container. If `keep_existing`, it does nothing
+    in a container that has a snapshot already.
+    """
+
+    return [
+        "/bin/bash",
+        "-c",
+        SNAPSHOT_SCRIPT,
+        "snapshot",
+        SNAPSHOT_DIRECTORY,
+        "1" if keep_existing else "0",
+    ] + paths
+
+
+@beartype
+def reset_command() -> list[str]:
+    return ["/bin/bash", "-c", RESET_SCRIPT, "reset", SNAPSHOT_DIRECTORY]
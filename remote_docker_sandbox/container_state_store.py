@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager, AbstractContextManager
+from dataclasses import dataclass, field
+from time import time, sleep, monotonic
+from typing import Any
+from beartype import beartype
+
+
+@beartype
+@dataclass
+class ContainerStateStore:
+    """
+    The state of the containers shared by the worker processes of a server, in an SQLite
+    database in WAL mode, so that any worker can serve any container: whether it is
+    still starting, started or failed to start, which worker owns it, the memory and cpus
+    it reserves, and when it was last used and by how many requests it is used now.
+
+    Every thread of every process uses its own connection.
+    """
+
+    path: str
+    busy_timeout_seconds: int | float = 30
+    min_poll_seconds: int | float = 0.005
+    max_poll_seconds: int | float = 0.1
+    _local: Any = field(default_factory=lambda: threading.local())
+
+    def __post_init__(self) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS containers (
+                    name TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    error TEXT,
+                    worker INTEGER NOT NULL,
+                    memory_gb REAL NOT NULL,
+                    cpus INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    active INTEGER NOT NULL
+                )
+                """
+            )
+
+    def clear(self) -> None:
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM containers")
+
+    def reserve(
+        self,
+        container_name: str,
+        memory_gb: int | float,
+        cpus: int,
+        worker: int,
+        capacity_memory_gb: int | float | None = None,
+        capacity_cpus: int | float | None = None,
+    ) -> bool:
+        """
+        Adds the container in the "starting" state if it fits in the capacity next to the
+        containers that didn't fail to start, and returns whether it did. A container
+        bigger than the capacity still gets to run alone.
+        """
+
+        with self._transaction() as connection:
+            live_containers, reserved_memory_gb, reserved_cpus = connection.execute(
+                "SELECT COUNT(*), TOTAL(memory_gb), TOTAL(cpus) FROM containers WHERE state != 'failed'"
+            ).fetchone()
+            fits = live_containers == 0 or (
+                (
+                    capacity_memory_gb is None
+                    or reserved_memory_gb + memory_gb <= capacity_memory_gb
+                )
+                and (capacity_cpus is None or reserved_cpus + cpus <= capacity_cpus)
+            )
+            if fits:
+                connection.execute(
+                    "INSERT OR REPLACE INTO containers VALUES (?, 'starting', NULL, ?, ?, ?, ?, 0)",
+                    (container_name, worker, memory_gb, cpus, time()),
+                )
+            return fits
+
+    def set_started(self, container_name: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE containers SET state = 'started' WHERE name = ?",
+                (container_name,),
+            )
+
+    def set_failed(self, container_name: str, error: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE containers SET state = 'failed', error = ? WHERE name = ?",
+                (error, container_name),
+            )
+
+    def fail_starts_of_worker(self, worker: int, error: str) -> int:
+        """
+        Marks the containers that `worker` was starting as failed, e.g. after it died, and
+        returns how many there were.
+        """
+
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE containers SET state = 'failed', error = ? WHERE worker = ? AND state = 'starting'",
+                (error, worker),
+            ).rowcount
+
+    def remove(self, container_name: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM containers WHERE name = ?", (container_name,)
+            )
+
+    def touch(self, container_name: str, active_delta: int = 0) -> None:
+        """
+        Marks the container as used now, by `active_delta` more requests.
+        """
+
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE containers SET last_used = ?, active = MAX(active + ?, 0) WHERE name = ?",
+                (time(), active_delta, container_name),
+            )
+
+    def idle_seconds(self, container_name: str) -> float | None:
+        """
+        For how long the container wasn't used, 0 while it is, None if it isn't in the
+        store.
+        """
+
+        row = self._connection().execute(
+            "SELECT last_used, active FROM containers WHERE name = ?", (container_name,)
+        ).fetchone()
+        if row is None:
+            return None
+        last_used, active = row
+        return 0.0 if active > 0 else max(time() - last_used, 0.0)
+
+    def state(self, container_name: str) -> tuple[str, str | None] | None:
+        """
+        The state of the container and its error if it failed to start, None if it isn't
+        in the store.
+        """
+
+        row = self._connection().execute(
+            "SELECT state, error FROM containers WHERE name = ?", (container_name,)
+        ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def wait_until_started(
+        self, container_name: str, timeout_seconds: int | float | None = None
+    ) -> None:
+        """
+        Polls until the container isn't starting anymore, and raises the error it failed
+        to start with, if any.
+        """
+
+        deadline = None if timeout_seconds is None else monotonic() + timeout_seconds
+        poll_seconds = self.min_poll_seconds
+        while True:
+            state = self.state(container_name)
+            if state is None or state[0] == "started":
+                return
+            if state[0] == "failed":
+                raise Exception(state[1])
+            if deadline is not None and monotonic() > deadline:
+                raise TimeoutError(
+                    f"Container {container_name} didn't start within {timeout_seconds} seconds."
+                )
+            sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, self.max_poll_seconds)
+
+    def container_names(self) -> list[str]:
+        """
+        The containers that are starting or started.
+        """
+
+        return [
+            name
+            for (name,) in self._connection().execute(
+                "SELECT name FROM containers WHERE state != 'failed'"
+            )
+        ]
+
+    def load(self) -> dict[str, int | float]:
+        live_containers, pending_starts, reserved_memory_gb, reserved_cpus = (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*), TOTAL(state = 'starting'), TOTAL(memory_gb), TOTAL(cpus) FROM containers WHERE state != 'failed'"
+            )
+            .fetchone()
+        )
+        return {
+            "live_containers": live_containers,
+            "pending_starts": int(pending_starts),
+            "reserved_memory_gb": reserved_memory_gb,
+            "reserved_cpus": reserved_cpus,
+        }
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be shared with the processes forked after they were opened.
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.busy_timeout_seconds, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @contextmanager
+    def _transaction(self) -> AbstractContextManager[sqlite3.Connection]:
+        connection = self._connection()
+        # IMMEDIATE takes the write lock at once, so that reads and the write that depends
+        # on them see the same state.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
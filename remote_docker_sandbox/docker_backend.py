@@ -0,0 +1,817 @@
+import subprocess
+import http.client
+import socket
+import tarfile
+import struct
+import json
+import io
+import os
+import selectors
+import itertools
+from abc import ABC, abstractmethod
+from pathlib import Path
+from queue import LifoQueue, Empty, Full
+from urllib.parse import quote as url_quote
+from time import perf_counter
+from dataclasses import dataclass, field
+from collections.abc import Iterator
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.capped_output import CappedOutput, translate_newlines
+
+
+DEFAULT_DOCKER_SOCKET_PATH = "/var/run/docker.sock"
+
+
+# ("stdout", bytes) and ("stderr", bytes) chunks as the command writes them, then one
+# ("returncode", int) once it has exited.
+ExecChunk = tuple[str, bytes | int]
+
+ARCHIVE_CHUNK_SIZE = 65536
+
+
+@beartype
+class DockerBackend(ABC):
+    """
+    The container operations the sandbox servers need from docker.
+
+    `exec_streaming` yields `ExecChunk`s and raises TimeoutError if the command doesn't
+    finish within `timeout_seconds`. `exec` collects them into a dict with keys
+    "returncode", "stdout" and "stderr", keeping at most about `max_bytes` of each of
+    stdout and stderr (see `CappedOutput`).
+    """
+
+    @abstractmethod
+    def image_exists(self, image: str) -> bool:
+        pass
+
+    @abstractmethod
+    def build_image(self, image: str, context_path: Path) -> None:
+        pass
+
+    @abstractmethod
+    def image_size(self, image: str) -> int:
+        """
+        The size of the image in bytes, including the layers it shares with other images.
+        """
+        pass
+
+    @abstractmethod
+    def remove_image(self, image: str) -> None:
+        pass
+
+    @abstractmethod
+    def list_images(self, repository: str) -> list[str]:
+        """
+        The "repository:tag" names of all the images of `repository`.
+        """
+        pass
+
+    @abstractmethod
+    def commit_container(self, container_name: str, image: str) -> None:
+        """
+        Saves the current filesystem of the container as the image `image`.
+        """
+        pass
+
+    @abstractmethod
+    def create_container(
+        self, container_name: str, image: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        pass
+
+    @abstractmethod
+    def start_container(self, container_name: str) -> None:
+        pass
+
+    @abstractmethod
+    def rename_container(self, container_name: str, new_container_name: str) -> None:
+        pass
+
+    @abstractmethod
+    def exec_streaming(
+        self,
+        container_name: str,
+        command: list[str],
+        timeout_seconds: int | float | None = None,
+    ) -> Iterator[ExecChunk]:
+        pass
+
+    def exec(
+        self,
+        container_name: str,
+        command: list[str],
+        timeout_seconds: int | float | None = None,
+        max_bytes: int | None = None,
+    ) -> dict:
+        output = {
+            "stdout": CappedOutput(max_bytes=max_bytes),
+            "stderr": CappedOutput(max_bytes=max_bytes),
+        }
+        returncode = 1
+        for stream, data in self.exec_streaming(
+            container_name, command, timeout_seconds=timeout_seconds
+        ):
+            if stream == "returncode":
+                assert isinstance(data, int)
+                returncode = data
+            else:
+                assert isinstance(data, bytes)
+                output[stream].append(data)
+
+        return {
+            "returncode": returncode,
+            "stdout": self.postprocess_output(output["stdout"].text()),
+            "stderr": self.postprocess_output(output["stderr"].text()),
+        }
+
+    def postprocess_output(self, text: str) -> str:
+        """
+        Applied to the decoded stdout and stderr, so that every backend returns the same
+        output as the docker CLI read in text mode did.
+        """
+
+        return translate_newlines(text)
+
+    @abstractmethod
+    def put_archive(self, container_name: str, path: str, archive: Any) -> None:
+        """
+        Extracts the tar archive read from the binary file-like object `archive` into the
+        directory `path` of the container, like `docker cp - container:path`.
+        """
+        pass
+
+    @abstractmethod
+    def get_archive(self, container_name: str, path: str) -> Iterator[bytes]:
+        """
+        Returns the chunks of a tar archive of the file or directory `path` of the
+        container, like `docker cp container:path -`. Raises right away, and not while
+        iterating, if the path can't be read.
+        """
+        pass
+
+    @abstractmethod
+    def stop_container(self, container_name: str) -> None:
+        pass
+
+    @abstractmethod
+    def remove_container(self, container_name: str, force: bool = False) -> None:
+        pass
+
+    @abstractmethod
+    def list_containers(self, name_prefix: str) -> list[str]:
+        """
+        The names of all the containers, running or not, whose name starts with
+        `name_prefix`.
+        """
+        pass
+
+    def remove_containers(self, container_names: list[str]) -> None:
+        """
+        Force removes all the containers, running or not, trying every one of them even if
+        removing some fails.
+        """
+
+        errors = []
+        for container_name in container_names:
+            try:
+                self.remove_container(container_name, force=True)
+            except Exception as e:
+                errors.append(str(e))
+        if len(errors) > 0:
+            raise Exception("\n".join(errors))
+
+    def create_and_start_container(
+        self, container_name: str, image: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        self.create_container(
+            container_name=container_name, image=image, memory_gb=memory_gb, cpus=cpus
+        )
+        self.start_container(container_name)
+
+
+@beartype
+class CliDockerBackend(DockerBackend):
+    """
+    Runs every operation through the `docker` command line client.
+    """
+
+    def image_exists(self, image: str) -> bool:
+        output = subprocess.run(
+            ["docker", "image", "inspect", image],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return output.returncode == 0
+
+    def build_image(self, image: str, context_path: Path) -> None:
+        self._run(["docker", "build", "-t", image, str(context_path)])
+
+    def image_size(self, image: str) -> int:
+        return int(
+            self._run(["docker", "image", "inspect", "--format", "{{.Size}}", image])
+        )
+
+    def remove_image(self, image: str) -> None:
+        self._run(["docker", "rmi", image])
+
+    def list_images(self, repository: str) -> list[str]:
+        output = self._run(
+            ["docker", "images", "--format", "{{.Repository}}:{{.Tag}}", repository]
+        )
+        return [
+            image for image in output.splitlines() if image.startswith(repository + ":")
+        ]
+
+    def commit_container(self, container_name: str, image: str) -> None:
+        self._run(["docker", "commit", container_name, image])
+
+    def create_container(
+        self, container_name: str, image: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        self._run(
+            [
+                "docker",
+                "create",
+                "--name",
+                container_name,
+                "--memory",
+                f"{memory_gb}gb",
+                "--cpus",
+                str(cpus),
+                "--tty",
+                image,
+                "/bin/bash",
+                "-c",
+                "sleep infinity",
+            ]
+        )
+
+    def start_container(self, container_name: str) -> None:
+        self._run(["docker", "start", container_name])
+
+    def create_and_start_container(
+        self, container_name: str, image: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        self._run(
+            [
+                "docker",
+                "run",
+                "-d",
+                "--name",
+                container_name,
+                "--memory",
+                f"{memory_gb}gb",
+                "--cpus",
+                str(cpus),
+                "--tty",
+                image,
+                "/bin/bash",
+                "-c",
+                "sleep infinity",
+            ]
+        )
+
+    def rename_container(self, container_name: str, new_container_name: str) -> None:
+        self._run(["docker", "rename", container_name, new_container_name])
+
+    def exec_streaming(
+        self,
+        container_name: str,
+        command: list[str],
+        timeout_seconds: int | float | None = None,
+    ) -> Iterator[ExecChunk]:
+        deadline = None if timeout_seconds is None else perf_counter() + timeout_seconds
+
+        process = subprocess.Popen(
+            ["docker", "exec", container_name] + command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(process.stdout, selectors.EVENT_READ, "stdout")  # type: ignore
+                selector.register(process.stderr, selectors.EVENT_READ, "stderr")  # type: ignore
+
+                while len(selector.get_map()) > 0:
+                    remaining_time = (
+                        None if deadline is None else deadline - perf_counter()
+                    )
+                    if remaining_time is not None and remaining_time <= 0:
+                        raise TimeoutError(
+                            f"Command {command} in {container_name} timed out after {timeout_seconds} seconds."
+                        )
+
+                    for key, _ in selector.select(timeout=remaining_time):
+                        chunk = os.read(key.fileobj.fileno(), 65536)  # type: ignore
+                        if len(chunk) == 0:
+                            selector.unregister(key.fileobj)
+                        else:
+                            yield key.data, chunk
+
+            remaining_time = None if deadline is None else deadline - perf_counter()
+            try:
+                returncode = process.wait(timeout=remaining_time)
+            except subprocess.TimeoutExpired as e:
+                raise TimeoutError(str(e)) from e
+            yield "returncode", returncode
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            assert process.stdout is not None and process.stderr is not None
+            process.stdout.close()
+            process.stderr.close()
+
+    def put_archive(self, container_name: str, path: str, archive: Any) -> None:
+        command = ["docker", "cp", "-", f"{container_name}:{path}"]
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        assert process.stdin is not None
+        try:
+            while len(chunk := archive.read(ARCHIVE_CHUNK_SIZE)) > 0:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass  # docker cp failed, its error message is reported below
+        except BaseException:
+            process.kill()
+            process.communicate()
+            raise
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise Exception(
+                f"Error running {' '.join(command)}:\nexit code: {process.returncode}\n\nstdout: {stdout.decode(errors='replace')}\n\nstderr: {stderr.decode(errors='replace')}"
+            )
+
+    def get_archive(self, container_name: str, path: str) -> Iterator[bytes]:
+        return start_eagerly(self._get_archive_chunks(container_name, path))
+
+    def _get_archive_chunks(self, container_name: str, path: str) -> Iterator[bytes]:
+        command = ["docker", "cp", f"{container_name}:{path}", "-"]
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        assert process.stdout is not None and process.stderr is not None
+        try:
+            # docker cp only writes the archive once it found the path, so an empty first
+            # read means that it failed.
+            chunk = process.stdout.read1(ARCHIVE_CHUNK_SIZE)
+            if len(chunk) == 0:
+                stderr = process.stderr.read()
+                process.wait()
+                raise Exception(
+                    f"Error running {' '.join(command)}:\nexit code: {process.returncode}\n\nstderr: {stderr.decode(errors='replace')}"
+                )
+            while len(chunk) > 0:
+                yield chunk
+                chunk = process.stdout.read1(ARCHIVE_CHUNK_SIZE)
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+    def stop_container(self, container_name: str) -> None:
+        self._run(["docker", "stop", container_name])
+
+    def remove_container(self, container_name: str, force: bool = False) -> None:
+        self._run(["docker", "rm"] + (["-f"] if force else []) + [container_name])
+
+    def list_containers(self, name_prefix: str) -> list[str]:
+        output = self._run(
+            [
+                "docker",
+                "ps",
+                "--all",
+                "--filter",
+                f"name=^{name_prefix}",
+                "--format",
+                "{{.Names}}",
+            ]
+        )
+        return [
+            name for name in output.splitlines() if name.startswith(name_prefix)
+        ]
+
+    def remove_containers(self, container_names: list[str]) -> None:
+        # One docker process for all of them. docker rm keeps going after a failure.
+        if len(container_names) > 0:
+            self._run(["docker", "rm", "-f"] + container_names)
+
+    def _run(self, command: list[str]) -> str:
+        output = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace",
+        )
+        if output.returncode != 0:
+            raise Exception(
+                f"Error running {' '.join(command)}:\nexit code: {output.returncode}\n\nstdout: {output.stdout}\n\nstderr: {output.stderr}"
+            )
+        return output.stdout
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: int | float | None = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+@beartype
+@dataclass
+class SocketDockerBackend(DockerBackend):
+    """
+    Talks to the Docker Engine API directly over its unix socket, reusing keep-alive
+    connections from a pool instead of starting a docker CLI process per operation.
+    """
+
+    socket_path: str = DEFAULT_DOCKER_SOCKET_PATH
+    api_version: str = "v1.41"
+    max_idle_connections: int = 64
+    request_timeout_seconds: int | float = 600
+    _idle_connections: Any = field(default_factory=lambda: LifoQueue())
+
+    def image_exists(self, image: str) -> bool:
+        status, _ = self._request("GET", f"/images/{url_quote(image, safe='')}/json")
+        return status == 200
+
+    def build_image(self, image: str, context_path: Path) -> None:
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode="w") as tar:
+            tar.add(str(context_path), arcname=".")
+
+        status, body = self._request(
+            "POST",
+            f"/build?t={url_quote(image, safe='')}",
+            body=context.getvalue(),
+            headers={"Content-Type": "application/x-tar"},
+        )
+        self._raise_for_status(status, body, f"building image {image}")
+
+        # The build endpoint answers 200 and reports build errors in its json stream.
+        for line in body.decode(errors="replace").splitlines():
+            if line.strip() == "":
+                continue
+            message = json.loads(line)
+            if "error" in message:
+                raise Exception(f"Error building image {image}: {message['error']}")
+
+    def image_size(self, image: str) -> int:
+        status, body = self._request("GET", f"/images/{url_quote(image, safe='')}/json")
+        self._raise_for_status(status, body, f"inspecting image {image}")
+        return json.loads(body)["Size"]
+
+    def remove_image(self, image: str) -> None:
+        status, body = self._request("DELETE", f"/images/{url_quote(image, safe='')}")
+        self._raise_for_status(status, body, f"removing image {image}")
+
+    def list_images(self, repository: str) -> list[str]:
+        filters = json.dumps({"reference": [repository]})
+        status, body = self._request(
+            "GET", f"/images/json?filters={url_quote(filters, safe='')}"
+        )
+        self._raise_for_status(status, body, "listing images")
+        return [
+            tag
+            for image in json.loads(body)
+            for tag in image.get("RepoTags") or []
+            if tag.startswith(repository + ":")
+        ]
+
+    def commit_container(self, container_name: str, image: str) -> None:
+        repository, _, tag = image.rpartition(":")
+        status, body = self._request(
+            "POST",
+            f"/commit?container={url_quote(container_name, safe='')}&repo={url_quote(repository, safe='')}&tag={url_quote(tag, safe='')}",
+        )
+        self._raise_for_status(status, body, f"committing container {container_name}")
+
+    def create_container(
+        self, container_name: str, image: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        status, body = self._request(
+            "POST",
+            f"/containers/create?name={url_quote(container_name, safe='')}",
+            json_body={
+                "Image": image,
+                "Cmd": ["/bin/bash", "-c", "sleep infinity"],
+                "Tty": True,
+                "HostConfig": {
+                    "Memory": int(memory_gb * 1024**3),
+                    "NanoCpus": int(cpus * 10**9),
+                },
+            },
+        )
+        self._raise_for_status(status, body, f"creating container {container_name}")
+
+    def start_container(self, container_name: str) -> None:
+        status, body = self._request(
+            "POST", f"/containers/{url_quote(container_name, safe='')}/start"
+        )
+        self._raise_for_status(status, body, f"starting container {container_name}")
+
+    def rename_container(self, container_name: str, new_container_name: str) -> None:
+        status, body = self._request(
+            "POST",
+            f"/containers/{url_quote(container_name, safe='')}/rename?name={url_quote(new_container_name, safe='')}",
+        )
+        self._raise_for_status(status, body, f"renaming container {container_name}")
+
+    def exec_streaming(
+        self,
+        container_name: str,
+        command: list[str],
+        timeout_seconds: int | float | None = None,
+    ) -> Iterator[ExecChunk]:
+        deadline = None if timeout_seconds is None else perf_counter() + timeout_seconds
+
+        status, body = self._request(
+            "POST",
+            f"/containers/{url_quote(container_name, safe='')}/exec",
+            json_body={"AttachStdout": True, "AttachStderr": True, "Cmd": command},
+        )
+        self._raise_for_status(status, body, f"creating exec in {container_name}")
+        exec_id = json.loads(body)["Id"]
+
+        yield from self._start_exec_and_stream_output(exec_id, deadline=deadline)
+
+        status, body = self._request("GET", f"/exec/{exec_id}/json")
+        self._raise_for_status(status, body, f"inspecting exec in {container_name}")
+        yield "returncode", json.loads(body)["ExitCode"]
+
+    def put_archive(self, container_name: str, path: str, archive: Any) -> None:
+        # With a file-like body and no Content-Length, http.client sends the archive with
+        # chunked transfer encoding as it reads it, so it is never held in memory.
+        status, body = self._request(
+            "PUT",
+            f"/containers/{url_quote(container_name, safe='')}/archive?path={url_quote(path, safe='')}",
+            body=archive,
+            headers={"Content-Type": "application/x-tar"},
+        )
+        self._raise_for_status(
+            status, body, f"copying an archive to {path} in {container_name}"
+        )
+
+    def get_archive(self, container_name: str, path: str) -> Iterator[bytes]:
+        return start_eagerly(self._get_archive_chunks(container_name, path))
+
+    def _get_archive_chunks(self, container_name: str, path: str) -> Iterator[bytes]:
+        # Like for exec output, the response is streamed on its own connection, which is
+        # not returned to the pool.
+        connection = self._new_connection()
+        try:
+            connection.request(
+                "GET",
+                f"/{self.api_version}/containers/{url_quote(container_name, safe='')}/archive?path={url_quote(path, safe='')}",
+            )
+            response = connection.getresponse()
+            if response.status != 200:
+                self._raise_for_status(
+                    response.status,
+                    response.read(),
+                    f"copying {path} from {container_name}",
+                )
+            while len(chunk := response.read1(ARCHIVE_CHUNK_SIZE)) > 0:
+                yield chunk
+        finally:
+            connection.close()
+
+    def stop_container(self, container_name: str) -> None:
+        status, body = self._request(
+            "POST", f"/containers/{url_quote(container_name, safe='')}/stop"
+        )
+        # 304 means that the container was already stopped.
+        if status != 304:
+            self._raise_for_status(status, body, f"stopping container {container_name}")
+
+    def remove_container(self, container_name: str, force: bool = False) -> None:
+        status, body = self._request(
+            "DELETE",
+            f"/containers/{url_quote(container_name, safe='')}?force={str(force).lower()}",
+        )
+        self._raise_for_status(status, body, f"removing container {container_name}")
+
+    def list_containers(self, name_prefix: str) -> list[str]:
+        filters = json.dumps({"name": [f"^/?{name_prefix}"]})
+        status, body = self._request(
+            "GET", f"/containers/json?all=true&filters={url_quote(filters, safe='')}"
+        )
+        self._raise_for_status(status, body, "listing containers")
+        # Container names come with a leading /.
+        names = [
+            name.lstrip("/") for container in json.loads(body) for name in container["Names"]
+        ]
+        return [name for name in names if name.startswith(name_prefix)]
+
+    def _start_exec_and_stream_output(
+        self, exec_id: str, deadline: float | None
+    ) -> Iterator[ExecChunk]:
+        # The engine hijacks the connection for the raw output stream and closes it
+        # afterwards, so this connection is never returned to the pool.
+        connection = UnixHTTPConnection(
+            self.socket_path, timeout=self._remaining(deadline)
+        )
+        try:
+            connection.request(
+                "POST",
+                f"/{self.api_version}/exec/{exec_id}/start",
+                body=json.dumps({"Detach": False, "Tty": False}),
+                headers={"Content-Type": "application/json"},
+            )
+            # http.client detaches the socket from the connection once it sees that the
+            # response lasts until the connection closes, so keep a reference to it.
+            sock = connection.sock
+            assert sock is not None
+            response = connection.getresponse()
+            if response.status != 200:
+                self._raise_for_status(
+                    response.status, response.read(), f"starting exec {exec_id}"
+                )
+
+            stream_names = {1: "stdout", 2: "stderr"}
+            while True:
+                header = self._read_exactly(sock, response, 8, deadline)
+                if len(header) < 8:
+                    break
+                stream, size = struct.unpack(">BxxxL", header)
+                payload = self._read_exactly(sock, response, size, deadline)
+                if stream in stream_names and len(payload) > 0:
+                    yield stream_names[stream], payload
+                if len(payload) < size:
+                    break
+        except socket.timeout as e:
+            raise TimeoutError(f"Exec {exec_id} timed out.") from e
+        finally:
+            connection.close()
+
+    def _read_exactly(
+        self,
+        sock: socket.socket,
+        response: http.client.HTTPResponse,
+        size: int,
+        deadline: float | None,
+    ) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            sock.settimeout(self._remaining(deadline))
+            chunk = response.read1(size - len(data))
+            if len(chunk) == 0:
+                break
+            data.extend(chunk)
+        return bytes(data)
+
+    def _remaining(self, deadline: float | None) -> int | float:
+        if deadline is None:
+            return self.request_timeout_seconds
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            raise TimeoutError("Docker API call timed out.")
+        return remaining
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        body: Any = None,
+        json_body: Any = None,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, bytes]:
+        headers = dict(headers) if headers is not None else {}
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+
+        # A file-like body can't be sent again after a failed attempt, so it gets a fresh
+        # connection, which isn't retried.
+        if hasattr(body, "read"):
+            connection, reused = self._new_connection(), False
+        else:
+            connection, reused = self._get_connection()
+        sent = False
+        response = None
+        try:
+            connection.request(
+                method, f"/{self.api_version}{path}", body=body, headers=headers
+            )
+            sent = True
+            response = connection.getresponse()
+            response_body = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            # The engine may have closed the idle keep-alive connection in the meantime,
+            # so retry once on a fresh connection, but only if the request can't have
+            # reached it: it couldn't be sent, or the connection was closed or reset
+            # before any byte of a response. Anything else, like a timeout, may come after
+            # the engine acted on a request that isn't safe to repeat, like creating a
+            # container.
+            stale_connection = (
+                reused
+                and not isinstance(e, TimeoutError)
+                and (not sent or (response is None and isinstance(e, ConnectionError)))
+            )
+            if not stale_connection:
+                raise
+            connection = self._new_connection()
+            try:
+                connection.request(
+                    method, f"/{self.api_version}{path}", body=body, headers=headers
+                )
+                response = connection.getresponse()
+                response_body = response.read()
+            except Exception:
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(connection)
+
+        return response.status, response_body
+
+    def _get_connection(self) -> tuple[UnixHTTPConnection, bool]:
+        while True:
+            try:
+                connection = self._idle_connections.get_nowait()
+            except Empty:
+                return self._new_connection(), False
+            # An idle connection that is readable was closed by the engine.
+            if connection.sock is not None and not is_readable(connection.sock):
+                return connection, True
+            connection.close()
+
+    def _new_connection(self) -> UnixHTTPConnection:
+        return UnixHTTPConnection(self.socket_path, timeout=self.request_timeout_seconds)
+
+    def _release_connection(self, connection: UnixHTTPConnection) -> None:
+        if self._idle_connections.qsize() >= self.max_idle_connections:
+            connection.close()
+            return
+        try:
+            self._idle_connections.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def _raise_for_status(self, status: int, body: bytes, action: str) -> None:
+        if 200 <= status < 300:
+            return
+        try:
+            message = json.loads(body).get("message", body.decode(errors="replace"))
+        except Exception:
+            message = body.decode(errors="replace")
+        raise Exception(f"Docker API error while {action}: status {status}: {message}")
+
+
+@beartype
+def is_readable(sock: socket.socket) -> bool:
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        return len(selector.select(timeout=0)) > 0
+
+
+@beartype
+def start_eagerly(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    Runs the generator `chunks` up to its first chunk right away, so that it raises now
+    if it fails before producing anything, and returns an iterator over all its chunks.
+    """
+
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return iter([])
+    return itertools.chain([first_chunk], chunks)
+
+
+@beartype
+def make_docker_backend(
+    kind: str = "auto", socket_path: str = DEFAULT_DOCKER_SOCKET_PATH
+) -> DockerBackend:
+    """
+    `kind` is "cli", "socket", or "auto", which uses the socket if it exists and
+    DOCKER_HOST doesn't point the docker CLI somewhere else, and the CLI otherwise.
+    """
+
+    if kind == "auto":
+        use_socket = "DOCKER_HOST" not in os.environ and os.path.exists(socket_path)
+        kind = "socket" if use_socket else "cli"
+
+    if kind == "cli":
+        return CliDockerBackend()
+    if kind == "socket":
+        return SocketDockerBackend(socket_path=socket_path)
+    raise ValueError(
+        f'Invalid docker backend "{kind}". Must be one of "auto", "cli", "socket".'
+    )
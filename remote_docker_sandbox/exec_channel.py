@@ -0,0 +1,181 @@
+import subprocess
+import selectors
+import base64
+import re
+import os
+from uuid import uuid4
+from time import perf_counter
+from threading import Lock
+from dataclasses import dataclass, field
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.capped_output import CappedOutput, translate_newlines
+
+
+@beartype
+@dataclass
+class _FramedStream:
+    """
+    One of the shell's output streams, read until the sentinel that ends the current
+    command. Only the last `lookbehind` bytes are kept uncapped, since the sentinel must
+    be searched across chunk boundaries.
+    """
+
+    pattern: re.Pattern
+    output: CappedOutput
+    lookbehind: int
+    match: re.Match | None = None
+    _pending: bytearray = field(default_factory=lambda: bytearray())
+
+    def feed(self, chunk: bytes) -> None:
+        self._pending.extend(chunk)
+        match = self.pattern.search(self._pending)
+        if match is not None:
+            self.output.append(bytes(self._pending[: match.start()]))
+            self._pending.clear()
+            self.match = match
+            return
+
+        if len(self._pending) > self.lookbehind:
+            self.output.append(bytes(self._pending[: -self.lookbehind]))
+            del self._pending[: -self.lookbehind]
+
+    def text(self) -> str:
+        self.output.append(bytes(self._pending))
+        self._pending.clear()
+        # Like the output of a one-off exec, see `DockerBackend.postprocess_output`.
+        return translate_newlines(self.output.text())
+
+
+@beartype
+@dataclass
+class PersistentShell:
+    """
+    A long-lived `docker exec -i <container> /bin/bash` whose stdin receives one framed
+    command at a time.
+
+    Every command still runs in its own `/bin/bash -c` inside the container, so it sees
+    exactly the same environment as with a fresh `docker exec`, but the docker CLI
+    start and API round trip are only paid once per container. After the command, the
+    shell prints a sentinel with its exit code to stdout and a sentinel to stderr, which
+    delimit the command's output on both streams.
+    """
+
+    container_name: str
+    _process: subprocess.Popen | None = None
+    _lock: Any = field(default_factory=lambda: Lock())
+
+    def run(
+        self,
+        command: str,
+        timeout_seconds: int | float,
+        max_output_bytes: int | None = None,
+    ) -> dict | None:
+        """
+        Returns the same dict as `DockerSandboxServer.run_command`, or None if the shell is
+        busy running another command, in which case the caller should fall back to a
+        one-off `docker exec`.
+        """
+
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._run(command, timeout_seconds, max_output_bytes)
+        finally:
+            self._lock.release()
+
+    def close(self) -> None:
+        with self._lock:
+            self._kill()
+
+    def _run(
+        self,
+        command: str,
+        timeout_seconds: int | float,
+        max_output_bytes: int | None,
+    ) -> dict:
+        if self._process is None or self._process.poll() is not None:
+            self._open()
+        assert self._process is not None
+        assert self._process.stdin is not None
+
+        sentinel = f"__remote_docker_sandbox_{uuid4().hex}__"
+        encoded_command = base64.b64encode(command.encode()).decode()
+        framed_command = (
+            f'/bin/bash -c "$(printf %s {encoded_command} | base64 -d)" < /dev/null; '
+            f"printf '\\n{sentinel} %d\\n' $?; "
+            f"printf '\\n{sentinel}\\n' >&2\n"
+        )
+
+        try:
+            self._process.stdin.write(framed_command.encode())
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self._kill()
+            return {
+                "returncode": 1,
+                "stdout": "",
+                "stderr": "The persistent shell in the container exited unexpectedly.",
+            }
+
+        lookbehind = len(sentinel) + 64
+        stdout = _FramedStream(
+            pattern=re.compile(rb"\n" + sentinel.encode() + rb" (\d+)\n"),
+            output=CappedOutput(max_bytes=max_output_bytes),
+            lookbehind=lookbehind,
+        )
+        stderr = _FramedStream(
+            pattern=re.compile(rb"\n" + sentinel.encode() + rb"\n"),
+            output=CappedOutput(max_bytes=max_output_bytes),
+            lookbehind=lookbehind,
+        )
+
+        deadline = perf_counter() + timeout_seconds
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._process.stdout, selectors.EVENT_READ, stdout)  # type: ignore
+            selector.register(self._process.stderr, selectors.EVENT_READ, stderr)  # type: ignore
+
+            while stdout.match is None or stderr.match is None:
+                remaining_time = deadline - perf_counter()
+                if remaining_time <= 0:
+                    self._kill()
+                    return {"returncode": 1, "stdout": "", "stderr": "timed out"}
+
+                for key, _ in selector.select(timeout=remaining_time):
+                    chunk = os.read(key.fileobj.fileno(), 65536)  # type: ignore
+                    if len(chunk) == 0:
+                        self._kill()
+                        return {
+                            "returncode": 1,
+                            "stdout": stdout.text(),
+                            "stderr": stderr.text()
+                            + "\nThe persistent shell in the container exited unexpectedly.",
+                        }
+                    key.data.feed(chunk)
+
+        assert stdout.match is not None
+        return {
+            "returncode": int(stdout.match.group(1)),
+            "stdout": stdout.text(),
+            "stderr": stderr.text(),
+        }
+
+    def _open(self) -> None:
+        self._kill()
+        self._process = subprocess.Popen(
+            ["docker", "exec", "-i", self.container_name, "/bin/bash"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def _kill(self) -> None:
+        if self._process is None:
+            return
+        self._process.kill()
+        self._process.wait()
+        for stream in [self._process.stdin, self._process.stdout, self._process.stderr]:
+            if stream is not None:
+                stream.close()
+        self._process = None
@@ -0,0 +1,183 @@
+import io
+import random
+import tarfile
+from pathlib import Path
+from threading import Lock
+from time import sleep
+from dataclasses import dataclass, field
+from collections.abc import Iterator
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.docker_backend import (
+    DockerBackend,
+    ExecChunk,
+    ARCHIVE_CHUNK_SIZE,
+)
+
+
+@beartype
+@dataclass
+class FakeDockerBackend(DockerBackend):
+    """
+    A stand-in for docker that keeps its containers and images in memory and only sleeps
+    for the configured latencies instead of doing anything, for benchmarking the servers
+    without the cost and the noise of real containers.
+
+    Every command succeeds after `exec_latency_seconds` and writes `exec_output_bytes`
+    bytes to stdout. Latencies are multiplied by a random factor between 1 - `jitter` and
+    1 + `jitter`, from a generator seeded with `seed` so that runs are reproducible.
+    """
+
+    create_latency_seconds: int | float = 0
+    start_latency_seconds: int | float = 0
+    exec_latency_seconds: int | float = 0
+    exec_output_bytes: int = 3
+    stop_latency_seconds: int | float = 0
+    remove_latency_seconds: int | float = 0
+    build_latency_seconds: int | float = 0
+    commit_latency_seconds: int | float = 0
+    jitter: int | float = 0
+    seed: int = 0
+    containers: dict[str, str] = field(
+        default_factory=lambda: {}
+    )  # container name -> "created" or "running"
+    images: dict[str, int] = field(default_factory=lambda: {})  # image -> size in bytes
+    _random: Any = None
+    _lock: Any = field(default_factory=lambda: Lock())
+
+    def __post_init__(self) -> None:
+        self._random = random.Random(self.seed)
+
+    def image_exists(self, image: str) -> bool:
+        with self._lock:
+            return image in self.images
+
+    def build_image(self, image: str, context_path: Path) -> None:
+        self._sleep(self.build_latency_seconds)
+        with self._lock:
+            self.images[image] = 0
+
+    def image_size(self, image: str) -> int:
+        with self._lock:
+            if image not in self.images:
+                raise Exception(f"No such image: {image}")
+            return self.images[image]
+
+    def remove_image(self, image: str) -> None:
+        with self._lock:
+            if self.images.pop(image, None) is None:
+                raise Exception(f"No such image: {image}")
+
+    def list_images(self, repository: str) -> list[str]:
+        with self._lock:
+            return [image for image in self.images if image.startswith(repository + ":")]
+
+    def commit_container(self, container_name: str, image: str) -> None:
+        self._sleep(self.commit_latency_seconds)
+        with self._lock:
+            self._check_exists(container_name)
+            self.images[image] = 0
+
+    def create_container(
+        self, container_name: str, image: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        self._sleep(self.create_latency_seconds)
+        with self._lock:
+            if image not in self.images:
+                raise Exception(f"No such image: {image}")
+            if container_name in self.containers:
+                raise Exception(
+                    f'Conflict. The container name "{container_name}" is already in use.'
+                )
+            self.containers[container_name] = "created"
+
+    def start_container(self, container_name: str) -> None:
+        self._sleep(self.start_latency_seconds)
+        with self._lock:
+            self._check_exists(container_name)
+            self.containers[container_name] = "running"
+
+    def rename_container(self, container_name: str, new_container_name: str) -> None:
+        with self._lock:
+            self._check_exists(container_name)
+            if new_container_name in self.containers:
+                raise Exception(
+                    f'Conflict. The container name "{new_container_name}" is already in use.'
+                )
+            self.containers[new_container_name] = self.containers.pop(container_name)
+
+    def exec_streaming(
+        self,
+        container_name: str,
+        command: list[str],
+        timeout_seconds: int | float | None = None,
+    ) -> Iterator[ExecChunk]:
+        with self._lock:
+            self._check_running(container_name)
+        latency = self._jittered(self.exec_latency_seconds)
+        if timeout_seconds is not None and latency > timeout_seconds:
+            sleep(timeout_seconds)
+            raise TimeoutError(
+                f"Command {command} in {container_name} timed out after {timeout_seconds} seconds."
+            )
+        sleep(latency)
+        if self.exec_output_bytes > 0:
+            yield "stdout", b"x" * (self.exec_output_bytes - 1) + b"\n"
+        yield "returncode", 0
+
+    def put_archive(self, container_name: str, path: str, archive: Any) -> None:
+        with self._lock:
+            self._check_running(container_name)
+        while len(archive.read(ARCHIVE_CHUNK_SIZE)) > 0:
+            pass
+
+    def get_archive(self, container_name: str, path: str) -> Iterator[bytes]:
+        with self._lock:
+            self._check_running(container_name)
+        # An empty file named after the path, like docker cp of a file.
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar:
+            tar.addfile(tarfile.TarInfo(Path(path).name or "root"), io.BytesIO())
+        return iter([archive.getvalue()])
+
+    def stop_container(self, container_name: str) -> None:
+        self._sleep(self.stop_latency_seconds)
+        with self._lock:
+            self._check_exists(container_name)
+            self.containers[container_name] = "created"
+
+    def remove_container(self, container_name: str, force: bool = False) -> None:
+        self._sleep(self.remove_latency_seconds)
+        with self._lock:
+            self._check_exists(container_name)
+            if self.containers[container_name] == "running" and not force:
+                raise Exception(
+                    f"You cannot remove a running container {container_name}. Stop the container before attempting removal or force remove."
+                )
+            del self.containers[container_name]
+
+    def list_containers(self, name_prefix: str) -> list[str]:
+        with self._lock:
+            return [name for name in self.containers if name.startswith(name_prefix)]
+
+    def _check_exists(self, container_name: str) -> None:
+        if container_name not in self.containers:
+            raise Exception(f"No such container: {container_name}")
+
+    def _check_running(self, container_name: str) -> None:
+        self._check_exists(container_name)
+        if self.containers[container_name] != "running":
+            raise Exception(f"Container {container_name} is not running")
+
+    def _jittered(self, seconds: int | float) -> float:
+        if seconds <= 0 or self.jitter <= 0:
+            return max(float(seconds), 0.0)
+        with self._lock:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(seconds * factor, 0.0)
+
+    def _sleep(self, seconds: int | float) -> None:
+        seconds = self._jittered(seconds)
+        if seconds > 0:
+            sleep(seconds)
@@ -0,0 +1,767 @@
+import hashlib
+import json
+import traceback
+from bisect import bisect_right
+from queue import Queue
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from collections.abc import Callable, Iterator
+from typing import Any
+import requests
+from urllib3.exceptions import NewConnectionError
+from beartype import beartype
+
+from remote_docker_sandbox.rest_server_base import JsonRESTServer, ServerBusy
+from remote_docker_sandbox.rest_client_base import (
+    get_session,
+    busy_response,
+    decoded_response_body,
+)
+from remote_docker_sandbox.circuit_breaker import ServerHealth
+from remote_docker_sandbox.tracing import (
+    current_request_id,
+    new_request_id,
+    request_headers,
+    tracer,
+    with_current_request_id,
+)
+from remote_docker_sandbox.client import start_error, busy_retry_after_seconds
+
+
+@beartype
+def is_connect_error(error: Exception) -> bool:
+    """
+    Whether a request failed while connecting, so the server never received it.
+    """
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or len(error.args) == 0:
+        return False
+    return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+
+
+@beartype
+@dataclass
+class HashRing:
+    """
+    Consistent hashing of container names over servers. Every server is put at `replicas`
+    points of the ring, so that adding or removing a server only moves about 1 / (number
+    of servers) of the names.
+    """
+
+    replicas: int = 64
+    _points: list[tuple[int, str]] = field(default_factory=lambda: [])
+
+    def add(self, server_url: str) -> None:
+        if server_url in self.server_urls():
+            return
+        self._points += [
+            (self._hash(f"{server_url}#{i}"), server_url) for i in range(self.replicas)
+        ]
+        self._points.sort()
+
+    def remove(self, server_url: str) -> None:
+        self._points = [point for point in self._points if point[1] != server_url]
+
+    def server_urls(self) -> list[str]:
+        return sorted({server_url for _, server_url in self._points})
+
+    def preference_list(self, key: str) -> list[str]:
+        """
+        All the servers, in the order in which they are tried for `key`: the one that owns
+        the key first, then the next ones clockwise.
+        """
+
+        if len(self._points) == 0:
+            return []
+        start = bisect_right(self._points, (self._hash(key), ""))
+        result: list[str] = []
+        for i in range(len(self._points)):
+            server_url = self._points[(start + i) % len(self._points)][1]
+            if server_url not in result:
+                result.append(server_url)
+        return result
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+@beartype
+@dataclass
+class SandboxGateway(JsonRESTServer):
+    """
+    One endpoint in front of many `DockerSandboxServer`s, so that clients only need the
+    gateway's url and backends can be added or drained without restarting them.
+
+    A new sandbox is placed on the first backend of its container name's preference list
+    (see `HashRing`) that isn't draining, failing (see `ServerHealth`) or busy, and every
+    later call for that container name is forwarded to the same backend, as recorded in
+    the placement table. The table is only kept in memory: when the gateway starts, and
+    then every `placement_rebuild_interval_seconds`, it is rebuilt from the
+    list_containers of every backend that answers within
+    `placement_rebuild_timeout_seconds`, which also drops the containers the backends
+    removed themselves, e.g. idle ones. So does a backend answering that a placed
+    container doesn't exist. Names missing from the table are routed to the backend that
+    owns them on the ring.
+
+    A start is only tried on the next backend right away if the previous one was busy or
+    couldn't be connected to. After any other failure, e.g. a timeout, the previous
+    backend may have created the container, so it is stopped there first.
+
+    Backends come from `backend_urls` and, if set, `backends_file`, one url per line,
+    which is re-read every `backends_file_check_seconds`: new urls join, missing ones are
+    drained. They can also be managed at runtime with the add_backend, drain_backend and
+    remove_backend functions.
+    """
+
+    backend_urls: list[str] = field(default_factory=lambda: [])
+    backends_file: str | None = None
+    backends_file_check_seconds: int | float = 10
+    max_start_attempts: int = 3
+    upstream_timeout_seconds: int | float = 600
+    abandoned_start_stop_timeout_seconds: int | float = 30
+    placement_rebuild_timeout_seconds: int | float = 10
+    placement_rebuild_interval_seconds: int | float | None = 60
+    ring: HashRing = field(default_factory=lambda: HashRing())
+    placements: dict[str, str] = field(default_factory=lambda: {})  # container name -> backend url
+    draining: set[str] = field(default_factory=lambda: set())
+    health: ServerHealth = field(default_factory=lambda: ServerHealth())
+    _placements_lock: Any = field(default_factory=lambda: Lock())
+    _stopped: Any = field(default_factory=lambda: Event())
+
+    def __post_init__(self) -> None:
+        for backend_url in self.backend_urls:
+            self.ring.add(backend_url)
+
+    def start_background_tasks(self) -> None:
+        if self.backends_file is not None:
+            self._read_backends_file()
+            Thread(target=self._watch_backends_file, daemon=True).start()
+        self.rebuild_placements()
+        if self.placement_rebuild_interval_seconds is not None:
+            Thread(target=self._rebuild_placements_periodically, daemon=True).start()
+
+    def stop_background_tasks(self) -> None:
+        self._stopped.set()
+
+    def get_response(self, function: str, **kwargs) -> Any:  # type: ignore
+        if function in self.name_to_function:
+            return self.name_to_function[function](**kwargs)
+        # Anything else about a container is handled by its backend.
+        if "container_name" in kwargs:
+            backend_url = self._backend_of(kwargs["container_name"])
+            try:
+                result = self._call_backend(
+                    backend_url, {"function": function, **kwargs}
+                )
+            except Exception as e:
+                self._forget_if_missing(kwargs["container_name"], backend_url, str(e))
+                raise
+            self._forget_if_missing_in_result(kwargs["container_name"], backend_url, result)
+            return result
+        raise KeyError(
+            f'Invalid function "{function}". Must be one of {", ".join(self.name_to_function.keys())}, or a function of the backends with a container_name argument.'
+        )
+
+    def get_streaming_response(self, function: str, **kwargs) -> Iterator[Any]:  # type: ignore
+        if function == "run_batch":
+            return self.run_batch_streaming(**kwargs)
+        if "container_name" not in kwargs:
+            raise KeyError(
+                f'Invalid streaming function "{function}". Must be run_batch or a function of the backends with a container_name argument.'
+            )
+        return self._stream_for_container(
+            kwargs["container_name"], {"function": function, **kwargs}
+        )
+
+    def get_upload_response(self, function: str, stream: Any, **kwargs) -> Any:  # type: ignore
+        backend_url = self._backend_of(kwargs["container_name"])
+        response = self._request(
+            backend_url,
+            "upload",
+            params={"function": function, **kwargs},
+            data=stream,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        try:
+            result = self._result(backend_url, response)
+        except Exception as e:
+            self._forget_if_missing(kwargs["container_name"], backend_url, str(e))
+            raise
+        self._forget_if_missing_in_result(kwargs["container_name"], backend_url, result)
+        return result
+
+    def get_download_response(self, function: str, **kwargs) -> Iterator[bytes]:  # type: ignore
+        backend_url = self._backend_of(kwargs["container_name"])
+        response = self._request(
+            backend_url,
+            "download",
+            json={"function": function, **kwargs},
+            stream=True,
+        )
+        if response.status_code != 200:
+            with response:
+                self._forget_if_missing(kwargs["container_name"], backend_url, response.text)
+                raise Exception(
+                    f"Error from backend {backend_url}.\nStatus code: {response.status_code}.\nResponse: {response.text}"
+                )
+        return self._download_chunks(response)
+
+    @property
+    def name_to_function(self) -> dict[str, Callable]:
+        return {
+            "add_one": self.add_one,
+            "start_container": self.start_container,
+            "stop_container": self.stop_container,
+            "run_batch": self.run_batch,
+            "get_load": self.get_load,
+            "get_backends": self.get_backends,
+            "add_backend": self.add_backend,
+            "drain_backend": self.drain_backend,
+            "remove_backend": self.remove_backend,
+        }
+
+    def add_one(self, x: int) -> str:
+        return str(x + 1)
+
+    def start_container(self, container_name: str, **kwargs) -> Any:
+        busy: list[ServerBusy] = []
+        errors: list[str] = []
+        for backend_url in self._placement_candidates(container_name)[
+            : self.max_start_attempts
+        ]:
+            try:
+                result = self._call_backend(
+                    backend_url,
+                    {
+                        "function": "start_container",
+                        "container_name": container_name,
+                        **kwargs,
+                    },
+                )
+            except ServerBusy as e:
+                busy.append(e)
+                continue
+            except Exception as e:
+                errors.append(f"{backend_url}: {e}")
+                if not is_connect_error(e):
+                    self._stop_abandoned_start(backend_url, container_name)
+                continue
+
+            error = start_error(result)
+            if error is not None:
+                self.health.record_failure(backend_url, error)
+                errors.append(f"{backend_url}: {error}")
+                self._stop_abandoned_start(backend_url, container_name)
+                continue
+
+            with self._placements_lock:
+                self.placements[container_name] = backend_url
+            return result
+
+        if len(errors) == 0 and len(busy) > 0:
+            raise ServerBusy(
+                f"All the backends tried are busy: {' '.join(str(e) for e in busy)}",
+                retry_after_seconds=min(e.retry_after_seconds for e in busy),
+            )
+        if len(errors) == 0:
+            raise Exception("No backend is available to start sandboxes.")
+        raise Exception(
+            f"Error starting container {container_name} on every backend tried:\n"
+            + "\n".join(errors)
+        )
+
+    def _stop_abandoned_start(self, backend_url: str, container_name: str) -> None:
+        """
+        Best effort stop of a container whose start failed on the backend in a way that
+        may have created it, before it is started elsewhere.
+        """
+
+        try:
+            self._call_backend(
+                backend_url,
+                {"function": "stop_container", "container_name": container_name},
+                timeout=self.abandoned_start_stop_timeout_seconds,
+            )
+        except Exception as e:
+            print(
+                f"Error stopping container {container_name} on backend {backend_url} after its start failed: {e}"
+            )
+
+    def stop_container(self, container_name: str) -> Any:
+        try:
+            return self._call_backend(
+                self._backend_of(container_name),
+                {"function": "stop_container", "container_name": container_name},
+            )
+        finally:
+            with self._placements_lock:
+                self.placements.pop(container_name, None)
+
+    def run_batch(self, items: list[dict]) -> list[dict]:
+        """
+        Sends the items of every backend to it in one run_batch call, all backends at the
+        same time, and returns the results in the order of `items`.
+        """
+
+        results: list[dict | None] = [None for _ in items]
+        backend_to_indices = self._group_by_backend(items)
+
+        def run_on_backend(backend_url: str) -> None:
+            indices = backend_to_indices[backend_url]
+            try:
+                response = self._call_backend(
+                    backend_url,
+                    {"function": "run_batch", "items": [items[i] for i in indices]},
+                )
+            except Exception as e:
+                response = [{"error": f"Error from backend {backend_url}: {e}"}] * len(
+                    indices
+                )
+            if not (isinstance(response, list) and len(response) == len(indices)):
+                response = [
+                    {"error": f"Invalid run_batch response from backend {backend_url}: {response}"}
+                ] * len(indices)
+            for i, result in zip(indices, response):
+                self._forget_if_missing_in_result(items[i]["container_name"], backend_url, result)
+                results[i] = result
+
+        with ThreadPoolExecutor(max_workers=max(len(backend_to_indices), 1)) as executor:
+            list(
+                executor.map(
+                    with_current_request_id(run_on_backend), backend_to_indices.keys()
+                )
+            )
+        return results  # type: ignore
+
+    def run_batch_streaming(self, items: list[dict]) -> Iterator[dict]:
+        """
+        Like `run_batch`, but yields {"index": ..., "result": ...} for every item as soon as
+        its backend streams it.
+        """
+
+        backend_to_indices = self._group_by_backend(items)
+        queue: Queue = Queue()
+
+        def stream_from_backend(backend_url: str) -> None:
+            indices = backend_to_indices[backend_url]
+            remaining = set(range(len(indices)))
+            try:
+                for item in self._stream_from_backend(
+                    backend_url,
+                    {"function": "run_batch", "items": [items[i] for i in indices]},
+                ):
+                    if isinstance(item, dict) and item.get("index") in remaining:
+                        remaining.remove(item["index"])
+                        self._forget_if_missing_in_result(
+                            items[indices[item["index"]]]["container_name"],
+                            backend_url,
+                            item.get("result"),
+                        )
+                        queue.put(
+                            {"index": indices[item["index"]], "result": item.get("result")}
+                        )
+                error = f"Backend {backend_url} didn't return all the results."
+            except Exception as e:
+                error = f"Error from backend {backend_url}: {e}"
+            for i in sorted(remaining):
+                queue.put({"index": indices[i], "result": {"error": error}})
+            queue.put(None)
+
+        for backend_url in backend_to_indices.keys():
+            Thread(
+                target=with_current_request_id(stream_from_backend),
+                args=(backend_url,),
+                daemon=True,
+            ).start()
+
+        finished_backends = 0
+        while finished_backends < len(backend_to_indices):
+            item = queue.get()
+            if item is None:
+                finished_backends += 1
+            else:
+                yield item
+
+    def get_load(self) -> dict:
+        """
+        The sum of the loads of the backends that answered, in the format of
+        `DockerSandboxServer.get_load`, so that clients can balance between gateways.
+        """
+
+        backend_urls = self.ring.server_urls()
+
+        def get_backend_load(backend_url: str) -> dict | None:
+            try:
+                load = self._call_backend(backend_url, {"function": "get_load"})
+            except Exception:
+                return None
+            return load if isinstance(load, dict) else None
+
+        with ThreadPoolExecutor(max_workers=max(len(backend_urls), 1)) as executor:
+            loads = [
+                load
+                for load in executor.map(get_backend_load, backend_urls)
+                if load is not None
+            ]
+        keys = [
+            "live_containers",
+            "pending_starts",
+            "reserved_memory_gb",
+            "reserved_cpus",
+            "total_memory_gb",
+            "available_memory_gb",
+            "cpu_count",
+            "load_average_1m",
+        ]
+        return {key: sum(load.get(key, 0) for load in loads) for key in keys}
+
+    def get_backends(self) -> dict:
+        with self._placements_lock:
+            containers: dict[str, int] = {}
+            for backend_url in self.placements.values():
+                containers[backend_url] = containers.get(backend_url, 0) + 1
+            ring_backend_urls = self.ring.server_urls()
+            draining = set(self.draining)
+        backend_urls = sorted(set(ring_backend_urls) | set(containers.keys()))
+        health = self.health.states(backend_urls)
+        return {
+            backend_url: {
+                "state": (
+                    "removed"
+                    if backend_url not in ring_backend_urls
+                    else "draining"
+                    if backend_url in draining
+                    else "active"
+                ),
+                "containers": containers.get(backend_url, 0),
+                "health": health[backend_url],
+            }
+            for backend_url in backend_urls
+        }
+
+    def rebuild_placements(self) -> None:
+        """
+        Adds the containers that the backends say they have to the placement table, e.g.
+        after a restart of the gateway, and drops the ones they don't have anymore.
+        Backends that don't answer are skipped.
+        """
+
+        with self._placements_lock:
+            backend_urls = sorted(
+                set(self.ring.server_urls()) | set(self.placements.values())
+            )
+            # Containers placed while the backends are listed may be missing from the
+            # lists, so only the ones placed before are dropped.
+            placements_before = dict(self.placements)
+
+        def list_containers(backend_url: str) -> list[str] | None:
+            try:
+                container_names = self._call_backend(
+                    backend_url,
+                    {"function": "list_containers"},
+                    timeout=self.placement_rebuild_timeout_seconds,
+                )
+            except Exception as e:
+                print(f"Error listing the containers of backend {backend_url}: {e}")
+                return None
+            # Anything else, e.g. an error from a backend without list_containers, isn't
+            # a reason to drop its placements.
+            if not (
+                isinstance(container_names, list)
+                and all(isinstance(name, str) for name in container_names)
+            ):
+                return None
+            return container_names
+
+        with ThreadPoolExecutor(max_workers=max(len(backend_urls), 1)) as executor:
+            backend_containers = list(executor.map(list_containers, backend_urls))
+
+        with self._placements_lock:
+            for backend_url, container_names in zip(backend_urls, backend_containers):
+                if container_names is None:
+                    continue
+                for container_name in container_names:
+                    self.placements.setdefault(container_name, backend_url)
+                listed = set(container_names)
+                for container_name, placed_backend_url in placements_before.items():
+                    if (
+                        placed_backend_url == backend_url
+                        and container_name not in listed
+                        and self.placements.get(container_name) == backend_url
+                    ):
+                        del self.placements[container_name]
+
+    def add_backend(self, server_url: str) -> None:
+        with self._placements_lock:
+            self.draining.discard(server_url)
+            self.ring.add(server_url)
+
+    def drain_backend(self, server_url: str) -> None:
+        """
+        Stops placing new sandboxes on the backend. The sandboxes already on it keep working.
+        """
+
+        with self._placements_lock:
+            if server_url in self.ring.server_urls():
+                self.draining.add(server_url)
+
+    def remove_backend(self, server_url: str) -> None:
+        """
+        Removes the backend from the ring. The sandboxes already on it are still forwarded
+        to it until they are stopped.
+        """
+
+        with self._placements_lock:
+            self.ring.remove(server_url)
+            self.draining.discard(server_url)
+
+    def extra_metrics(self) -> dict[str, int | float]:
+        with self._placements_lock:
+            placements = len(self.placements)
+            backends = len(self.ring.server_urls())
+            draining_backends = len(self.draining)
+        return {
+            "placements": placements,
+            "backends": backends,
+            "draining_backends": draining_backends,
+            "failing_backends": sum(
+                1
+                for backend_url in self.ring.server_urls()
+                if not self.health.is_available(backend_url)
+            ),
+        }
+
+    def _placement_candidates(self, container_name: str) -> list[str]:
+        with self._placements_lock:
+            preference_list = [
+                backend_url
+                for backend_url in self.ring.preference_list(container_name)
+                if backend_url not in self.draining
+            ]
+        healthy = [
+            backend_url
+            for backend_url in preference_list
+            if self.health.is_available(backend_url)
+        ]
+        # If all the backends are failing, try them anyway rather than fail right away.
+        return healthy or preference_list
+
+    def _backend_of(self, container_name: str) -> str:
+        with self._placements_lock:
+            backend_url = self.placements.get(container_name)
+            if backend_url is not None:
+                return backend_url
+            preference_list = self.ring.preference_list(container_name)
+        if len(preference_list) == 0:
+            raise Exception("The gateway has no backends.")
+        return preference_list[0]
+
+    def _forget_if_missing(
+        self, container_name: str, backend_url: str, error: str
+    ) -> None:
+        """
+        Drops the placement of a container that its backend says doesn't exist, e.g.
+        because the backend stopped it when it was idle.
+        """
+
+        if f"No such container: {container_name}" not in error:
+            return
+        with self._placements_lock:
+            if self.placements.get(container_name) == backend_url:
+                del self.placements[container_name]
+
+    def _forget_if_missing_in_result(
+        self, container_name: str, backend_url: str, result: Any
+    ) -> None:
+        # How the backends report an exception raised by the function.
+        if isinstance(result, list) and len(result) == 2:
+            result = result[0]
+        if isinstance(result, dict) and isinstance(result.get("error"), str):
+            self._forget_if_missing(container_name, backend_url, result["error"])
+
+    def _stream_for_container(self, container_name: str, arguments: dict) -> Iterator[Any]:
+        backend_url = self._backend_of(container_name)
+        try:
+            for item in self._stream_from_backend(backend_url, arguments):
+                self._forget_if_missing_in_result(container_name, backend_url, item)
+                yield item
+        except Exception as e:
+            self._forget_if_missing(container_name, backend_url, str(e))
+            raise
+
+    def _group_by_backend(self, items: list[dict]) -> dict[str, list[int]]:
+        backend_to_indices: dict[str, list[int]] = {}
+        for i, item in enumerate(items):
+            backend_to_indices.setdefault(
+                self._backend_of(item["container_name"]), []
+            ).append(i)
+        return backend_to_indices
+
+    def _request(self, backend_url: str, path: str, **kwargs) -> requests.Response:
+        """
+        A POST to the backend over its pooled keep-alive connections, whose outcome
+        counts for the backend's health. Forwards the request id of the call being handled.
+        """
+
+        kwargs["headers"] = {
+            **kwargs.get("headers", {}),
+            **request_headers(current_request_id.get() or new_request_id()),
+        }
+        kwargs.setdefault("timeout", self.upstream_timeout_seconds)
+        try:
+            with tracer.span("gateway.upstream", backend_url=backend_url, path=path):
+                response = get_session(backend_url).post(
+                    f"{backend_url}/{path}", **kwargs
+                )
+        except Exception as e:
+            self.health.record_failure(backend_url, f"{e}")
+            raise
+        if response.status_code >= 500 and response.status_code != 503:
+            self.health.record_failure(
+                backend_url, f"Status code {response.status_code}."
+            )
+        elif response.status_code < 500:
+            self.health.record_success(backend_url)
+        return response
+
+    def _call_backend(self, backend_url: str, arguments: dict, **kwargs) -> Any:
+        return self._result(
+            backend_url, self._request(backend_url, "process", json=arguments, **kwargs)
+        )
+
+    def _result(self, backend_url: str, response: requests.Response) -> Any:
+        result = decoded_response_body(response)
+        busy = busy_response(response.status_code, result)
+        if busy is not None:
+            retry_after_seconds = busy_retry_after_seconds(busy)
+            assert retry_after_seconds is not None
+            raise ServerBusy(
+                f"Backend {backend_url}: {busy['error']}",
+                retry_after_seconds=retry_after_seconds,
+            )
+        if response.status_code != 200:
+            raise Exception(
+                f"Error from backend {backend_url}.\nStatus code: {response.status_code}.\nResponse: {result}"
+            )
+        return result
+
+    def _stream_from_backend(self, backend_url: str, arguments: dict) -> Iterator[Any]:
+        response = self._request(
+            backend_url, "process_stream", json=arguments, stream=True
+        )
+        with response:
+            if response.status_code != 200:
+                raise Exception(
+                    f"Error from backend {backend_url}.\nStatus code: {response.status_code}.\nResponse: {response.text}"
+                )
+            for line in response.iter_lines():
+                if len(line) > 0:
+                    yield json.loads(line)
+
+    def _download_chunks(self, response: requests.Response) -> Iterator[bytes]:
+        with response:
+            yield from response.iter_content(chunk_size=65536)
+
+    def _read_backends_file(self) -> None:
+        assert self.backends_file is not None
+        try:
+            with open(self.backends_file) as f:
+                backend_urls = {
+                    line.strip()
+                    for line in f
+                    if line.strip() != "" and not line.strip().startswith("#")
+                }
+        except OSError as e:
+            print(f"Error reading the backends file {self.backends_file}: {e}")
+            return
+
+        for backend_url in backend_urls:
+            if backend_url not in self.ring.server_urls() or backend_url in self.draining:
+                print(f"Adding backend {backend_url}.")
+                self.add_backend(backend_url)
+        for backend_url in self.ring.server_urls():
+            if backend_url not in backend_urls and backend_url not in self.draining:
+                print(f"Draining backend {backend_url}.")
+                self.drain_backend(backend_url)
+
+    def _rebuild_placements_periodically(self) -> None:
+        assert self.placement_rebuild_interval_seconds is not None
+        while not self._stopped.wait(timeout=self.placement_rebuild_interval_seconds):
+            try:
+                self.rebuild_placements()
+            except Exception as e:
+                print(f"Error rebuilding the placements: {e}\n{traceback.format_exc()}")
+
+    def _watch_backends_file(self) -> None:
+        while not self._stopped.wait(timeout=self.backends_file_check_seconds):
+            try:
+                self._read_backends_file()
+            except Exception as e:
+                print(f"Error updating the backends: {e}\n{traceback.format_exc()}")
+
+
+@beartype
+def main() -> None:
+    parser = ArgumentParser(
+        description="Run a gateway that forwards the calls of remote docker sandbox clients to many sandbox servers. Point the clients at http://your_ip:port."
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--threads", type=int, default=256)
+    parser.add_argument("--connection-limit", type=int, default=2048)
+    parser.add_argument(
+        "--backend-url",
+        type=str,
+        action="append",
+        default=[],
+        help="The url of a sandbox server. Can be repeated.",
+    )
+    parser.add_argument(
+        "--backends-file",
+        type=str,
+        default=None,
+        help="A file with one sandbox server url per line, re-read every --backends-file-check-seconds. Servers added to it join, servers removed from it are drained: no new sandboxes are placed on them.",
+    )
+    parser.add_argument("--backends-file-check-seconds", type=float, default=10)
+    parser.add_argument(
+        "--max-start-attempts",
+        type=int,
+        default=3,
+        help="On how many backends starting a sandbox is tried before giving up, when backends are busy or fail.",
+    )
+    parser.add_argument(
+        "--placement-rebuild-interval-seconds",
+        type=float,
+        default=60,
+        help="How often the gateway asks the backends which containers they have, to forget the sandboxes they removed themselves, e.g. idle ones. 0 only does it at startup.",
+    )
+    arguments = parser.parse_args()
+
+    if len(arguments.backend_url) == 0 and arguments.backends_file is None:
+        parser.error("Give at least one --backend-url or a --backends-file.")
+
+    gateway = SandboxGateway(
+        host=arguments.host,
+        port=arguments.port,
+        threads=arguments.threads,
+        connection_limit=arguments.connection_limit,
+        backend_urls=arguments.backend_url,
+        backends_file=arguments.backends_file,
+        backends_file_check_seconds=arguments.backends_file_check_seconds,
+        max_start_attempts=arguments.max_start_attempts,
+        placement_rebuild_interval_seconds=(
+            arguments.placement_rebuild_interval_seconds
+            if arguments.placement_rebuild_interval_seconds > 0
+            else None
+        ),
+    )
+    gateway.serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import hashlib
+from uuid import uuid4
+from time import monotonic
+from collections import OrderedDict
+from threading import Lock, Condition
+from dataclasses import dataclass, field
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.docker_backend import DockerBackend
+
+
+@beartype
+@dataclass
+class CachedImage:
+    image: str
+    size_bytes: int  # what the image adds on top of its base image
+
+
+@beartype
+@dataclass
+class InitImageCache:
+    """
+    Images of containers saved right after their `init_command` succeeded, keyed by
+    (base image, init command), so that later containers with the same key start from the
+    image instead of running the init command again.
+
+    The least recently used images are removed once the images take more than
+    `max_bytes` on disk. `max_bytes=0` disables the cache.
+
+    For every key, only one container runs the init command and saves its image at a time:
+    `acquire` makes the other callers with the same key wait for it, for at most
+    `max_populate_wait_seconds`, after which they run the init command themselves.
+
+    The images are only known to the process that saved them. The ones left over by a
+    previous run are removed with `remove_leftover_images`.
+    """
+
+    docker: DockerBackend
+    max_bytes: int = 0
+    image_name: str = "bash-sandbox-init"
+    retry_after_failure_seconds: int | float = 60
+    max_populate_wait_seconds: int | float = 300
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    failed_commits: int = 0
+    populate_wait_timeouts: int = 0
+    _images: OrderedDict[str, CachedImage] = field(
+        default_factory=lambda: OrderedDict()
+    )
+    _populating: set[str] = field(default_factory=lambda: set())
+    _failed_at: dict[str, float] = field(default_factory=lambda: {})
+    # Images that were evicted but couldn't be removed yet, because containers use them.
+    _images_to_remove: list[str] = field(default_factory=lambda: [])
+    _lock: Any = field(default_factory=lambda: Lock())
+    _populated: Any = None
+
+    def __post_init__(self) -> None:
+        self._populated = Condition(self._lock)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(cached.size_bytes for cached in self._images.values())
+
+    @staticmethod
+    def key(base_image: str, init_command: str) -> str:
+        return hashlib.sha256(
+            base_image.encode() + b"\0" + init_command.encode()
+        ).hexdigest()
+
+    def acquire(self, key: str) -> tuple[str | None, bool]:
+        """
+        Returns (image, should_populate). If image isn't None, the container can be started
+        from it. Otherwise, the caller has to run the init command itself, and, if
+        should_populate is True, call `add` or `abandon` afterwards.
+        """
+
+        with self._lock:
+            if not self._populated.wait_for(
+                lambda: key not in self._populating,
+                timeout=self.max_populate_wait_seconds,
+            ):
+                # E.g. the init command hangs. Running it uncached is still better than
+                # waiting for it.
+                self.populate_wait_timeouts += 1
+                self.misses += 1
+                return None, False
+
+            cached = self._images.get(key)
+            if cached is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return cached.image, False
+
+            self.misses += 1
+            # After a failure, let the callers run the init command concurrently for a
+            # while instead of one at a time.
+            failed_at = self._failed_at.get(key)
+            if (
+                failed_at is not None
+                and monotonic() - failed_at < self.retry_after_failure_seconds
+            ):
+                return None, False
+            self._populating.add(key)
+            return None, True
+
+    def add(self, key: str, container_name: str, base_image: str) -> None:
+        """
+        Saves the container, which was started from `base_image` and just ran the init
+        command with key `key`, as an image.
+        """
+
+        with self._lock:
+            self._failed_at.pop(key, None)
+
+        # A fresh tag every time, so that an evicted image of the same key that is still
+        # to be removed is never confused with this one.
+        image = f"{self.image_name}:{key[:16]}-{uuid4().hex[:8]}"
+        try:
+            self.docker.commit_container(container_name, image)
+            size_bytes = max(
+                self.docker.image_size(image) - self.docker.image_size(base_image), 0
+            )
+        except Exception as e:
+            print(f"Error saving the image of container {container_name}: {e}")
+            with self._lock:
+                self.failed_commits += 1
+            self.abandon(key, failed=True)
+            return
+
+        with self._lock:
+            self._images[key] = CachedImage(image=image, size_bytes=size_bytes)
+            self._populating.discard(key)
+            self._populated.notify_all()
+            to_remove = self._evict()
+        self._remove_images(to_remove)
+
+    def abandon(self, key: str, failed: bool = False) -> None:
+        with self._lock:
+            self._populating.discard(key)
+            if failed:
+                self._failed_at[key] = monotonic()
+            self._populated.notify_all()
+
+    def remove_leftover_images(self) -> None:
+        """
+        Removes the images of this cache that are not in it, i.e. that a previous run of
+        the server saved. Those that containers still use are removed later, like evicted
+        images. Must be called before any image is added.
+        """
+
+        try:
+            images = self.docker.list_images(self.image_name)
+        except Exception as e:
+            print(f"Error listing the init images left over by a previous run: {e}")
+            return
+        with self._lock:
+            cached_images = {cached.image for cached in self._images.values()}
+        leftover_images = [image for image in images if image not in cached_images]
+        if len(leftover_images) > 0:
+            print(
+                f"Removing {len(leftover_images)} init images left over by a previous run."
+            )
+        self._remove_images(leftover_images)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "size_bytes": self.size_bytes,
+                "images": len(self._images),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "failed_commits": self.failed_commits,
+                "populate_wait_timeouts": self.populate_wait_timeouts,
+                "images_to_remove": len(self._images_to_remove),
+            }
+
+    def _evict(self) -> list[str]:
+        # Keep at least the image that was just added, even if it is bigger than the budget.
+        while self.size_bytes > self.max_bytes and len(self._images) > 1:
+            _, cached = self._images.popitem(last=False)
+            self._images_to_remove.append(cached.image)
+            self.evictions += 1
+        to_remove = self._images_to_remove
+        self._images_to_remove = []
+        return to_remove
+
+    def _remove_images(self, images: list[str]) -> None:
+        not_removed = []
+        for image in images:
+            try:
+                self.docker.remove_image(image)
+            except Exception:
+                not_removed.append(image)
+        with self._lock:
+            self._images_to_remove.extend(not_removed)
@@ -0,0 +1,297 @@
+from collections import deque
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from dataclasses import dataclass, field
+from typing import Any
+from beartype import beartype
+
+
+# In seconds, from a fast exec to a slow container start with a long init command.
+DEFAULT_LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+)
+
+
+@beartype
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS
+    # counts[i] is the number of observations <= buckets[i] and > buckets[i - 1], and
+    # the last count is for the observations above the last bucket.
+    counts: list[int] = field(default_factory=lambda: [])
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        if len(self.counts) == 0:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list[tuple[str, int]]:
+        result = []
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((format_float(bucket), total))
+        result.append(("+Inf", self.count))
+        return result
+
+
+@beartype
+@dataclass
+class FunctionMetrics:
+    requests: int = 0
+    errors: int = 0
+    in_flight: int = 0
+    latency: Histogram = field(default_factory=lambda: Histogram())
+
+
+@beartype
+@dataclass
+class RequestMetrics:
+    """
+    Request metrics in fixed memory: per (endpoint, function) counters, in flight gauges
+    and latency histograms, and the (start, end) times of the last `max_timings` calls
+    in a ring buffer.
+    """
+
+    max_timings: int = 100_000
+    # Function names come from the clients, so their number is capped too.
+    max_functions: int = 256
+    _functions: dict[tuple[str, str], FunctionMetrics] = field(
+        default_factory=lambda: {}
+    )
+    _timings: Any = None
+    _lock: Any = field(default_factory=lambda: Lock())
+
+    def __post_init__(self) -> None:
+        self._timings = deque(maxlen=self.max_timings)
+
+    def start(self, endpoint: str, function: str) -> float:
+        with self._lock:
+            self._function_metrics(endpoint, function).in_flight += 1
+        return perf_counter()
+
+    def finish(
+        self, endpoint: str, function: str, start_time: float, error: bool = False
+    ) -> None:
+        end_time = perf_counter()
+        with self._lock:
+            metrics = self._function_metrics(endpoint, function)
+            metrics.in_flight -= 1
+            metrics.requests += 1
+            if error:
+                metrics.errors += 1
+            metrics.latency.observe(end_time - start_time)
+            self._timings.append((start_time, end_time))
+
+    def timings(
+        self,
+        since: float | None = None,
+        limit: int | None = None,
+        before: float | None = None,
+    ) -> list[tuple[float, float]]:
+        """
+        The (start, end) times of the most recent calls that ended after `since` and before
+        `before`, at most `limit` of them, oldest first. Older calls are fetched page by
+        page by passing the end time of the oldest call returned as `before`.
+        """
+
+        result = []
+        with self._lock:
+            # Walk from the newest call, so that the cost is proportional to the number of
+            # calls returned and not to the size of the buffer.
+            for start_time, end_time in reversed(self._timings):
+                if since is not None and end_time <= since:
+                    break
+                if before is not None and end_time >= before:
+                    continue
+                if limit is not None and len(result) >= limit:
+                    break
+                result.append((start_time, end_time))
+        result.reverse()
+        return result
+
+    def timeline(
+        self, bins: int, start: float | None = None, end: float | None = None
+    ) -> dict[str, Any]:
+        """
+        The calls between `start` and `end` (by default, all the buffered calls up to now)
+        aggregated in `bins` bins of equal width: the average number of calls in flight,
+        the number of calls that ended, and the mean and max duration of those calls.
+        The result's size depends on `bins` only, however long the time range.
+        """
+
+        with self._lock:
+            timings = list(self._timings)
+        if end is None:
+            end = perf_counter()
+        if start is None:
+            start = min((start_time for start_time, _ in timings), default=end)
+        bin_seconds = max(end - start, 1e-9) / bins
+
+        # busy_seconds[i] is the total time spent in calls during bin i. Calls covering
+        # whole bins are added with a difference array, so that a long call costs as much
+        # as a short one.
+        busy_seconds = [0.0] * bins
+        whole_bins = [0] * (bins + 1)
+        calls = [0] * bins
+        duration_sums = [0.0] * bins
+        max_durations = [0.0] * bins
+
+        for start_time, end_time in timings:
+            if end_time < start or start_time > end:
+                continue
+            first = int((max(start_time, start) - start) / bin_seconds)
+            last = int((min(end_time, end) - start) / bin_seconds)
+            first = min(max(first, 0), bins - 1)
+            last = min(max(last, first), bins - 1)
+            if first == last:
+                busy_seconds[first] += min(end_time, end) - max(start_time, start)
+            else:
+                busy_seconds[first] += start + (first + 1) * bin_seconds - max(
+                    start_time, start
+                )
+                busy_seconds[last] += min(end_time, end) - (start + last * bin_seconds)
+                whole_bins[first + 1] += 1
+                whole_bins[last] -= 1
+            if end_time <= end:
+                duration = end_time - start_time
+                calls[last] += 1
+                duration_sums[last] += duration
+                max_durations[last] = max(max_durations[last], duration)
+
+        concurrency = []
+        covering = 0
+        for i in range(bins):
+            covering += whole_bins[i]
+            concurrency.append(covering + busy_seconds[i] / bin_seconds)
+
+        return {
+            "start": start,
+            "bin_seconds": bin_seconds,
+            "concurrency": concurrency,
+            "calls": calls,
+            "mean_duration": [
+                duration_sum / count if count > 0 else None
+                for duration_sum, count in zip(duration_sums, calls)
+            ],
+            "max_duration": [
+                max_duration if count > 0 else None
+                for max_duration, count in zip(max_durations, calls)
+            ],
+        }
+
+    def render_prometheus(
+        self, prefix: str, extra_gauges: dict[str, int | float] | None = None
+    ) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+
+        with self._lock:
+            functions = {
+                labels: FunctionMetrics(
+                    requests=metrics.requests,
+                    errors=metrics.errors,
+                    in_flight=metrics.in_flight,
+                    latency=Histogram(
+                        buckets=metrics.latency.buckets,
+                        counts=list(metrics.latency.counts),
+                        sum=metrics.latency.sum,
+                        count=metrics.latency.count,
+                    ),
+                )
+                for labels, metrics in self._functions.items()
+            }
+
+        lines = []
+
+        def add_family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        def labels_text(endpoint: str, function: str, **extra: str) -> str:
+            labels = {"endpoint": endpoint, "function": function, **extra}
+            return ",".join(
+                f'{key}="{escape_label_value(value)}"' for key, value in labels.items()
+            )
+
+        add_family("requests_total", "counter", "Requests handled.")
+        for (endpoint, function), metrics in functions.items():
+            lines.append(
+                f"{prefix}_requests_total{{{labels_text(endpoint, function)}}} {metrics.requests}"
+            )
+
+        add_family(
+            "request_errors_total", "counter", "Requests that raised an exception."
+        )
+        for (endpoint, function), metrics in functions.items():
+            lines.append(
+                f"{prefix}_request_errors_total{{{labels_text(endpoint, function)}}} {metrics.errors}"
+            )
+
+        add_family("requests_in_flight", "gauge", "Requests being handled.")
+        for (endpoint, function), metrics in functions.items():
+            lines.append(
+                f"{prefix}_requests_in_flight{{{labels_text(endpoint, function)}}} {metrics.in_flight}"
+            )
+
+        add_family(
+            "request_duration_seconds", "histogram", "Time to handle a request."
+        )
+        for (endpoint, function), metrics in functions.items():
+            for bucket, count in metrics.latency.cumulative_counts():
+                lines.append(
+                    f"{prefix}_request_duration_seconds_bucket{{{labels_text(endpoint, function, le=bucket)}}} {count}"
+                )
+            lines.append(
+                f"{prefix}_request_duration_seconds_sum{{{labels_text(endpoint, function)}}} {format_float(metrics.latency.sum)}"
+            )
+            lines.append(
+                f"{prefix}_request_duration_seconds_count{{{labels_text(endpoint, function)}}} {metrics.latency.count}"
+            )
+
+        for name, value in (extra_gauges or {}).items():
+            add_family(name, "gauge", name.replace("_", " ").capitalize() + ".")
+            lines.append(f"{prefix}_{name} {format_float(float(value))}")
+
+        return "\n".join(lines) + "\n"
+
+    def _function_metrics(self, endpoint: str, function: str) -> FunctionMetrics:
+        key = (endpoint, function)
+        if key not in self._functions and len(self._functions) >= self.max_functions:
+            key = (endpoint, "other")
+        if key not in self._functions:
+            self._functions[key] = FunctionMetrics()
+        return self._functions[key]
+
+
+@beartype
+def format_float(value: float) -> str:
+    return repr(float(value))
+
+
+@beartype
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,100 +1,264 @@
 import os
-import requests
+import heapq
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from beartype import beartype
-from typing import List, Optional
+from typing import Any, List, Optional
+
+from remote_docker_sandbox.rest_client_base import get_session
+
+
+# Define colors for different servers (will cycle if more servers than colors)
+COLORS = [
+    # Standard colors
+    'red', 'blue', 'green', 'yellow', 'purple', 'orange', 'pink', 'brown',
+    'black', 'gray', 'cyan', 'magenta', 'lime', 'teal', 'indigo', 'violet',
+
+    # Light variations
+    'lightblue', 'lightgreen', 'lightcoral', 'lightsalmon', 'lightseagreen',
+    'lightskyblue', 'lightsteelblue', 'lightpink', 'lightyellow', 'lightgray',
+
+    # Dark variations
+    'darkblue', 'darkgreen', 'darkcyan', 'darkred', 'darkmagenta', 'darkorange',
+    'darkviolet', 'darkslategray', 'darkkhaki', 'darkturquoise',
+
+    # Other named colors
+    'chocolate', 'firebrick', 'forestgreen', 'gold', 'goldenrod', 'hotpink',
+    'indianred', 'lavender', 'lawngreen', 'maroon', 'mediumaquamarine',
+    'mediumseagreen', 'mediumslateblue', 'navy', 'olive', 'olivedrab',
+    'orangered', 'orchid', 'plum', 'rosybrown', 'royalblue', 'salmon',
+    'seagreen', 'sienna', 'silver', 'skyblue', 'slateblue', 'springgreen',
+    'steelblue', 'tomato', 'turquoise', 'wheat', 'yellowgreen'
+]
+
+
+@beartype
+def server_urls_from_environment() -> List[str]:
+    env_urls = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_URL")
+    if not env_urls:
+        raise ValueError("No server URLs provided and REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable not set")
+    return [url.strip() for url in env_urls.split(",")]
+
 
 @beartype
-def plot_call_timestamps(server_urls: Optional[List[str]] = None, save_filename: Optional[str] = None) -> None:
+@dataclass
+class CallTimestampsFetcher:
     """
-    Fetch call timestamps from specified servers and plot them using Plotly.
-    
-    Args:
-        server_urls: List of server URLs to fetch timestamps from. If None, reads from REMOTE_DOCKER_SANDBOX_SERVER_URL env var.
-        save_filename: If provided, saves the figure to this file as HTML. Otherwise, shows the figure.
+    Keeps the calls fetched from every server, and only fetches the calls that ended since
+    the last fetch when `fetch` is called again. Servers are fetched in parallel.
     """
-    # Get server URLs from environment variable if not provided
-    if server_urls is None:
-        env_urls = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_URL")
-        if not env_urls:
-            raise ValueError("No server URLs provided and REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable not set")
-        server_urls = [url.strip() for url in env_urls.split(",")]
-    
-    # Define colors for different servers (will cycle if more servers than colors)
-    colors = [
-        # Standard colors
-        'red', 'blue', 'green', 'yellow', 'purple', 'orange', 'pink', 'brown',
-        'black', 'gray', 'cyan', 'magenta', 'lime', 'teal', 'indigo', 'violet',
-        
-        # Light variations
-        'lightblue', 'lightgreen', 'lightcoral', 'lightsalmon', 'lightseagreen',
-        'lightskyblue', 'lightsteelblue', 'lightpink', 'lightyellow', 'lightgray',
-        
-        # Dark variations
-        'darkblue', 'darkgreen', 'darkcyan', 'darkred', 'darkmagenta', 'darkorange',
-        'darkviolet', 'darkslategray', 'darkkhaki', 'darkturquoise',
-        
-        # Other named colors
-        'chocolate', 'firebrick', 'forestgreen', 'gold', 'goldenrod', 'hotpink',
-        'indianred', 'lavender', 'lawngreen', 'maroon', 'mediumaquamarine',
-        'mediumseagreen', 'mediumslateblue', 'navy', 'olive', 'olivedrab',
-        'orangered', 'orchid', 'plum', 'rosybrown', 'royalblue', 'salmon',
-        'seagreen', 'sienna', 'silver', 'skyblue', 'slateblue', 'springgreen',
-        'steelblue', 'tomato', 'turquoise', 'wheat', 'yellowgreen'
-    ]
-    
-    # Create subplots (one row for each server)
-    fig = make_subplots(rows=len(server_urls), shared_xaxes=True, 
-                        vertical_spacing=0.02,
-                        subplot_titles=[f"Server: {url}" for url in server_urls])
-    
-    # For each server, fetch and plot the data
-    for i, server_url in enumerate(server_urls):
-        color = colors[i % len(colors)]
-        row = i + 1
-        
+
+    server_urls: List[str]
+    page_size: int = 10_000
+    timeout_seconds: int | float = 30
+    calls: dict[str, list[tuple[float, float]]] = field(default_factory=lambda: {})
+    last_end: dict[str, float] = field(default_factory=lambda: {})
+
+    def fetch(self) -> dict[str, list[tuple[float, float]]]:
+        with ThreadPoolExecutor(max_workers=max(len(self.server_urls), 1)) as executor:
+            for server_url, new_calls in zip(
+                self.server_urls, executor.map(self._fetch_new_calls, self.server_urls)
+            ):
+                if new_calls is None:
+                    continue
+                self.calls.setdefault(server_url, []).extend(new_calls)
+                if len(new_calls) > 0:
+                    self.last_end[server_url] = max(end for _, end in new_calls)
+        return self.calls
+
+    def _fetch_new_calls(self, server_url: str) -> Optional[list[tuple[float, float]]]:
+        # The server returns the most recent calls first, so the calls since the last
+        # fetch are fetched from the newest page to the oldest one.
+        pages = []
+        before = None
         try:
-            # Fetch timestamps from server
-            response = requests.get(f"{server_url}/get_call_timestamps")
-            response.raise_for_status()  # Raise exception for 4xx/5xx responses
-            
-            timestamps = response.json()
-            
-            # Plot each timestamp as a line
-            for j, ts in enumerate(timestamps):
-                start = ts["start"]
-                end = ts["end"]
-                duration = end - start
-                
-                # Add line for this timestamp
-                fig.add_trace(
-                    go.Scatter(
-                        x=[start, end],
-                        y=[j, j],
-                        mode='lines',
-                        line=dict(color=color, width=2),
-                        name=f"{server_url} - Call {j}",
-                        showlegend=False
-                    ),
-                    row=row, col=1
+            while True:
+                params: dict[str, Any] = {"limit": self.page_size}
+                if server_url in self.last_end:
+                    params["since"] = self.last_end[server_url]
+                if before is not None:
+                    params["before"] = before
+                response = get_session(server_url).get(
+                    f"{server_url}/get_call_timestamps",
+                    params=params,
+                    timeout=self.timeout_seconds,
                 )
-        
+                response.raise_for_status()  # Raise exception for 4xx/5xx responses
+                page = [(ts["start"], ts["end"]) for ts in response.json()]
+                # Servers that don't know `before` return the same page again.
+                if len(page) == 0 or (before is not None and page[-1][1] >= before):
+                    break
+                pages.append(page)
+                before = page[0][1]
+        except Exception as e:
+            print(f"Error fetching data from {server_url}: {e}")
+            return None
+
+        return [call for page in reversed(pages) for call in page]
+
+
+@beartype
+def fetch_timelines(
+    server_urls: List[str], bins: int, timeout_seconds: int | float = 30
+) -> dict[str, dict]:
+    """
+    Fetches the calls of every server aggregated in `bins` time bins, in parallel.
+    """
+
+    def fetch_timeline(server_url: str) -> Optional[dict]:
+        try:
+            response = get_session(server_url).get(
+                f"{server_url}/get_call_timeline",
+                params={"bins": bins},
+                timeout=timeout_seconds,
+            )
+            response.raise_for_status()
+            return response.json()
         except Exception as e:
             print(f"Error fetching data from {server_url}: {e}")
-    
-    # Update layout
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(len(server_urls), 1)) as executor:
+        timelines = dict(zip(server_urls, executor.map(fetch_timeline, server_urls)))
+    return {url: timeline for url, timeline in timelines.items() if timeline is not None}
+
+
+@beartype
+def call_segments(
+    calls: list[tuple[float, float]],
+) -> tuple[list[float | None], list[int | None]]:
+    """
+    The x and y coordinates of one horizontal segment per call, separated by None so that
+    they can be drawn as a single trace. Every call is put on the lowest lane that is free
+    during the call, so the number of lanes in use is the number of calls in flight.
+    """
+
+    x: list[float | None] = []
+    y: list[int | None] = []
+    busy_lanes: list[tuple[float, int]] = []  # heap of (end, lane)
+    free_lanes: list[int] = []  # heap
+    lane_count = 0
+    for start, end in sorted(calls):
+        while len(busy_lanes) > 0 and busy_lanes[0][0] <= start:
+            heapq.heappush(free_lanes, heapq.heappop(busy_lanes)[1])
+        if len(free_lanes) > 0:
+            lane = heapq.heappop(free_lanes)
+        else:
+            lane = lane_count
+            lane_count += 1
+        heapq.heappush(busy_lanes, (end, lane))
+        x += [start, end, None]
+        y += [lane, lane, None]
+    return x, y
+
+
+@beartype
+def plot_calls(calls: dict[str, list[tuple[float, float]]], server_urls: List[str]) -> go.Figure:
+    # Create subplots (one row for each server)
+    fig = make_subplots(rows=len(server_urls), shared_xaxes=True,
+                        vertical_spacing=0.02,
+                        subplot_titles=[f"Server: {url}" for url in server_urls])
+
+    for i, server_url in enumerate(server_urls):
+        x, y = call_segments(calls.get(server_url, []))
+        # A single WebGL trace per server, however many calls it made.
+        fig.add_trace(
+            go.Scattergl(
+                x=x,
+                y=y,
+                mode='lines',
+                line=dict(color=COLORS[i % len(COLORS)], width=2),
+                connectgaps=False,
+                name=server_url,
+                showlegend=False
+            ),
+            row=i + 1, col=1
+        )
+        fig.update_yaxes(title_text="Calls in flight", row=i + 1, col=1)
+
     fig.update_layout(
         title="Call Timestamps by Server",
         xaxis_title="Time (seconds)",
         height=500 * len(server_urls),  # Adjust height based on number of servers
         margin=dict(l=50, r=20, t=50, b=50),
     )
-    
-    # For each subplot, hide y-axis labels as they're just indices
-    for i in range(1, len(server_urls) + 1):
-        fig.update_yaxes(showticklabels=False, row=i, col=1)
-    
+    return fig
+
+
+@beartype
+def plot_timelines(timelines: dict[str, dict], server_urls: List[str]) -> go.Figure:
+    fig = make_subplots(rows=3, shared_xaxes=True, vertical_spacing=0.05,
+                        subplot_titles=["Calls in flight (average)", "Calls per second", "Call duration (seconds, mean and max)"])
+
+    for i, server_url in enumerate(server_urls):
+        timeline = timelines.get(server_url)
+        if timeline is None:
+            continue
+        color = COLORS[i % len(COLORS)]
+        bin_seconds = timeline["bin_seconds"]
+        # The middle of every bin.
+        x = [timeline["start"] + (j + 0.5) * bin_seconds for j in range(len(timeline["calls"]))]
+
+        fig.add_trace(go.Scattergl(x=x, y=timeline["concurrency"], mode='lines', line=dict(color=color),
+                                   name=server_url, legendgroup=server_url), row=1, col=1)
+        fig.add_trace(go.Scattergl(x=x, y=[count / bin_seconds for count in timeline["calls"]], mode='lines',
+                                   line=dict(color=color), name=server_url, legendgroup=server_url, showlegend=False),
+                      row=2, col=1)
+        fig.add_trace(go.Scattergl(x=x, y=timeline["mean_duration"], mode='lines', line=dict(color=color),
+                                   name=f"{server_url} mean", legendgroup=server_url, showlegend=False),
+                      row=3, col=1)
+        fig.add_trace(go.Scattergl(x=x, y=timeline["max_duration"], mode='lines', line=dict(color=color, dash='dot'),
+                                   name=f"{server_url} max", legendgroup=server_url, showlegend=False),
+                      row=3, col=1)
+
+    fig.update_layout(
+        title="Calls by Server",
+        xaxis3_title="Time (seconds)",
+        height=1200,
+        margin=dict(l=50, r=20, t=50, b=50),
+    )
+    return fig
+
+
+@beartype
+def plot_call_timestamps(
+    server_urls: Optional[List[str]] = None,
+    save_filename: Optional[str] = None,
+    view: str = "auto",
+    bins: int = 1000,
+    max_calls: int = 100_000,
+    fetcher: Optional[CallTimestampsFetcher] = None,
+) -> None:
+    """
+    Fetch call timestamps from specified servers and plot them using Plotly.
+
+    Args:
+        server_urls: List of server URLs to fetch timestamps from. If None, reads from REMOTE_DOCKER_SANDBOX_SERVER_URL env var.
+        save_filename: If provided, saves the figure to this file as HTML. Otherwise, shows the figure.
+        view: "calls" draws every call, "binned" draws the number of calls in flight, calls per second and call durations aggregated by the servers in `bins` time bins. "auto" draws every call if there are at most `max_calls` of them in total, and the binned view otherwise.
+        fetcher: Reuse the fetcher of a previous call to only fetch the calls made since then.
+    """
+    if server_urls is None:
+        server_urls = fetcher.server_urls if fetcher is not None else server_urls_from_environment()
+
+    if view not in ["auto", "calls", "binned"]:
+        raise ValueError(f'Invalid view "{view}". Must be one of "auto", "calls", "binned".')
+
+    if view != "binned":
+        if fetcher is None:
+            fetcher = CallTimestampsFetcher(server_urls=server_urls)
+        calls = fetcher.fetch()
+        if view == "auto" and sum(len(server_calls) for server_calls in calls.values()) > max_calls:
+            view = "binned"
+
+    if view == "binned":
+        fig = plot_timelines(fetch_timelines(server_urls, bins=bins), server_urls)
+    else:
+        fig = plot_calls(calls, server_urls)
+
     # Either save or show the figure
     if save_filename:
         fig.write_html(save_filename)
@@ -105,7 +269,13 @@ def plot_call_timestamps(server_urls: Optional[List[str]] = None, save_filename:
 
 @beartype
 def main() -> None:
-    plot_call_timestamps()
+    parser = ArgumentParser(description="Plot the calls made to remote docker sandbox servers.")
+    parser.add_argument("--server-urls", type=str, nargs="+", default=None, help="Defaults to the comma separated REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable.")
+    parser.add_argument("--save", type=str, default=None, help="Save the figure to this HTML file instead of showing it.")
+    parser.add_argument("--view", type=str, choices=["auto", "calls", "binned"], default="auto")
+    parser.add_argument("--bins", type=int, default=1000)
+    args = parser.parse_args()
+    plot_call_timestamps(server_urls=args.server_urls, save_filename=args.save, view=args.view, bins=args.bins)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,135 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
 import traceback
 import json
 import os
+from threading import Lock
+from collections.abc import Iterator
 from typing import Any
 from beartype import beartype
 
+from remote_docker_sandbox.tracing import (
+    current_request_id,
+    new_request_id,
+    request_headers,
+    tracer,
+)
+from remote_docker_sandbox.wire_format import (
+    JSON_CONTENT_TYPE,
+    accept_headers,
+    encode_body,
+    loads,
+    remember_server_accept_encodings,
+    server_accept_encodings,
+)
+
+
+DEFAULT_CONNECTION_POOL_SIZE = int(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_CONNECTION_POOL_SIZE", "256")
+)
+
+# One keep-alive session per server url, shared by every client in the process.
+_sessions: dict[str, requests.Session] = {}
+_session_pool_sizes: dict[str, int] = {}
+_sessions_lock = Lock()
+
+
+@beartype
+def get_session(
+    server_url: str, pool_size: int = DEFAULT_CONNECTION_POOL_SIZE
+) -> requests.Session:
+    """
+    Returns the process-wide session for `server_url`, creating it with a connection pool
+    of `pool_size` keep-alive connections the first time the server is used.
+    """
+
+    with _sessions_lock:
+        session = _sessions.get(server_url)
+        if session is None:
+            session = requests.Session()
+            # pool_block=False: if more than pool_size calls are in flight at once, the
+            # extra connections are opened anyway and discarded afterwards.
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, pool_block=False
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[server_url] = session
+            _session_pool_sizes[server_url] = pool_size
+        return session
+
+
+@beartype
+def connection_pool_stats() -> dict[str, dict]:
+    """
+    For debugging: per server url, the pool size, the number of connections opened so
+    far, the number of requests sent, and the number of idle connections in the pool.
+    """
+
+    with _sessions_lock:
+        sessions = dict(_sessions)
+        pool_sizes = dict(_session_pool_sizes)
+
+    stats = {}
+    for server_url, session in sessions.items():
+        adapter = session.get_adapter(server_url)
+        assert isinstance(adapter, HTTPAdapter)
+        pools = [
+            adapter.poolmanager.pools[key] for key in adapter.poolmanager.pools.keys()
+        ]
+        stats[server_url] = {
+            "pool_size": pool_sizes[server_url],
+            "connections_opened": sum(pool.num_connections for pool in pools),
+            "requests": sum(pool.num_requests for pool in pools),
+            "idle_connections": sum(
+                sum(connection is not None for connection in list(pool.pool.queue))  # type: ignore
+                for pool in pools
+            ),
+        }
+    return stats
+
+
+@beartype
+def busy_response(status_code: int, response: Any) -> dict | None:
+    """
+    The {"error": ..., "busy": True, "retry_after_seconds": ...} json of a server that
+    can't take the call now but should later, see `ServerBusy`, and None for any other
+    response.
+    """
+
+    if (
+        status_code == 503
+        and isinstance(response, dict)
+        and response.get("busy") is True
+        and isinstance(response.get("retry_after_seconds"), int | float)
+    ):
+        return response
+    return None
+
+
+@beartype
+def decoded_response_body(response: requests.Response) -> Any:
+    """
+    The json or msgpack body of a /process response, which requests already
+    decompressed, or its text if it is neither.
+    """
+
+    try:
+        return loads(response.content, response.headers.get("Content-Type"))
+    except Exception:
+        return response.text
+
 
 @beartype
 class JsonRESTClient:
     server_url: str
 
     def __init__(
-        self, server_url: str | None = None, ignore_failed_server_calls: bool = True
+        self,
+        server_url: str | None = None,
+        ignore_failed_server_calls: bool = True,
+        connection_pool_size: int = DEFAULT_CONNECTION_POOL_SIZE,
     ) -> None:
         if server_url is None:
             server_url = os.environ.get("REMOTE_DOCKER_SANDBOX_SERVER_URL")
@@ -21,22 +139,211 @@ class JsonRESTClient:
                 "To initialize a JsonRESTClient, you must provide a server url, either with the server_url argument to the contructor or the REMOTE_DOCKER_SANDBOX_SERVER_URL environment variable."
             )
 
-        self.server_url = server_url
         self.ignore_failed_server_calls = ignore_failed_server_calls
+        self.connection_pool_size = connection_pool_size
+        self.use_server_url(server_url)
+
+    def use_server_url(self, server_url: str) -> None:
+        self.server_url = server_url
+        self.session = get_session(server_url, pool_size=self.connection_pool_size)
+
+    def record_call_outcome(
+        self, function: str, status_code: int | None, error: str | None = None
+    ) -> None:
+        """
+        Called after every call with the status code of the response, or with None and
+        the error if the server couldn't be reached or didn't answer. Does nothing, but
+        subclasses can use it to track the health of the servers.
+        """
 
     @property
     def endpoint(self):
         return f"{self.server_url}/process"
 
+    @property
+    def streaming_endpoint(self):
+        return f"{self.server_url}/process_stream"
+
+    @property
+    def upload_endpoint(self):
+        return f"{self.server_url}/upload"
+
+    @property
+    def download_endpoint(self):
+        return f"{self.server_url}/download"
+
     def call_server(self, **kwargs) -> Any:
+        # A call made while handling another one, e.g. by the gateway, keeps its request id.
+        request_id = current_request_id.get() or new_request_id()
+        token = current_request_id.set(request_id)
+        try:
+            return self._call_server(request_id, kwargs)
+        finally:
+            current_request_id.reset(token)
+
+    def _call_server(self, request_id: str, kwargs: dict) -> Any:
+        # Compressed if the server said it can read it, see wire_format.
+        with tracer.span("client.encode"):
+            body, headers = encode_body(
+                kwargs, JSON_CONTENT_TYPE, server_accept_encodings(self.server_url)
+            )
+        try:
+            with tracer.span(
+                "client.round_trip",
+                server_url=self.server_url,
+                function=str(kwargs.get("function", "")),
+            ):
+                response = self.session.post(
+                    self.endpoint,
+                    data=body,
+                    headers={
+                        **headers,
+                        **accept_headers(list(HTTPResponse.CONTENT_DECODERS)),
+                        **request_headers(request_id),
+                    },
+                    timeout=600, # we want this big enough to virtually never happen, but we want this because otherwise the training script can freeze forever
+                )
+        except Exception as e:
+            self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = (
+                f"Error communicating with server: {e} {traceback.format_exc()}"
+            )
+            print(error_message)
+            return {"error": error_message}
+        self.record_call_outcome(str(kwargs.get("function", "")), response.status_code)
+
+        remember_server_accept_encodings(
+            self.server_url, response.headers.get("Accept-Encoding")
+        )
+        with tracer.span("client.decode"):
+            result = decoded_response_body(response)
+
+        # Returned whatever ignore_failed_server_calls is, for the caller to retry later or
+        # on another server.
+        busy = busy_response(response.status_code, result)
+        if busy is not None:
+            return busy
+
+        if response.status_code != 200:
+            error_message = f"Error communicating with server.\nStatus code: {response.status_code}.\nResponse json: {result}"
+            if self.ignore_failed_server_calls:
+                print(error_message)
+                return {"error": error_message}
+            else:
+                raise requests.HTTPError(error_message)
+
+        return result
+
+
+    def call_server_streaming(self, **kwargs) -> Iterator[Any]:
+        """
+        Like `call_server`, but yields the items of a streamed (newline delimited json)
+        response as they arrive. Errors are yielded as {"error": ...} items.
+        """
+
+        try:
+            response = self.session.post(
+                self.streaming_endpoint,
+                json=kwargs,
+                headers={
+                    "Content-Type": "application/json",
+                    **request_headers(current_request_id.get() or new_request_id()),
+                },
+                timeout=600, # timeout between two received bytes, not for the whole stream
+                stream=True,
+            )
+        except Exception as e:
+            self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = (
+                f"Error communicating with server: {e} {traceback.format_exc()}"
+            )
+            print(error_message)
+            yield {"error": error_message}
+            return
+        self.record_call_outcome(str(kwargs.get("function", "")), response.status_code)
+
+        with response:
+            if response.status_code != 200:
+                error_message = f"Error communicating with server.\nStatus code: {response.status_code}.\nResponse: {response.text}"
+                if not self.ignore_failed_server_calls:
+                    raise requests.HTTPError(error_message)
+                print(error_message)
+                yield {"error": error_message}
+                return
+
+            try:
+                for line in response.iter_lines():
+                    if len(line) > 0:
+                        yield json.loads(line)
+            except Exception as e:
+                self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
+                if not self.ignore_failed_server_calls:
+                    raise e
+                error_message = f"Error while streaming from server: {e} {traceback.format_exc()}"
+                print(error_message)
+                yield {"error": error_message}
+
+    def call_server_upload(self, data: bytes | Iterator[bytes], **kwargs) -> Any:
+        """
+        Like `call_server`, but sends `data` as the raw request body, chunked if it is an
+        iterator of chunks, and `kwargs`, which must be strings, in the query string.
+        """
+
+        try:
+            response = self.session.post(
+                self.upload_endpoint,
+                params=kwargs,
+                data=data,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    **request_headers(current_request_id.get() or new_request_id()),
+                },
+                timeout=600,
+            )
+        except Exception as e:
+            self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
+            if not self.ignore_failed_server_calls:
+                raise e
+            error_message = (
+                f"Error communicating with server: {e} {traceback.format_exc()}"
+            )
+            print(error_message)
+            return {"error": error_message}
+        self.record_call_outcome(str(kwargs.get("function", "")), response.status_code)
+
+        if response.status_code != 200:
+            error_message = f"Error communicating with server.\nStatus code: {response.status_code}.\nResponse: {decoded_response_body(response)}"
+            if self.ignore_failed_server_calls:
+                print(error_message)
+                return {"error": error_message}
+            else:
+                raise requests.HTTPError(error_message)
+
+        return decoded_response_body(response)
+
+    def call_server_download(self, **kwargs) -> requests.Response | dict:
+        """
+        Like `call_server`, but returns the streamed response, whose raw body is read from
+        `response.raw`, or an {"error": ...} dict. The response must be closed.
+        """
+
         try:
-            response = requests.post(
-                self.endpoint,
+            response = self.session.post(
+                self.download_endpoint,
                 json=kwargs,
-                headers={"Content-Type": "application/json"},
-                timeout=600, # we want this big enough to virtually never happen, but we want this because otherwise the training script can freeze forever
+                headers={
+                    "Content-Type": "application/json",
+                    **request_headers(current_request_id.get() or new_request_id()),
+                },
+                timeout=600, # timeout between two received bytes, not for the whole download
+                stream=True,
             )
         except Exception as e:
+            self.record_call_outcome(str(kwargs.get("function", "")), None, f"{e}")
             if not self.ignore_failed_server_calls:
                 raise e
             error_message = (
@@ -44,16 +351,17 @@ class JsonRESTClient:
             )
             print(error_message)
             return {"error": error_message}
+        self.record_call_outcome(str(kwargs.get("function", "")), response.status_code)
 
         if response.status_code != 200:
-            error_message = f"Error communicating with server.\nStatus code: {response.status_code}.\nResponse json: {response.json()}"
+            with response:
+                error_message = f"Error communicating with server.\nStatus code: {response.status_code}.\nResponse: {response.text}"
             if self.ignore_failed_server_calls:
                 print(error_message)
                 return {"error": error_message}
             else:
                 raise requests.HTTPError(error_message)
 
-        response = response.json()
         return response
 
 
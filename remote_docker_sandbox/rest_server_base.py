@@ -1,12 +1,49 @@
-from threading import Lock
-from flask import Flask, request, jsonify
-from time import perf_counter
+from threading import Condition, Thread
+from flask import Flask, Response, request, jsonify, g
+from werkzeug.serving import is_running_from_reloader
+from waitress.server import create_server
+import _thread
+import signal
+import json
+import math
 import traceback
+from time import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field, asdict
+from collections.abc import Callable, Iterator, Iterable
 from typing import Any
 from beartype import beartype
 
+from remote_docker_sandbox.metrics import RequestMetrics
+from remote_docker_sandbox.tracing import (
+    REQUEST_ID_HEADER,
+    REQUEST_SENT_AT_HEADER,
+    SERVER_TRACING_ENABLED,
+    current_request_id,
+    new_request_id,
+    tracer,
+)
+from remote_docker_sandbox.wire_format import (
+    supported_content_types,
+    supported_encodings,
+    choose_content_type,
+    parse_header_list,
+    encode_body,
+    decode_body,
+)
+
+
+class ServerBusy(Exception):
+    """
+    Raised by a handler when the server can't take the request now but should be able to
+    later. It is answered with status 503, a Retry-After header and the json
+    {"error": ..., "busy": true, "retry_after_seconds": ...}.
+    """
+
+    def __init__(self, message: str, retry_after_seconds: int | float) -> None:
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
 
 @beartype
 @dataclass(frozen=True)
@@ -20,53 +57,459 @@ class Timestamp:
 class JsonRESTServer(ABC):
     host: str = "0.0.0.0" # Use host='0.0.0.0' to make the server accessible from other machines
     port: int = 8080
-    _call_timestamps: list[Timestamp] = field(default_factory=lambda: [])
-    _call_timestamps_lock: Any = field(default_factory=lambda: Lock())
+    engine: str = "threaded" # "threaded" for a multi-threaded production WSGI server, "debug" for flask's development server
+    threads: int = 256 # maximum number of requests handled concurrently by the threaded engine
+    connection_limit: int = 2048 # maximum number of open (including idle keep-alive) connections
+    listen_socket: Any = None # an already bound socket to serve on instead of host and port, see worker_processes
+    keep_alive_timeout_seconds: int = 300
+    shutdown_timeout_seconds: int | float = 60
+    _in_flight_requests: int = 0
+    _shutting_down: bool = False
+    _drained: bool = False
+    _in_flight_requests_condition: Any = field(default_factory=lambda: Condition())
+    metrics: RequestMetrics = field(default_factory=lambda: RequestMetrics())
+    metrics_prefix: str = "remote_docker_sandbox"
+    max_call_timestamps_per_response: int = 10_000
+    max_timeline_bins: int = 10_000
 
     def serve(self) -> None:
+        tracer.enabled = SERVER_TRACING_ENABLED
+        app = self.make_app()
+
+        if self.engine == "debug":
+            # With debug=True, werkzeug's reloader re-runs the program in a child process,
+            # and only that child actually serves requests.
+            if is_running_from_reloader():
+                self.start_background_tasks()
+            app.run(host=self.host, debug=True, port=self.port)
+        elif self.engine == "threaded":
+            self.start_background_tasks()
+            self._serve_threaded(app)
+        else:
+            raise ValueError(
+                f'Invalid engine "{self.engine}". Must be one of "threaded", "debug".'
+            )
+
+    def make_app(self) -> Flask:
         app = Flask(__name__)
 
+        @app.before_request
+        def start_trace():
+            # The request id the client sent, so that its spans and the server's match.
+            request_id = request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+            g.request_id_token = current_request_id.set(request_id)
+            # Waitress doesn't tell when it received the request, so queueing is measured
+            # from when the client sent it, which includes the network.
+            try:
+                sent_at = float(request.headers.get(REQUEST_SENT_AT_HEADER, ""))
+            except ValueError:
+                return
+            now = time()
+            if sent_at < now:
+                tracer.record("server.queue", sent_at, now, path=request.path)
+
+        @app.after_request
+        def add_request_id(response):
+            response.headers[REQUEST_ID_HEADER] = current_request_id.get() or ""
+            return response
+
+        @app.teardown_request
+        def end_trace(exception):
+            token = g.pop("request_id_token", None)
+            if token is not None:
+                current_request_id.reset(token)
+
         @app.route("/process", methods=["POST"])
         def process():
+            # The body is json or msgpack, optionally compressed, see wire_format.
+            if request.mimetype not in supported_content_types():
+                return jsonify(
+                    {
+                        "error": f"Request must be one of {', '.join(supported_content_types())}"
+                    }
+                ), 400
+
+            with self._in_flight_requests_condition:
+                if self._shutting_down:
+                    return jsonify({"error": "Server is shutting down."}), 503
+                self._in_flight_requests += 1
+
+            try:
+                try:
+                    with tracer.span("server.decode"):
+                        data = decode_body(
+                            request.get_data(),
+                            request.content_type,
+                            request.headers.get("Content-Encoding"),
+                        )
+                except Exception as e:
+                    return jsonify({"error": f"Invalid request body: {e}"}), 400
+                result, status_code = self._get_response_or_error(data)
+                with tracer.span("server.encode"):
+                    return encoded_response(result, status_code)
+            finally:
+                with self._in_flight_requests_condition:
+                    self._in_flight_requests -= 1
+                    self._in_flight_requests_condition.notify_all()
+
+        @app.route("/process_stream", methods=["POST"])
+        def process_stream():
+            if not request.is_json:
+                return jsonify({"error": "Request must be JSON"}), 400
+
+            # Parsed before the request is counted as in flight, so there's nothing to
+            # undo for a malformed body.
+            try:
+                data = request.get_json()
+            except Exception as e:
+                return jsonify({"error": f"Invalid request body: {e}"}), 400
+            with self._in_flight_requests_condition:
+                if self._shutting_down:
+                    return jsonify({"error": "Server is shutting down."}), 503
+                self._in_flight_requests += 1
+
+            function = function_name(data)
+            start_time = self.metrics.start("process_stream", function)
+            outcome = {"error": True}
+            return self._finish_on_close(
+                Response(
+                    self._stream_response_or_error(data, outcome),
+                    mimetype="application/x-ndjson",
+                ),
+                "process_stream",
+                function,
+                start_time,
+                outcome,
+            )
+
+        @app.route("/upload", methods=["POST"])
+        def upload():
+            # The arguments are in the query string, the body is passed on unparsed.
+            with self._in_flight_requests_condition:
+                if self._shutting_down:
+                    return jsonify({"error": "Server is shutting down."}), 503
+                self._in_flight_requests += 1
+
+            try:
+                result, status_code = self._get_response_or_error(
+                    {**request.args.to_dict(), "stream": request.stream},
+                    get_response=self.get_upload_response,
+                    endpoint="upload",
+                )
+                return encoded_response(result, status_code)
+            finally:
+                with self._in_flight_requests_condition:
+                    self._in_flight_requests -= 1
+                    self._in_flight_requests_condition.notify_all()
+
+        @app.route("/download", methods=["POST"])
+        def download():
             if not request.is_json:
                 return jsonify({"error": "Request must be JSON"}), 400
 
-            data = request.get_json()
-            result, status_code = self._get_response_or_error(data)
+            with self._in_flight_requests_condition:
+                if self._shutting_down:
+                    return jsonify({"error": "Server is shutting down."}), 503
+                self._in_flight_requests += 1
 
-            return jsonify(result), status_code
+            function = function_name(request.get_json(silent=True))
+            start_time = self.metrics.start("download", function)
+            try:
+                chunks = self.get_download_response(**request.get_json())
+            except Exception as e:
+                self._finish_request("download", function, start_time, error=True)
+                return jsonify(
+                    {"error": f"Uncaught exception:\n\n{e}\n{traceback.format_exc()}"}
+                ), 400
+
+            outcome = {"error": True}
+            return self._finish_on_close(
+                Response(
+                    self._stream_chunks(chunks, outcome),
+                    mimetype="application/octet-stream",
+                ),
+                "download",
+                function,
+                start_time,
+                outcome,
+            )
 
         @app.route("/get_call_timestamps", methods=["GET"])
         def get_call_timestamps():
-            with self._call_timestamps_lock:
-                response = [asdict(timestamp) for timestamp in self._call_timestamps]
-            return response, 200
+            """
+            The start and end times of the most recent calls, at most
+            `max_call_timestamps_per_response` of them. With ?since=t, only the calls that
+            ended after t, for fetching new calls incrementally. With ?before=t, only the
+            calls that ended before t, for fetching older calls page by page.
+            """
+
+            since = request.args.get("since", type=float)
+            before = request.args.get("before", type=float)
+            limit = min(
+                request.args.get(
+                    "limit", default=self.max_call_timestamps_per_response, type=int
+                ),
+                self.max_call_timestamps_per_response,
+            )
+            response = [
+                asdict(Timestamp(start=start, end=end))
+                for start, end in self.metrics.timings(
+                    since=since, limit=limit, before=before
+                )
+            ]
+            return jsonify(response), 200
+
+        @app.route("/get_call_timeline", methods=["GET"])
+        def get_call_timeline():
+            """
+            The calls aggregated in ?bins=n time bins between ?start= and ?end=, see
+            `RequestMetrics.timeline`, for plotting long time ranges.
+            """
+
+            bins = min(
+                max(request.args.get("bins", default=1000, type=int), 1),
+                self.max_timeline_bins,
+            )
+            return (
+                jsonify(
+                    self.metrics.timeline(
+                        bins=bins,
+                        start=request.args.get("start", type=float),
+                        end=request.args.get("end", type=float),
+                    )
+                ),
+                200,
+            )
+
+        @app.route("/get_trace", methods=["GET"])
+        def get_trace():
+            """
+            The spans recorded by this process, see `Tracer`, as a Chrome trace or, with
+            ?format=otlp, as OTLP JSON. With ?since=t, only the spans that ended after t.
+            """
+
+            format = request.args.get("format", default="chrome")
+            if format not in ["chrome", "otlp"]:
+                return jsonify(
+                    {"error": f'Invalid trace format "{format}". Must be one of "chrome", "otlp".'}
+                ), 400
+            return (
+                jsonify(tracer.trace(format, since=request.args.get("since", type=float))),
+                200,
+            )
+
+        @app.route("/metrics", methods=["GET"])
+        def metrics():
+            return Response(
+                self.metrics.render_prometheus(
+                    self.metrics_prefix, extra_gauges=self.extra_metrics()
+                ),
+                mimetype="text/plain; version=0.0.4",
+            )
+
+        return app
+
+    def _serve_threaded(self, app: Flask) -> None:
+        server = create_server(
+            app,
+            **(
+                {"host": self.host, "port": self.port}
+                if self.listen_socket is None
+                else {"sockets": [self.listen_socket]}
+            ),
+            threads=self.threads,
+            connection_limit=self.connection_limit,
+            channel_timeout=self.keep_alive_timeout_seconds,
+        )
 
-        app.run(host=self.host, debug=True, port=self.port)
+        def handle_shutdown_signal(signal_number, frame) -> None:
+            if self._drained:
+                raise KeyboardInterrupt()
+            Thread(target=self._drain_and_stop, daemon=True).start()
 
-    def _get_response_or_error(self, arguments: Any) -> tuple[Any, int]:
-        start_time = perf_counter()
+        signal.signal(signal.SIGTERM, handle_shutdown_signal)
+        signal.signal(signal.SIGINT, handle_shutdown_signal)
+
+        print(f"Serving on http://{self.host}:{self.port} with {self.threads} threads.")
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self.stop_background_tasks()
+
+    def _drain_and_stop(self) -> None:
+        """
+        Graceful shutdown: refuse new requests, wait for the in flight ones to finish (up
+        to `shutdown_timeout_seconds`), then stop the server loop in the main thread.
+        """
+
+        with self._in_flight_requests_condition:
+            if self._shutting_down:
+                return
+            self._shutting_down = True
+            print(
+                f"Shutting down, waiting for {self._in_flight_requests} in flight requests to finish."
+            )
+            self._in_flight_requests_condition.wait_for(
+                lambda: self._in_flight_requests == 0,
+                timeout=self.shutdown_timeout_seconds,
+            )
+            self._drained = True
+        # This runs the SIGINT handler in the main thread, which raises KeyboardInterrupt
+        # now that the server is drained, which stops the waitress loop.
+        _thread.interrupt_main()
+
+    def start_background_tasks(self) -> None:
+        pass
+
+    def extra_metrics(self) -> dict[str, int | float]:
+        """
+        Gauges exported on /metrics next to the request metrics.
+        """
+
+        return {}
+
+    def stop_background_tasks(self) -> None:
+        pass
+
+    def _get_response_or_error(
+        self,
+        arguments: Any,
+        get_response: Callable | None = None,
+        endpoint: str = "process",
+    ) -> tuple[Any, int]:
+        if get_response is None:
+            get_response = self.get_response
+
+        function = function_name(arguments)
+        start_time = self.metrics.start(endpoint, function)
+        error = False
         try:
-            result = self.get_response(**arguments)
+            with tracer.span("server.handle", endpoint=endpoint, function=function):
+                result = get_response(**arguments)
+        except ServerBusy as e:
+            self.metrics.finish(endpoint, function, start_time, error=True)
+            return {
+                "error": str(e),
+                "busy": True,
+                "retry_after_seconds": e.retry_after_seconds,
+            }, 503
         except Exception as e:
+            error = True
             result = (
                 {"error": f"Uncaught exception:\n\n{e}\n{traceback.format_exc()}"},
                 400,
             )
-        end_time = perf_counter()
-
-        with self._call_timestamps_lock:
-            self._call_timestamps.append(Timestamp(start=start_time, end=end_time))
+        self.metrics.finish(endpoint, function, start_time, error=error)
 
         try:
             return result, 200
         except Exception:
             return {"error": f"Unable to convert response to json. {str(result)=}"}, 400
 
+    def _stream_response_or_error(self, arguments: Any, outcome: dict) -> Iterator[str]:
+        """
+        Yields the items of `get_streaming_response` as newline delimited json. An error
+        while streaming is sent as a last {"error": ...} line.
+        """
+
+        try:
+            for item in self.get_streaming_response(**arguments):
+                yield json.dumps(item) + "\n"
+            outcome["error"] = False
+        except Exception as e:
+            yield json.dumps(
+                {"error": f"Uncaught exception:\n\n{e}\n{traceback.format_exc()}"}
+            ) + "\n"
+
+    def _stream_chunks(self, chunks: Iterator[bytes], outcome: dict) -> Iterator[bytes]:
+        # An error in the middle of a download can't be reported anymore, the client sees
+        # the connection close before the end of the response.
+        yield from chunks
+        outcome["error"] = False
+
+    def _finish_on_close(
+        self,
+        response: Response,
+        endpoint: str,
+        function: str,
+        start_time: float,
+        outcome: dict,
+    ) -> Response:
+        """
+        Finishes the request when the server closes the streamed `response`, which it
+        also does when the body was never iterated, e.g. if the client went away first.
+        """
+
+        response.call_on_close(
+            lambda: self._finish_request(
+                endpoint, function, start_time, error=outcome["error"]
+            )
+        )
+        return response
+
+    def _finish_request(
+        self, endpoint: str, function: str, start_time: float, error: bool = False
+    ) -> None:
+        self.metrics.finish(endpoint, function, start_time, error=error)
+        with self._in_flight_requests_condition:
+            self._in_flight_requests -= 1
+            self._in_flight_requests_condition.notify_all()
+
     @abstractmethod
     def get_response(self, **kwargs) -> Any:
         pass
 
+    def get_streaming_response(self, **kwargs) -> Iterable[Any]:
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support streaming responses."
+        )
+
+    def get_upload_response(self, stream: Any, **kwargs) -> Any:
+        """
+        Handles a call to /upload. `stream` is a binary file-like object with the request
+        body, the other arguments come from the query string.
+        """
+
+        raise NotImplementedError(f"{type(self).__name__} does not support uploads.")
+
+    def get_download_response(self, **kwargs) -> Iterator[bytes]:
+        """
+        Handles a call to /download, whose response body is made of the returned chunks.
+        """
+
+        raise NotImplementedError(f"{type(self).__name__} does not support downloads.")
+
+
+@beartype
+def encoded_response(result: Any, status_code: int) -> tuple[Response, int]:
+    """
+    `result` encoded as the current request's Accept and Accept-Encoding headers ask:
+    msgpack if asked for explicitly and json otherwise, compressed if it is big enough.
+    The response tells the client which compressions it may use for its requests.
+    """
+
+    body, headers = encode_body(
+        result,
+        choose_content_type(request.headers.get("Accept")),
+        parse_header_list(request.headers.get("Accept-Encoding")),
+    )
+    response = Response(body, headers=headers)
+    response.headers["Accept-Encoding"] = ", ".join(supported_encodings())
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    if isinstance(result, dict) and "retry_after_seconds" in result:
+        response.headers["Retry-After"] = str(math.ceil(result["retry_after_seconds"]))
+    return response, status_code
+
+
+@beartype
+def function_name(arguments: Any) -> str:
+    if isinstance(arguments, dict) and isinstance(arguments.get("function"), str):
+        return arguments["function"]
+    return ""
+
 
 @beartype
 class DummyJsonRESTServer(JsonRESTServer):
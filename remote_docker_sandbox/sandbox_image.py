@@ -0,0 +1,73 @@
+import hashlib
+import os
+from pathlib import Path
+from threading import Lock
+from dataclasses import dataclass, field
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.docker_backend import DockerBackend, CliDockerBackend
+from remote_docker_sandbox.tracing import tracer
+
+
+@beartype
+@dataclass
+class SandboxImage:
+    """
+    The docker image built from the `sandbox/` directory, tagged with a hash of the
+    directory's contents so that it only gets rebuilt when the contents change.
+
+    The directory is hashed once, the first time the tag is needed, so changes to it are
+    only picked up by a new server. Concurrent callers of `ensure_built` share a single
+    in-flight build.
+    """
+
+    sandbox_path: Path
+    image_name: str = "bash-sandbox"
+    docker: DockerBackend = field(default_factory=lambda: CliDockerBackend())
+    _tag: str | None = None
+    _built_tag: str | None = None
+    _build_lock: Any = field(default_factory=lambda: Lock())
+
+    def content_hash(self) -> str:
+        if not self.sandbox_path.is_dir():
+            raise FileNotFoundError(
+                f"Sandbox directory '{self.sandbox_path}' not found."
+            )
+
+        hasher = hashlib.sha256()
+        for directory, subdirectories, filenames in os.walk(self.sandbox_path):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                path = Path(directory) / filename
+                hasher.update(str(path.relative_to(self.sandbox_path)).encode())
+                hasher.update(b"\0")
+                hasher.update(path.read_bytes())
+                hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def tag(self) -> str:
+        if self._tag is None:
+            self._tag = f"{self.image_name}:{self.content_hash()[:16]}"
+        return self._tag
+
+    def ensure_built(self) -> str:
+        """
+        Builds the image if no image with the current content hash exists yet and returns
+        its tag.
+        """
+
+        tag = self.tag()
+        if tag == self._built_tag:
+            return tag
+
+        with self._build_lock:
+            if tag == self._built_tag:
+                return tag
+
+            if not self.docker.image_exists(tag):
+                with tracer.span("image_build", tag=tag):
+                    self.docker.build_image(tag, self.sandbox_path)
+            self._built_tag = tag
+
+        return tag
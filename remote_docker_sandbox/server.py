@@ -1,24 +1,209 @@
-import subprocess
 from pathlib import Path
+from threading import Thread, Lock, Condition
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from os.path import dirname, abspath
-from shlex import quote
 from argparse import ArgumentParser
 from dataclasses import dataclass, field
-from collections.abc import Callable
-from time import perf_counter
+from collections.abc import Callable, Iterator
+from time import perf_counter, monotonic
+import traceback
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
 from typing import Any
 from beartype import beartype
 
-from remote_docker_sandbox.rest_server_base import JsonRESTServer
+from remote_docker_sandbox.rest_server_base import JsonRESTServer, ServerBusy
+from remote_docker_sandbox.warm_pool import WarmContainerPool, ContainerShape
+from remote_docker_sandbox.sandbox_image import SandboxImage
+from remote_docker_sandbox.exec_channel import PersistentShell
+from remote_docker_sandbox.capped_output import CappedOutput
+from remote_docker_sandbox.archive import merge_archives
+from remote_docker_sandbox.init_image_cache import InitImageCache
+from remote_docker_sandbox.container_lifecycle import ContainerLifecycle
+from remote_docker_sandbox.command_list_runner import run_command_list
+from remote_docker_sandbox.container_reset import (
+    DEFAULT_RESET_PATHS,
+    snapshot_command,
+    reset_command,
+)
+from remote_docker_sandbox.container_state_store import ContainerStateStore
+from remote_docker_sandbox.worker_processes import serve_in_worker_processes
+from remote_docker_sandbox.tracing import tracer, with_current_request_id
+from remote_docker_sandbox.docker_backend import (
+    DockerBackend,
+    make_docker_backend,
+    DEFAULT_DOCKER_SOCKET_PATH,
+)
 
 
 @beartype
 @dataclass
 class DockerSandboxServer(JsonRESTServer):
-    starting_container_processes: dict[str, subprocess.Popen] = field(
-        default_factory=lambda: {}
-    )
+    docker: DockerBackend = field(default_factory=lambda: make_docker_backend())
+    starting_containers: dict[str, Future] = field(default_factory=lambda: {})
     image_name: str = "bash-sandbox"
+    sandbox_image: SandboxImage | None = None
+    max_concurrent_starts: int = 256
+    _start_executor: ThreadPoolExecutor | None = None
+    max_concurrent_batch_commands: int = 256
+    _batch_executor: ThreadPoolExecutor | None = None
+    warm_pool_size: int = 0
+    warm_pool_shapes: list[tuple[int | float, int]] = field(
+        default_factory=lambda: []
+    )
+    warm_pool: WarmContainerPool | None = None
+    init_image_cache_bytes: int = 0
+    init_image_cache: InitImageCache | None = None
+    persistent_exec: bool = False
+    # Run all the commands of run_commands_sequentially in one exec, see command_list_runner.
+    single_exec_command_lists: bool = False
+    max_output_bytes: int | None = 64 * 1024 * 1024 # per stream and command, see CappedOutput
+    exec_channels: dict[str, PersistentShell] = field(default_factory=lambda: {})
+    _exec_channels_lock: Any = field(default_factory=lambda: Lock())
+    live_containers: dict[str, tuple[int | float, int]] = field(
+        default_factory=lambda: {}
+    )  # container name -> (memory_gb, cpus)
+    pending_starts: int = 0
+    _load_lock: Any = field(default_factory=lambda: Lock())
+    idle_ttl_seconds: int | float | None = None
+    lifecycle: ContainerLifecycle | None = None
+    # Containers are named docker-sandbox-... by the clients and the warm pool.
+    container_name_prefix: str = "docker-sandbox-"
+    remove_orphans_at_startup: bool = True
+    # Start requests that would take the memory or cpus reserved by the live containers
+    # above these wait for other containers to stop. None means no limit.
+    capacity_memory_gb: int | float | None = None
+    capacity_cpus: int | float | None = None
+    max_admission_wait_seconds: int | float = 30
+    max_queued_starts: int = 1024
+    busy_retry_after_seconds: int | float = 10
+    admission_rejections: int = 0
+    _admission_queue: Any = field(default_factory=lambda: deque())
+    _capacity_freed: Any = None
+    # Shared with the other worker processes serving on the same port, see
+    # serve_in_worker_processes. Then the load and the capacity are those of all the
+    # workers, and any worker can use the containers started by another one.
+    state_store: ContainerStateStore | None = None
+    # What reset_container restores, in the containers started with resettable=True.
+    reset_paths: list[str] = field(default_factory=lambda: list(DEFAULT_RESET_PATHS))
+    reset_timeout_seconds: int | float = 60
+
+    def __post_init__(self) -> None:
+        self._capacity_freed = Condition(self._load_lock)
+        if self.sandbox_image is None:
+            self.sandbox_image = SandboxImage(
+                sandbox_path=Path(dirname(abspath(__file__)) + "/sandbox"),
+                image_name=self.image_name,
+                docker=self.docker,
+            )
+        if self._start_executor is None:
+            self._start_executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrent_starts
+            )
+        if self._batch_executor is None:
+            self._batch_executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrent_batch_commands
+            )
+        if self.init_image_cache is None:
+            self.init_image_cache = InitImageCache(
+                docker=self.docker, max_bytes=self.init_image_cache_bytes
+            )
+        if self.lifecycle is None:
+            self.lifecycle = ContainerLifecycle(
+                remove_containers=self.docker.remove_containers,
+                stop_idle_container=self.stop_container,
+                idle_ttl_seconds=self.idle_ttl_seconds,
+                check_interval_seconds=(
+                    min(10, self.idle_ttl_seconds / 2)
+                    if self.idle_ttl_seconds is not None
+                    else 10
+                ),
+                # Only needed to stop idle containers that other workers use.
+                on_use=(
+                    self.state_store.touch
+                    if self.state_store is not None and self.idle_ttl_seconds is not None
+                    else None
+                ),
+                idle_seconds=(
+                    self.state_store.idle_seconds
+                    if self.state_store is not None and self.idle_ttl_seconds is not None
+                    else None
+                ),
+            )
+        if self.warm_pool is None:
+            self.warm_pool = WarmContainerPool(
+                create_container=self._create_warm_pool_container,
+                remove_container=self._remove_container_now,
+                size_per_shape=self.warm_pool_size,
+                fits=self._warm_pool_fits,
+                shapes=[
+                    ContainerShape(
+                        memory_gb=memory_gb,
+                        cpus=cpus,
+                        image_name=self.sandbox_image.tag(),
+                    )
+                    for memory_gb, cpus in self.warm_pool_shapes
+                ],
+            )
+
+    def start_background_tasks(self) -> None:
+        assert self.sandbox_image is not None
+        assert self.warm_pool is not None
+        assert self.lifecycle is not None
+        assert self.init_image_cache is not None
+        # Before anything else creates containers or images, so that only those of a
+        # previous run are found.
+        if self.remove_orphans_at_startup:
+            self._remove_orphaned_containers()
+            self.init_image_cache.remove_leftover_images()
+        Thread(target=self._build_image_at_startup, daemon=True).start()
+        self.warm_pool.start()
+        self.lifecycle.start()
+
+    def stop_background_tasks(self) -> None:
+        assert self.warm_pool is not None
+        assert self.lifecycle is not None
+        self.warm_pool.shutdown()
+        self.lifecycle.shutdown()
+
+    def _remove_orphaned_containers(self) -> None:
+        """
+        Schedules the removal of the sandbox containers left over by a previous run of the
+        server, e.g. after a crash.
+        """
+
+        assert self.lifecycle is not None
+        try:
+            container_names = self.docker.list_containers(self.container_name_prefix)
+        except Exception as e:
+            print(f"Error listing the containers left over by a previous run: {e}")
+            return
+        if len(container_names) > 0:
+            print(
+                f"Removing {len(container_names)} containers left over by a previous run."
+            )
+        for container_name in container_names:
+            self.lifecycle.remove(container_name)
+
+    def remove_orphaned_containers_now(self) -> None:
+        """
+        Like at startup, but waits until they are removed.
+        """
+
+        assert self.lifecycle is not None
+        assert self.init_image_cache is not None
+        self._remove_orphaned_containers()
+        self.lifecycle.shutdown()
+        self.init_image_cache.remove_leftover_images()
+
+    def _build_image_at_startup(self) -> None:
+        assert self.sandbox_image is not None
+        try:
+            self.sandbox_image.ensure_built()
+        except Exception as e:
+            print(f"Error building the sandbox image at startup: {e}")
 
     def get_response(self, function: str, **kwargs) -> Any:  # type: ignore
         if function not in self.name_to_function:
@@ -28,105 +213,669 @@ class DockerSandboxServer(JsonRESTServer):
 
         return self.name_to_function[function](**kwargs)
 
+    def get_streaming_response(self, function: str, **kwargs) -> Iterator[Any]:  # type: ignore
+        if function not in self.name_to_streaming_function:
+            raise KeyError(
+                f'Invalid streaming function "{function}". Must be one of {", ".join(self.name_to_streaming_function.keys())}'
+            )
+
+        return self.name_to_streaming_function[function](**kwargs)
+
+    def get_upload_response(self, function: str, stream: Any, **kwargs) -> Any:  # type: ignore
+        if function not in self.name_to_upload_function:
+            raise KeyError(
+                f'Invalid upload function "{function}". Must be one of {", ".join(self.name_to_upload_function.keys())}'
+            )
+
+        return self.name_to_upload_function[function](stream=stream, **kwargs)
+
+    def get_download_response(self, function: str, **kwargs) -> Iterator[bytes]:  # type: ignore
+        if function not in self.name_to_download_function:
+            raise KeyError(
+                f'Invalid download function "{function}". Must be one of {", ".join(self.name_to_download_function.keys())}'
+            )
+
+        return self.name_to_download_function[function](**kwargs)
+
     @property
     def name_to_function(self) -> dict[str, Callable]:
         return {
             "add_one": self.add_one,
             "start_container": self.start_container,
             "stop_container": self.stop_container,
+            "reset_container": self.reset_container,
             "run_command": self.run_command,
             "run_commands_sequentially": self.run_commands_sequentially,
+            "run_batch": self.run_batch,
+            "get_pool_stats": self.get_pool_stats,
+            "get_load": self.get_load,
+            "get_init_image_cache_stats": self.get_init_image_cache_stats,
+            "get_lifecycle_stats": self.get_lifecycle_stats,
+            "list_containers": self.list_containers,
+        }
+
+    @property
+    def name_to_streaming_function(self) -> dict[str, Callable]:
+        return {
+            "run_batch": self.run_batch_streaming,
+            "run_command": self.run_command_streaming,
         }
 
+    @property
+    def name_to_upload_function(self) -> dict[str, Callable]:
+        return {"upload_archive": self.upload_archive}
+
+    @property
+    def name_to_download_function(self) -> dict[str, Callable]:
+        return {"download_archive": self.download_archive}
+
     def add_one(self, x: int) -> str:
         return str(x + 1)
 
+    def get_pool_stats(self) -> dict:
+        assert self.warm_pool is not None
+        return self.warm_pool.stats()
+
+    def extra_metrics(self) -> dict[str, int | float]:
+        assert self.warm_pool is not None
+        assert self.init_image_cache is not None
+        warm_pool_stats = self.warm_pool.stats()
+        init_image_cache_stats = self.init_image_cache.stats()
+        lifecycle_stats = self.get_lifecycle_stats()
+        with self._load_lock:
+            load = self._load()
+            queued_starts = len(self._admission_queue)
+            admission_rejections = self.admission_rejections
+        return {
+            "live_containers": load["live_containers"],
+            "pending_starts": load["pending_starts"],
+            "queued_starts": queued_starts,
+            "admission_rejections": admission_rejections,
+            "exec_channels": len(self.exec_channels),
+            "warm_pool_hits": warm_pool_stats["hits"],
+            "warm_pool_misses": warm_pool_stats["misses"],
+            "warm_pool_failed_creations": warm_pool_stats["failed_creations"],
+            "warm_pool_evictions": warm_pool_stats["evictions"],
+            "warm_pool_ready_containers": sum(
+                shape["ready"] for shape in warm_pool_stats["shapes"]
+            ),
+            "init_image_cache_hits": init_image_cache_stats["hits"],
+            "init_image_cache_misses": init_image_cache_stats["misses"],
+            "init_image_cache_evictions": init_image_cache_stats["evictions"],
+            "init_image_cache_size_bytes": init_image_cache_stats["size_bytes"],
+            "init_image_cache_populate_wait_timeouts": init_image_cache_stats[
+                "populate_wait_timeouts"
+            ],
+            "idle_containers_stopped": lifecycle_stats["idle_containers_stopped"],
+            "pending_container_removals": lifecycle_stats["pending_removals"],
+        }
+
+    def get_init_image_cache_stats(self) -> dict:
+        assert self.init_image_cache is not None
+        return self.init_image_cache.stats()
+
+    def get_lifecycle_stats(self) -> dict:
+        assert self.lifecycle is not None
+        return self.lifecycle.stats()
+
+    def list_containers(self) -> list[str]:
+        """
+        The names of the containers that are starting or started and weren't stopped, for
+        a gateway to find where the sandboxes it placed before restarting are.
+        """
+
+        if self.state_store is not None:
+            return self.state_store.container_names()
+        with self._load_lock:
+            return list(self.live_containers.keys())
+
+    def get_load(self) -> dict:
+        """
+        A cheap snapshot of how busy this server is, which clients use to choose a server.
+        """
+
+        total_memory_gb, available_memory_gb = host_memory_gb()
+        with self._load_lock:
+            return {
+                **self._load(),
+                "total_memory_gb": total_memory_gb,
+                "available_memory_gb": available_memory_gb,
+                "cpu_count": os.cpu_count() or 1,
+                "load_average_1m": os.getloadavg()[0],
+            }
+
     def start_container(
         self,
         container_name: str,
         init_command: str | None,
         memory_gb: int | float,
         cpus: int,
+        resettable: bool = False,
+        cache_init: bool = True,
     ) -> None:
-        sandbox_path = Path(dirname(abspath(__file__)) + "/sandbox")
-        if not sandbox_path.is_dir():
-            raise FileNotFoundError(f"Sandbox directory '{sandbox_path}' not found.")
+        with tracer.span("admission", container_name=container_name), self._load_lock:
+            self._wait_for_capacity(
+                container_name=container_name, memory_gb=memory_gb, cpus=cpus
+            )
+            self.pending_starts += 1
+        assert self.lifecycle is not None
+        # With a state store, containers stopped through another worker are never
+        # forgotten here, so they are only tracked for stopping them when idle.
+        if self.state_store is None or self.idle_ttl_seconds is not None:
+            self.lifecycle.track(container_name)
 
-        build_command = (
-            f"docker build -t {quote(self.image_name)} {quote(str(sandbox_path))}"
+        assert self._start_executor is not None
+        start_future = self._start_executor.submit(
+            with_current_request_id(self._start_container_in_background),
+            container_name=container_name,
+            init_command=init_command,
+            memory_gb=memory_gb,
+            cpus=cpus,
+            resettable=resettable,
+            cache_init=cache_init,
         )
-        start_command = f"docker run -d --name {quote(container_name)} --memory {memory_gb}gb --cpus {cpus} --tty {quote(self.image_name)} /bin/bash -c 'sleep infinity'"
-        if init_command is not None:
-            exec_init_command = f"docker exec {quote(container_name)} /bin/bash -c {quote(init_command)}"
+        self.starting_containers[container_name] = start_future
+        if self.state_store is not None:
+            # The state store keeps how the start went.
+            start_future.add_done_callback(
+                lambda _: self.starting_containers.pop(container_name, None)
+            )
+
+    def _wait_for_capacity(
+        self, container_name: str, memory_gb: int | float, cpus: int
+    ) -> None:
+        """
+        Must be called with `_load_lock` held. Waits until a container with `memory_gb`
+        and `cpus` fits in the capacity next to the live containers and reserves them for
+        `container_name`, letting the start requests that came first go first, and raises
+        ServerBusy if that takes more than `max_admission_wait_seconds` or too many start
+        requests are waiting already.
+        """
+
+        if self.capacity_memory_gb is None and self.capacity_cpus is None:
+            reserved = self._reserve(container_name, memory_gb=memory_gb, cpus=cpus)
+            if not reserved:
+                raise Exception(
+                    f"Error reserving resources for container {container_name}: it doesn't fit although the server has no capacity limit."
+                )
+            return
+
+        if len(self._admission_queue) >= self.max_queued_starts:
+            self.admission_rejections += 1
+            raise ServerBusy(
+                f"Server busy: {len(self._admission_queue)} start requests are already waiting for capacity.",
+                retry_after_seconds=self.busy_retry_after_seconds,
+            )
+
+        ticket = object()
+        self._admission_queue.append(ticket)
+        deadline = monotonic() + self.max_admission_wait_seconds
+        try:
+            while not (
+                self._admission_queue[0] is ticket
+                and self._reserve(container_name, memory_gb=memory_gb, cpus=cpus)
+            ):
+                remaining_seconds = deadline - monotonic()
+                if remaining_seconds <= 0:
+                    self.admission_rejections += 1
+                    raise ServerBusy(
+                        f"Server busy: not enough free capacity to start a container with {memory_gb} GB of memory and {cpus} cpus after waiting {self.max_admission_wait_seconds} seconds. Reserved by the live containers: {self._load()['reserved_memory_gb']} of {'unlimited' if self.capacity_memory_gb is None else self.capacity_memory_gb} GB of memory and {self._load()['reserved_cpus']} of {'unlimited' if self.capacity_cpus is None else self.capacity_cpus} cpus.",
+                        retry_after_seconds=self.busy_retry_after_seconds,
+                    )
+                # Capacity freed by other workers isn't notified.
+                self._capacity_freed.wait(
+                    timeout=(
+                        remaining_seconds
+                        if self.state_store is None
+                        else min(remaining_seconds, self.state_store.max_poll_seconds)
+                    )
+                )
+        finally:
+            self._admission_queue.remove(ticket)
+            # The next request in line may fit.
+            self._capacity_freed.notify_all()
+
+    def _reserve(self, container_name: str, memory_gb: int | float, cpus: int) -> bool:
+        if self.state_store is not None:
+            return self.state_store.reserve(
+                container_name,
+                memory_gb=memory_gb,
+                cpus=cpus,
+                worker=os.getpid(),
+                capacity_memory_gb=self.capacity_memory_gb,
+                capacity_cpus=self.capacity_cpus,
+            )
+        if not self._fits(memory_gb=memory_gb, cpus=cpus):
+            return False
+        self.live_containers[container_name] = (memory_gb, cpus)
+        return True
+
+    def _load(self) -> dict[str, int | float]:
+        if self.state_store is not None:
+            return self.state_store.load()
+        return {
+            "live_containers": len(self.live_containers),
+            "pending_starts": self.pending_starts,
+            "reserved_memory_gb": self._reserved_memory_gb(),
+            "reserved_cpus": self._reserved_cpus(),
+        }
+
+    def _fits(self, memory_gb: int | float, cpus: int) -> bool:
+        # A container bigger than the capacity still gets to run alone.
+        if len(self.live_containers) == 0:
+            return True
+        return (
+            self.capacity_memory_gb is None
+            or self._reserved_memory_gb() + memory_gb <= self.capacity_memory_gb
+        ) and (
+            self.capacity_cpus is None
+            or self._reserved_cpus() + cpus <= self.capacity_cpus
+        )
+
+    def _reserved_memory_gb(self) -> int | float:
+        return sum(memory_gb for memory_gb, _ in self.live_containers.values())
+
+    def _reserved_cpus(self) -> int | float:
+        return sum(cpus for _, cpus in self.live_containers.values())
+
+    def _start_container_in_background(
+        self,
+        container_name: str,
+        init_command: str | None,
+        memory_gb: int | float,
+        cpus: int,
+        resettable: bool,
+        cache_init: bool,
+    ) -> None:
+        assert self.lifecycle is not None
+        assert self.sandbox_image is not None
+        try:
+            self._make_room_in_warm_pool(
+                keep=ContainerShape(
+                    memory_gb=memory_gb, cpus=cpus, image_name=self.sandbox_image.tag()
+                )
+            )
+            with self.lifecycle.using(container_name):
+                self._start_container(
+                    container_name=container_name,
+                    init_command=init_command,
+                    memory_gb=memory_gb,
+                    cpus=cpus,
+                    cache_init=cache_init,
+                )
+                if resettable:
+                    self._exec_or_raise(
+                        container_name,
+                        snapshot_command(self.reset_paths),
+                        error_message="Error snapshotting sandbox for resetting it",
+                    )
+        except BaseException as e:
+            with self._load_lock:
+                self.live_containers.pop(container_name, None)
+                self._capacity_freed.notify_all()
+            if self.state_store is not None:
+                self.state_store.set_failed(container_name, str(e) or repr(e))
+            raise
         else:
-            exec_init_command = "true"
-
-        start_process = subprocess.Popen(
-            f"{build_command} && {start_command} && {exec_init_command}",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            errors="replace",
+            if self.state_store is not None:
+                self.state_store.set_started(container_name)
+        finally:
+            with self._load_lock:
+                self.pending_starts -= 1
+
+    def _start_container(
+        self,
+        container_name: str,
+        init_command: str | None,
+        memory_gb: int | float,
+        cpus: int,
+        cache_init: bool = True,
+    ) -> None:
+        """
+        Containers started from the init image cache have the files init_command made, but
+        not the processes it left running, so `cache_init=False` is for init commands that
+        start daemons.
+        """
+
+        assert self.sandbox_image is not None
+        assert self.warm_pool is not None
+
+        assert self.init_image_cache is not None
+
+        image_tag = self.sandbox_image.ensure_built()
+
+        cache_key = None
+        should_populate_cache = False
+        if init_command is not None and cache_init and self.init_image_cache.enabled:
+            cache_key = InitImageCache.key(image_tag, init_command)
+            cached_image, should_populate_cache = self.init_image_cache.acquire(
+                cache_key
+            )
+            if cached_image is not None:
+                with tracer.span(
+                    "container_start", container_name=container_name, source="init_image_cache"
+                ):
+                    self.docker.create_and_start_container(
+                        container_name=container_name,
+                        image=cached_image,
+                        memory_gb=memory_gb,
+                        cpus=cpus,
+                    )
+                return
+
+        try:
+            pooled_container_name = self.warm_pool.claim(
+                ContainerShape(memory_gb=memory_gb, cpus=cpus, image_name=image_tag)
+            )
+
+            if pooled_container_name is not None:
+                with tracer.span(
+                    "container_start", container_name=container_name, source="warm_pool"
+                ):
+                    self.docker.rename_container(pooled_container_name, container_name)
+            else:
+                with tracer.span(
+                    "container_start", container_name=container_name, source="image"
+                ):
+                    self.docker.create_and_start_container(
+                        container_name=container_name,
+                        image=image_tag,
+                        memory_gb=memory_gb,
+                        cpus=cpus,
+                    )
+
+            if init_command is None:
+                return
+
+            with tracer.span("init_command", container_name=container_name):
+                output = self.docker.exec(
+                    container_name, ["/bin/bash", "-c", init_command]
+                )
+            if output["returncode"] != 0:
+                raise Exception(
+                    f"Error starting sandbox:\ninit command exit code: {output['returncode']} \n\ninit command stdout: {output['stdout']}\n\ninit command stderr {output['stderr']}"
+                )
+        except BaseException:
+            if should_populate_cache:
+                assert cache_key is not None
+                self.init_image_cache.abandon(cache_key, failed=True)
+            raise
+
+        if should_populate_cache:
+            assert cache_key is not None
+            self.init_image_cache.add(cache_key, container_name, base_image=image_tag)
+
+    def _warm_pool_fits(self) -> bool:
+        """
+        Whether the warm pool's containers fit in the capacity next to the live ones. With
+        worker processes, only this worker's warm pool is counted.
+        """
+
+        assert self.warm_pool is not None
+        warm_memory_gb, warm_cpus = self.warm_pool.reserved()
+        with self._load_lock:
+            load = self._load()
+        return (
+            self.capacity_memory_gb is None
+            or load["reserved_memory_gb"] + warm_memory_gb <= self.capacity_memory_gb
+        ) and (
+            self.capacity_cpus is None
+            or load["reserved_cpus"] + warm_cpus <= self.capacity_cpus
         )
 
-        self.starting_container_processes[container_name] = start_process
+    def _make_room_in_warm_pool(self, keep: ContainerShape) -> None:
+        """
+        Removes warm containers that, next to the live containers, take more than the
+        capacity, e.g. after a start was admitted. Admission doesn't count them, so that
+        they never hold up a start.
+        """
 
-    def _wait_until_started(self, container_name: str) -> None:
-        start_process = self.starting_container_processes.get(container_name)
-        if start_process is None:
+        assert self.warm_pool is not None
+        if not self.warm_pool.enabled or (
+            self.capacity_memory_gb is None and self.capacity_cpus is None
+        ):
             return
-        stdout, stderr = start_process.communicate()
-        if start_process.returncode != 0:
-            raise Exception(
-                f"Error starting sandbox:\nstart process exit code: {start_process.returncode} \n\nstart process stdout: {stdout}\n\nstart process stderr {stderr}"
-            )
+        warm_memory_gb, warm_cpus = self.warm_pool.reserved()
+        with self._load_lock:
+            load = self._load()
+        self.warm_pool.evict(
+            memory_gb=(
+                0
+                if self.capacity_memory_gb is None
+                else load["reserved_memory_gb"] + warm_memory_gb - self.capacity_memory_gb
+            ),
+            cpus=(
+                0
+                if self.capacity_cpus is None
+                else load["reserved_cpus"] + warm_cpus - self.capacity_cpus
+            ),
+            keep=keep,
+        )
+
+    def _create_warm_pool_container(
+        self, container_name: str, shape: ContainerShape
+    ) -> None:
+        assert self.sandbox_image is not None
+        self.sandbox_image.ensure_built()
+        self.docker.create_and_start_container(
+            container_name=container_name,
+            image=shape.image_name,
+            memory_gb=shape.memory_gb,
+            cpus=shape.cpus,
+        )
+
+    def _remove_container_now(self, container_name: str) -> None:
+        self.docker.remove_container(container_name, force=True)
+
+    def _wait_until_started(self, container_name: str) -> None:
+        start_future = self.starting_containers.get(container_name)
+        if start_future is not None:
+            with tracer.span("wait_until_started", container_name=container_name):
+                start_future.result()
+        elif self.state_store is not None:
+            with tracer.span("wait_until_started", container_name=container_name):
+                self.state_store.wait_until_started(container_name)
 
     def stop_container(self, container_name: str) -> None:
-        self._wait_until_started(container_name)
+        assert self.lifecycle is not None
+        try:
+            self._wait_until_started(container_name)
+        finally:
+            # Even if the container failed to start, since it may have been created.
+            self.starting_containers.pop(container_name, None)
+            if self.state_store is not None:
+                self.state_store.remove(container_name)
+            with self._load_lock:
+                self.live_containers.pop(container_name, None)
+                self._capacity_freed.notify_all()
+            self.lifecycle.forget(container_name)
 
-        stop_container_command = (
-            f"docker stop {quote(container_name)}; docker rm {quote(container_name)}"
-        )
+            with self._exec_channels_lock:
+                exec_channel = self.exec_channels.pop(container_name, None)
+            if exec_channel is not None:
+                exec_channel.close()
+
+            # Removed in batches in the background.
+            self.lifecycle.remove(container_name)
+
+    def reset_container(self, container_name: str) -> None:
+        """
+        Kills every process of the container but its init, and restores the
+        `reset_paths` to what they were right after it started. The container must have
+        been started with resettable=True.
 
-        subprocess.Popen(
-            stop_container_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
+        The processes that `init_command` started in the background aren't restarted,
+        since running it again wouldn't be idempotent on the restored files.
+        """
+
+        assert self.lifecycle is not None
+        with self.lifecycle.using(container_name):
+            self._wait_until_started(container_name)
+            # Its shell is killed, and would keep the environment of the last commands.
+            with self._exec_channels_lock:
+                exec_channel = self.exec_channels.pop(container_name, None)
+            if exec_channel is not None:
+                exec_channel.close()
+            with tracer.span("reset", container_name=container_name):
+                self._exec_or_raise(
+                    container_name,
+                    reset_command(),
+                    error_message="Error resetting sandbox",
+                )
+
+    def _exec_or_raise(
+        self, container_name: str, command: list[str], error_message: str
+    ) -> None:
+        output = self.docker.exec(
+            container_name, command, timeout_seconds=self.reset_timeout_seconds
         )
+        if output["returncode"] != 0:
+            raise Exception(
+                f"{error_message}:\nexit code: {output['returncode']} \n\nstdout: {output['stdout']}\n\nstderr {output['stderr']}"
+            )
+
+    def upload_archive(self, container_name: str, path: str, stream: Any) -> None:
+        """
+        Extracts the tar archive in the request body into the directory `path` of the
+        container.
+        """
+
+        assert self.lifecycle is not None
+        with self.lifecycle.using(container_name):
+            self._wait_until_started(container_name)
+            self.docker.put_archive(container_name, path, stream)
+
+    def download_archive(self, container_name: str, paths: list[str]) -> Iterator[bytes]:
+        """
+        Streams one tar archive of the files and directories at the absolute `paths` of
+        the container, whose members are named after their path without the leading /.
+        """
+
+        assert self.lifecycle is not None
+        with self.lifecycle.using(container_name):
+            self._wait_until_started(container_name)
+            # Open all the archives before streaming anything, so that a missing path is
+            # reported as an error response instead of a truncated archive.
+            archives = [
+                (path, self.docker.get_archive(container_name, path)) for path in paths
+            ]
+        return self._while_using(container_name, merge_archives(archives))
+
+    def _while_using(self, container_name: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        assert self.lifecycle is not None
+        with self.lifecycle.using(container_name):
+            yield from chunks
 
     def run_command(
-        self, container_name: str, command: str, timeout_seconds: int | float
+        self,
+        container_name: str,
+        command: str,
+        timeout_seconds: int | float,
+        max_output_bytes: int | None = None,
     ) -> dict:
-        self._wait_until_started(container_name)
+        assert self.lifecycle is not None
+        with self.lifecycle.using(container_name):
+            self._wait_until_started(container_name)
 
-        docker_exec_command = [
-            "docker",
-            "exec",
-            container_name,
-            "/bin/bash",
-            "-c",
-            command,
-        ]
+            max_output_bytes = self._effective_max_output_bytes(max_output_bytes)
 
-        try:
-            output = subprocess.run(
-                docker_exec_command,
-                timeout=timeout_seconds,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                errors="replace",
-            )
-        except subprocess.TimeoutExpired:
-            return {"returncode": 1, "stdout": "", "stderr": "timed out"}
+            if self.persistent_exec:
+                with self._exec_channels_lock:
+                    if container_name not in self.exec_channels:
+                        self.exec_channels[container_name] = PersistentShell(
+                            container_name=container_name
+                        )
+                    exec_channel = self.exec_channels[container_name]
+                with tracer.span(
+                    "exec", container_name=container_name, channel="persistent_shell"
+                ):
+                    output = exec_channel.run(
+                        command,
+                        timeout_seconds=timeout_seconds,
+                        max_output_bytes=max_output_bytes,
+                    )
+                # The channel is busy with a concurrent command on the same container.
+                if output is not None:
+                    return output
 
-        return {
-            "returncode": output.returncode,
-            "stdout": output.stdout,
-            "stderr": output.stderr,
-        }
+            try:
+                with tracer.span("exec", container_name=container_name, channel="docker_exec"):
+                    return self.docker.exec(
+                        container_name,
+                        ["/bin/bash", "-c", command],
+                        timeout_seconds=timeout_seconds,
+                        max_bytes=max_output_bytes,
+                    )
+            except TimeoutError:
+                return {"returncode": 1, "stdout": "", "stderr": "timed out"}
+
+    def run_command_streaming(
+        self,
+        container_name: str,
+        command: str,
+        timeout_seconds: int | float,
+        max_output_bytes: int | None = None,
+    ) -> Iterator[dict]:
+        """
+        Yields {"stdout": ...} and {"stderr": ...} chunks as the command writes its output,
+        then a last {"returncode": ..., "stdout_truncated_bytes": ...,
+        "stderr_truncated_bytes": ...}.
+
+        With a byte limit, the first half of the allowed output of each stream is sent as
+        it is produced, and the last half is held back and sent when the command is done,
+        after a truncation marker if anything was dropped in between.
+        """
+
+        assert self.lifecycle is not None
+        with self.lifecycle.using(container_name):
+            self._wait_until_started(container_name)
+
+            max_output_bytes = self._effective_max_output_bytes(max_output_bytes)
+            output = {
+                "stdout": CappedOutput(max_bytes=max_output_bytes),
+                "stderr": CappedOutput(max_bytes=max_output_bytes),
+            }
+            returncode = 1
+            try:
+                for stream, data in self.docker.exec_streaming(
+                    container_name,
+                    ["/bin/bash", "-c", command],
+                    timeout_seconds=timeout_seconds,
+                ):
+                    if stream == "returncode":
+                        assert isinstance(data, int)
+                        returncode = data
+                        continue
+                    assert isinstance(data, bytes)
+                    text = output[stream].append(data)
+                    if len(text) > 0:
+                        yield {stream: text}
+                timed_out = False
+            except TimeoutError:
+                timed_out = True
+
+            for stream in ["stdout", "stderr"]:
+                text = output[stream].tail_text()
+                if len(text) > 0:
+                    yield {stream: text}
+            if timed_out:
+                yield {"stderr": "timed out"}
+
+            yield {
+                "returncode": returncode,
+                "stdout_truncated_bytes": output["stdout"].truncated_bytes,
+                "stderr_truncated_bytes": output["stderr"].truncated_bytes,
+            }
+
+    def _effective_max_output_bytes(
+        self, max_output_bytes: int | None
+    ) -> int | None:
+        limits = [
+            limit
+            for limit in [max_output_bytes, self.max_output_bytes]
+            if limit is not None
+        ]
+        return min(limits) if len(limits) > 0 else None
 
     def run_commands_sequentially(
         self,
@@ -135,6 +884,23 @@ class DockerSandboxServer(JsonRESTServer):
         total_timeout_seconds: float | int,
         per_command_timeout_seconds: float | int,
     ) -> list[dict]:
+        if self.single_exec_command_lists:
+            assert self.lifecycle is not None
+            with self.lifecycle.using(container_name):
+                self._wait_until_started(container_name)
+                with tracer.span(
+                    "exec", container_name=container_name, channel="command_list_runner"
+                ):
+                    return run_command_list(
+                        self.docker.exec_streaming,
+                        container_name=container_name,
+                        commands=commands,
+                        total_timeout_seconds=total_timeout_seconds,
+                        per_command_timeout_seconds=per_command_timeout_seconds,
+                        max_output_bytes=self._effective_max_output_bytes(None),
+                        postprocess_output=self.docker.postprocess_output,
+                    )
+
         self._wait_until_started(container_name)
 
         responses: list[dict] = []
@@ -157,6 +923,73 @@ class DockerSandboxServer(JsonRESTServer):
 
         return responses
 
+    def run_batch(self, items: list[dict]) -> list[dict]:
+        """
+        Runs `run_command` for every item, which must have keys "container_name",
+        "command" and "timeout_seconds", concurrently, and returns the results in order.
+        """
+
+        futures = self._submit_batch(items)
+        return [self._batch_item_result(future) for future in futures]
+
+    def run_batch_streaming(self, items: list[dict]) -> Iterator[dict]:
+        """
+        Like `run_batch`, but yields {"index": ..., "result": ...} for every item as soon as
+        it completes.
+        """
+
+        futures = self._submit_batch(items)
+        future_to_index = {future: i for i, future in enumerate(futures)}
+        for future in as_completed(futures):
+            yield {
+                "index": future_to_index[future],
+                "result": self._batch_item_result(future),
+            }
+
+    def _submit_batch(self, items: list[dict]) -> list[Future]:
+        assert self._batch_executor is not None
+        return [
+            self._batch_executor.submit(
+                with_current_request_id(self.run_command),
+                container_name=item["container_name"],
+                command=item["command"],
+                timeout_seconds=item["timeout_seconds"],
+            )
+            for item in items
+        ]
+
+    def _batch_item_result(self, future: Future) -> dict:
+        try:
+            return future.result()
+        except Exception as e:
+            return {"error": f"Uncaught exception:\n\n{e}\n{traceback.format_exc()}"}
+
+
+@beartype
+def host_memory_gb() -> tuple[float, float]:
+    """
+    Returns the total and the available memory of the host in GB.
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = {
+                line.split(":")[0]: int(line.split()[1]) * 1024 for line in f
+            }
+        return meminfo["MemTotal"] / 2**30, meminfo["MemAvailable"] / 2**30
+    except (OSError, KeyError, ValueError, IndexError):
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        return (
+            os.sysconf("SC_PHYS_PAGES") * page_size / 2**30,
+            os.sysconf("SC_AVPHYS_PAGES") * page_size / 2**30,
+        )
+
+
+@beartype
+def parse_shape(shape: str) -> tuple[int | float, int]:
+    memory_gb, cpus = shape.split(":")
+    return float(memory_gb) if "." in memory_gb else int(memory_gb), int(cpus)
+
 
 @beartype
 def main():
@@ -165,10 +998,194 @@ def main():
     )
     parser.add_argument("--host", type=str, default="0.0.0.0")
     parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["threaded", "debug"],
+        default="threaded",
+        help="threaded: multi-threaded production WSGI server with keep-alive and graceful shutdown on SIGTERM. debug: flask's development server with the debugger and reloader.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=256,
+        help="Maximum number of requests handled concurrently by the threaded engine.",
+    )
+    parser.add_argument(
+        "--connection-limit",
+        type=int,
+        default=2048,
+        help="Maximum number of open connections for the threaded engine.",
+    )
+    parser.add_argument(
+        "--warm-pool-size",
+        type=int,
+        default=0,
+        help="Number of already running containers to keep ready for every (memory_gb, cpus) shape. 0 disables the warm pool.",
+    )
+    parser.add_argument(
+        "--warm-pool-shape",
+        type=str,
+        action="append",
+        default=[],
+        help="A MEMORY_GB:CPUS shape to keep warm from startup on, e.g. 1:1. Can be repeated. Up to 8 other shapes are added to the pool the first time they are requested, and dropped after 10 minutes without being requested. Warm containers only take the capacity (see --capacity-memory-gb and --capacity-cpus) the live containers leave free.",
+    )
+    parser.add_argument(
+        "--init-image-cache-gb",
+        type=float,
+        default=0,
+        help="Save the container as an image after a successful init_command, and start later sandboxes with the same init_command from that image instead of running it again. The least recently used images are removed when they take more than this many GB. 0 disables the cache. Only files are saved: processes init_command left running, e.g. daemons, aren't running in sandboxes started from the cache. Clients whose init_command starts processes pass cache_init=False to always run it.",
+    )
+    parser.add_argument(
+        "--persistent-exec",
+        action="store_true",
+        help="Run commands through one long-lived shell per container instead of a new docker exec per command.",
+    )
+    parser.add_argument(
+        "--single-exec-command-lists",
+        action="store_true",
+        help="Run all the commands of a run_commands_sequentially call in a single exec, through a small runner script in the container, instead of one exec per command.",
+    )
+    parser.add_argument(
+        "--docker-backend",
+        type=str,
+        choices=["auto", "cli", "socket"],
+        default="auto",
+        help="How to talk to docker: through the Docker Engine API on its unix socket, through the docker CLI, or auto to use the socket when it is available.",
+    )
+    parser.add_argument(
+        "--docker-socket", type=str, default=DEFAULT_DOCKER_SOCKET_PATH
+    )
+    parser.add_argument(
+        "--max-output-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Maximum number of bytes of stdout and of stderr kept per command. The beginning and the end of longer outputs are kept. 0 means no limit.",
+    )
+    parser.add_argument(
+        "--idle-ttl-seconds",
+        type=float,
+        default=0,
+        help="Stop and remove the containers that haven't been used (started, or run a command, or had files uploaded or downloaded) for this many seconds, e.g. because the client crashed. 0 means never.",
+    )
+    parser.add_argument(
+        "--keep-orphaned-containers",
+        action="store_true",
+        help="Don't remove the docker-sandbox-* containers left over by a previous run of the server at startup. Needed if several servers share the same docker daemon.",
+    )
+    parser.add_argument(
+        "--capacity-memory-gb",
+        type=float,
+        default=0,
+        help="Memory, in GB, that the sandboxes' memory limits may add up to. Start requests beyond that wait for sandboxes to stop, and get a retryable busy answer after --max-admission-wait-seconds. 0 means no limit.",
+    )
+    parser.add_argument(
+        "--capacity-cpus",
+        type=float,
+        default=0,
+        help="Like --capacity-memory-gb, for the sandboxes' cpus. 0 means no limit.",
+    )
+    parser.add_argument(
+        "--max-admission-wait-seconds",
+        type=float,
+        default=30,
+        help="How long a start request waits for capacity before the server answers that it is busy.",
+    )
+    parser.add_argument(
+        "--reset-path",
+        type=str,
+        action="append",
+        default=[],
+        help=f"A directory or file that reset_container restores to what it was after the sandbox started. Can be repeated. Defaults to {', '.join(DEFAULT_RESET_PATHS)}.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes serving on the port, sharing the state of the containers through --state-store, so that requests aren't all handled by one Python interpreter. --threads, --connection-limit and --warm-pool-size are per worker.",
+    )
+    parser.add_argument(
+        "--state-store",
+        type=str,
+        default=None,
+        help="Path of the SQLite database the workers share the state of the containers in. Defaults to a temporary file.",
+    )
     arguments = parser.parse_args()
 
-    server = DockerSandboxServer(host=arguments.host, port=arguments.port)
-    server.serve()
+    def make_server(**kwargs) -> DockerSandboxServer:
+        return DockerSandboxServer(
+            docker=make_docker_backend(
+                arguments.docker_backend, socket_path=arguments.docker_socket
+            ),
+            host=arguments.host,
+            port=arguments.port,
+            engine=arguments.engine,
+            threads=arguments.threads,
+            connection_limit=arguments.connection_limit,
+            warm_pool_size=arguments.warm_pool_size,
+            warm_pool_shapes=[parse_shape(shape) for shape in arguments.warm_pool_shape],
+            init_image_cache_bytes=int(arguments.init_image_cache_gb * 1024**3),
+            persistent_exec=arguments.persistent_exec,
+            single_exec_command_lists=arguments.single_exec_command_lists,
+            max_output_bytes=(
+                arguments.max_output_bytes if arguments.max_output_bytes > 0 else None
+            ),
+            idle_ttl_seconds=(
+                arguments.idle_ttl_seconds if arguments.idle_ttl_seconds > 0 else None
+            ),
+            capacity_memory_gb=(
+                arguments.capacity_memory_gb if arguments.capacity_memory_gb > 0 else None
+            ),
+            capacity_cpus=arguments.capacity_cpus if arguments.capacity_cpus > 0 else None,
+            max_admission_wait_seconds=arguments.max_admission_wait_seconds,
+            reset_paths=(
+                arguments.reset_path
+                if len(arguments.reset_path) > 0
+                else list(DEFAULT_RESET_PATHS)
+            ),
+            **kwargs,
+        )
+
+    if arguments.workers <= 1:
+        make_server(
+            remove_orphans_at_startup=not arguments.keep_orphaned_containers
+        ).serve()
+        return
+
+    if arguments.engine != "threaded":
+        parser.error("--workers needs the threaded engine.")
+    if arguments.init_image_cache_gb > 0:
+        # Every worker would evict the images of the others.
+        parser.error("--init-image-cache-gb isn't supported with --workers.")
+
+    state_store_directory = None
+    if arguments.state_store is None:
+        state_store_directory = mkdtemp(prefix="remote_docker_sandbox_")
+        arguments.state_store = f"{state_store_directory}/containers.sqlite"
+    state_store = ContainerStateStore(path=arguments.state_store)
+    state_store.clear()
+
+    # Once, before any worker creates containers.
+    if not arguments.keep_orphaned_containers:
+        make_server(remove_orphans_at_startup=True).remove_orphaned_containers_now()
+
+    try:
+        serve_in_worker_processes(
+            lambda listen_socket: make_server(
+                listen_socket=listen_socket,
+                state_store=state_store,
+                remove_orphans_at_startup=False,
+            ).serve(),
+            host=arguments.host,
+            port=arguments.port,
+            workers=arguments.workers,
+            on_worker_exit=lambda pid: state_store.fail_starts_of_worker(
+                pid, f"The server worker process {pid} that was starting the container exited."
+            ),
+        )
+    finally:
+        if state_store_directory is not None:
+            rmtree(state_store_directory, ignore_errors=True)
 
 
 if __name__ == "__main__":
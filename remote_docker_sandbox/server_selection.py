@@ -0,0 +1,183 @@
+import os
+from threading import Lock, Thread
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any
+from beartype import beartype
+
+from remote_docker_sandbox.rest_client_base import get_session
+
+
+DEFAULT_LOAD_SNAPSHOT_TTL_SECONDS = float(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_LOAD_SNAPSHOT_TTL_SECONDS", "2")
+)
+
+
+@beartype
+@dataclass(frozen=True)
+class ServerLoad:
+    """
+    What a server's `get_load` function returns.
+    """
+
+    live_containers: int
+    pending_starts: int
+    reserved_memory_gb: int | float
+    reserved_cpus: int | float
+    total_memory_gb: int | float
+    available_memory_gb: int | float
+    cpu_count: int
+    load_average_1m: int | float
+
+    @staticmethod
+    def from_json(response: Any) -> "ServerLoad | None":
+        try:
+            return ServerLoad(**response)
+        except Exception:
+            return None
+
+
+@beartype
+@dataclass
+class _Assigned:
+    """
+    Sandboxes this process placed on a server since its last load snapshot, which the
+    snapshot doesn't account for yet.
+    """
+
+    containers: int = 0
+    memory_gb: int | float = 0
+    cpus: int | float = 0
+
+
+@beartype
+@dataclass
+class LoadBalancer:
+    """
+    Picks the server whose memory or cpus would be the least used, relative to its
+    capacity, after placing a sandbox on it.
+
+    Load snapshots are cached for `ttl_seconds` and refreshed in background threads, so
+    `choose` never waits for the network. Servers without a snapshot (not fetched yet,
+    unreachable, or too old to have `get_load`) are not chosen, and `choose` returns None
+    if no server has one, in which case the caller falls back to round-robin.
+    """
+
+    ttl_seconds: int | float = DEFAULT_LOAD_SNAPSHOT_TTL_SECONDS
+    request_timeout_seconds: int | float = 2
+    snapshots: dict[str, ServerLoad] = field(default_factory=lambda: {})
+    _fetched_at: dict[str, float] = field(default_factory=lambda: {})
+    _assigned: dict[str, _Assigned] = field(default_factory=lambda: {})
+    _refreshing: set[str] = field(default_factory=lambda: set())
+    _lock: Any = field(default_factory=lambda: Lock())
+
+    def choose(
+        self, server_urls: list[str], memory_gb: int | float, cpus: int
+    ) -> str | None:
+        self._refresh_stale_in_background(server_urls)
+
+        with self._lock:
+            candidates = [url for url in server_urls if url in self.snapshots]
+            if len(candidates) == 0:
+                return None
+
+            server_url = min(
+                candidates,
+                key=lambda url: self._score(
+                    self.snapshots[url],
+                    self._assigned.setdefault(url, _Assigned()),
+                    memory_gb=memory_gb,
+                    cpus=cpus,
+                ),
+            )
+
+            assigned = self._assigned.setdefault(server_url, _Assigned())
+            assigned.containers += 1
+            assigned.memory_gb += memory_gb
+            assigned.cpus += cpus
+
+        return server_url
+
+    def refresh(self, server_urls: list[str]) -> None:
+        """
+        Fetches the load of all servers now, in parallel, and waits for the results.
+        """
+
+        threads = [
+            Thread(target=self._refresh_one, args=(server_url,), daemon=True)
+            for server_url in server_urls
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _score(
+        snapshot: ServerLoad,
+        assigned: _Assigned,
+        memory_gb: int | float,
+        cpus: int,
+    ) -> float:
+        # Reservations are what the sandboxes may grow to, actual usage is what the
+        # host sees, including what isn't a sandbox. Whichever is higher counts.
+        used_memory_gb = max(
+            snapshot.reserved_memory_gb,
+            snapshot.total_memory_gb - snapshot.available_memory_gb,
+        )
+        used_cpus = max(snapshot.reserved_cpus, snapshot.load_average_1m)
+        return max(
+            (used_memory_gb + assigned.memory_gb + memory_gb)
+            / max(snapshot.total_memory_gb, 1e-9),
+            (used_cpus + assigned.cpus + cpus) / max(snapshot.cpu_count, 1),
+        )
+
+    def _refresh_stale_in_background(self, server_urls: list[str]) -> None:
+        now = monotonic()
+        with self._lock:
+            stale = [
+                url
+                for url in server_urls
+                if url not in self._refreshing
+                and now - self._fetched_at.get(url, float("-inf")) >= self.ttl_seconds
+            ]
+            self._refreshing.update(stale)
+
+        for server_url in stale:
+            Thread(
+                target=self._refresh_one,
+                args=(server_url,),
+                kwargs={"already_marked": True},
+                daemon=True,
+            ).start()
+
+    def _refresh_one(self, server_url: str, already_marked: bool = False) -> None:
+        if not already_marked:
+            with self._lock:
+                self._refreshing.add(server_url)
+
+        try:
+            response = get_session(server_url).post(
+                f"{server_url}/process",
+                json={"function": "get_load"},
+                timeout=self.request_timeout_seconds,
+            )
+            snapshot = (
+                ServerLoad.from_json(response.json())
+                if response.status_code == 200
+                else None
+            )
+        except Exception:
+            snapshot = None
+
+        with self._lock:
+            self._refreshing.discard(server_url)
+            self._fetched_at[server_url] = monotonic()
+            if snapshot is None:
+                self.snapshots.pop(server_url, None)
+            else:
+                self.snapshots[server_url] = snapshot
+            self._assigned[server_url] = _Assigned()
+
+
+load_balancer = LoadBalancer()
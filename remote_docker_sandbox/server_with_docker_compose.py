@@ -5,18 +5,76 @@ from shlex import quote
 from argparse import ArgumentParser
 from dataclasses import dataclass, field
 from collections.abc import Callable
+from threading import Lock
 from typing import Any
 from beartype import beartype
 
 from remote_docker_sandbox.rest_server_base import JsonRESTServer
+from remote_docker_sandbox.docker_backend import DockerBackend, make_docker_backend
+from remote_docker_sandbox.compose_replica_pool import ComposeReplicaPool
+from remote_docker_sandbox.container_reset import (
+    DEFAULT_RESET_PATHS,
+    snapshot_command,
+    reset_command,
+)
+
 
 
 @beartype
 @dataclass
 class DockerSandboxServer(JsonRESTServer):
-    docker_compose_is_up: bool = False
-    container_name_to_actual_name: dict[str, str] = {}
+    """
+    Serves sandboxes that are replicas of the `service` of a docker compose stack, leased
+    from a `ComposeReplicaPool`.
+
+    The `reset_paths` of a replica are snapshotted the first time it is leased, before
+    `init_command` runs, and when its lease ends it is reset like by `reset_container` of
+    `remote_docker_sandbox.server.DockerSandboxServer`: its processes are killed and the
+    `reset_paths` are restored. Then `reset_command` is run in it, if given. Replicas left
+    over by a previous run without a snapshot fail to reset, and are recreated.
+    """
+
+    container_name_to_actual_name: dict[str, str] = field(default_factory=lambda: {})
+    _names_lock: Any = field(default_factory=lambda: Lock())
     image_name: str = "bash-sandbox"
+    docker: DockerBackend = field(default_factory=lambda: make_docker_backend())
+    compose_file: str | None = None
+    compose_project: str | None = None
+    service: str = "worker"
+    reset_paths: list[str] = field(default_factory=lambda: list(DEFAULT_RESET_PATHS))
+    reset_command: str | None = None
+    reset_timeout_seconds: int | float = 60
+    min_replicas: int = 0
+    max_replicas: int = 64
+    spare_replicas: int = 1
+    scale_down_after_seconds: int | float = 60
+    max_lease_wait_seconds: int | float = 30
+    pool: ComposeReplicaPool | None = None
+
+    def __post_init__(self) -> None:
+        if self.pool is None:
+            self.pool = ComposeReplicaPool(
+                scale=self._scale,
+                reset_replica=self._reset_replica,
+                remove_replicas=self.docker.remove_containers,
+                min_replicas=self.min_replicas,
+                max_replicas=self.max_replicas,
+                spare_replicas=self.spare_replicas,
+                scale_down_after_seconds=self.scale_down_after_seconds,
+                max_lease_wait_seconds=self.max_lease_wait_seconds,
+            )
+
+    def start_background_tasks(self) -> None:
+        assert self.pool is not None
+        self.pool.start()
+
+    def stop_background_tasks(self) -> None:
+        assert self.pool is not None
+        self.pool.shutdown()
+        try:
+            self._compose("down")
+        except Exception as e:
+            print(f"Error taking the docker compose stack down: {e}")
 
     def get_response(self, function: str, **kwargs) -> Any:  # type: ignore
         if function not in self.name_to_function:
@@ -33,23 +91,47 @@ class DockerSandboxServer(JsonRESTServer):
             "start_container": self.start_container,
             "run_command": self.run_command,
             "stop_container": self.stop_container,
+            "get_pool_stats": self.get_pool_stats,
         }
 
     def add_one(self, x: int) -> str:
         return str(x + 1)
 
+    def get_pool_stats(self) -> dict:
+        assert self.pool is not None
+        return self.pool.stats()
+
+    def extra_metrics(self) -> dict[str, int | float]:
+        stats = self.get_pool_stats()
+        return {
+            f"compose_pool_{key}": value
+            for key, value in stats.items()
+            if key not in ["min_replicas", "max_replicas"]
+        }
+
     def start_container(
-        self, container_name: str, init_command: str | None = None
+        self,
+        container_name: str,
+        init_command: str | None = None,
+        memory_gb: int | float | None = None,
+        cpus: int | None = None,
+        cache_init: bool = True,
     ) -> None:
-        if not self.docker_compose_is_up:
-            subprocess.run(
-                ["docker", "compose", "up", "-d"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+        # The replicas' resources are the ones in the compose file, not memory_gb and cpus.
+        # init_command always runs, since there is no init image cache.
+        assert self.pool is not None
+        actual_name = self.pool.lease()
+        try:
+            self._exec_or_raise(
+                actual_name,
+                snapshot_command(self.reset_paths, keep_existing=True),
+                error_message="Error snapshotting replica for resetting it",
             )
-
-        i = len(self.container_name_to_actual_name) + 1
-        self.container_name_to_actual_name[container_name] = f"docker-test-worker-{i}"
+        except Exception:
+            self.pool.release(actual_name)
+            raise
+        with self._names_lock:
+            self.container_name_to_actual_name[container_name] = actual_name
 
         if init_command is not None:
             self.run_command(container_name, init_command, timeout_seconds=30)
@@ -57,53 +139,143 @@ class DockerSandboxServer(JsonRESTServer):
     def run_command(
         self, container_name: str, command: str, timeout_seconds: int | float
     ) -> dict:
-        docker_exec_command = [
-            "docker",
-            "exec",
-            self.container_name_to_actual_name[container_name],
-            "/bin/bash",
-            "-c",
-            command,
-        ]
-
+        with self._names_lock:
+            actual_name = self.container_name_to_actual_name[container_name]
         try:
-            output = subprocess.run(
-                docker_exec_command,
-                timeout=timeout_seconds,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                errors="replace",
+            return self.docker.exec(
+                actual_name,
+                ["/bin/bash", "-c", command],
+                timeout_seconds=timeout_seconds,
             )
-        except subprocess.TimeoutExpired:
+        except TimeoutError:
             return {"returncode": 1, "stdout": "", "stderr": ""}
 
-        return {
-            "returncode": output.returncode,
-            "stdout": output.stdout,
-            "stderr": output.stderr,
-        }
-
     def stop_container(self, container_name: str) -> None:
-        del self.container_name_to_actual_name[container_name]
+        assert self.pool is not None
+        with self._names_lock:
+            actual_name = self.container_name_to_actual_name.pop(container_name)
+        self.pool.release(actual_name)
+
+    def _reset_replica(self, replica_name: str) -> None:
+        self._exec_or_raise(
+            replica_name, reset_command(), error_message="Error resetting replica"
+        )
+        if self.reset_command is not None:
+            self._exec_or_raise(
+                replica_name,
+                ["/bin/bash", "-c", self.reset_command],
+                error_message="Error running the reset command",
+            )
+
+    def _exec_or_raise(
+        self, replica_name: str, command: list[str], error_message: str
+    ) -> None:
+        output = self.docker.exec(
+            replica_name, command, timeout_seconds=self.reset_timeout_seconds
+        )
+        if output["returncode"] != 0:
+            raise Exception(
+                f"{error_message}:\nexit code: {output['returncode']}\n\nstdout: {output['stdout']}\n\nstderr: {output['stderr']}"
+            )
+
+    def _scale(self, replicas: int) -> list[str]:
+        """
+        Scales the service to `replicas` without recreating the existing ones, and returns
+        the ids of all its containers.
+        """
 
-        if len(self.container_name_to_actual_name) == 0:
-            subprocess.run(
-                ["docker", "compose", "down"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+        self._compose(
+            "up", "-d", "--no-recreate", "--scale", f"{self.service}={replicas}", self.service
+        )
+        return self._compose("ps", "--quiet", self.service).split()
+
+    def _compose(self, *arguments: str) -> str:
+        command = ["docker", "compose"]
+        if self.compose_file is not None:
+            command += ["--file", self.compose_file]
+        if self.compose_project is not None:
+            command += ["--project-name", self.compose_project]
+        process = subprocess.run(
+            command + list(arguments),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if process.returncode != 0:
+            raise Exception(
+                f"{' '.join(command + list(arguments))} failed with exit code {process.returncode}: {process.stderr}"
             )
-            self.docker_compose_is_up = False
+        return process.stdout
 
 
 @beartype
 def main():
     parser = ArgumentParser(
-        usage="`python -m remote_docker_sandbox.server` to run the server on http://0.0.0.0:8000"
+        usage="`python -m remote_docker_sandbox.server_with_docker_compose` to run the server on http://0.0.0.0:8080"
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--compose-file", type=str, default=None)
+    parser.add_argument("--compose-project", type=str, default=None)
+    parser.add_argument(
+        "--service",
+        type=str,
+        default="worker",
+        help="The docker compose service whose replicas are the sandboxes.",
+    )
+    parser.add_argument("--min-replicas", type=int, default=0)
+    parser.add_argument("--max-replicas", type=int, default=64)
+    parser.add_argument(
+        "--spare-replicas",
+        type=int,
+        default=1,
+        help="Number of free replicas to keep ready for the next sandboxes.",
+    )
+    parser.add_argument(
+        "--scale-down-after-seconds",
+        type=float,
+        default=60,
+        help="Remove the free replicas that weren't needed for this long.",
+    )
+    parser.add_argument(
+        "--max-lease-wait-seconds",
+        type=float,
+        default=30,
+        help="How long a start request waits for a free replica before the server answers that it is busy.",
+    )
+    parser.add_argument(
+        "--reset-path",
+        type=str,
+        action="append",
+        default=[],
+        help=f"A directory or file restored to what it was before the replica was first leased, when its sandbox stops. Can be repeated. Defaults to {', '.join(DEFAULT_RESET_PATHS)}.",
+    )
+    parser.add_argument(
+        "--reset-command",
+        type=str,
+        default=None,
+        help="Command run in a replica after it was reset, when its sandbox stopped, before it is leased again, e.g. to restart its services. Replicas for which the reset fails are recreated.",
     )
     arguments = parser.parse_args()
 
-    server = DockerSandboxServer()
+    server = DockerSandboxServer(
+        host=arguments.host,
+        port=arguments.port,
+        compose_file=arguments.compose_file,
+        compose_project=arguments.compose_project,
+        service=arguments.service,
+        reset_paths=(
+            arguments.reset_path
+            if len(arguments.reset_path) > 0
+            else list(DEFAULT_RESET_PATHS)
+        ),
+        reset_command=arguments.reset_command,
+        min_replicas=arguments.min_replicas,
+        max_replicas=arguments.max_replicas,
+        spare_replicas=arguments.spare_replicas,
+        scale_down_after_seconds=arguments.scale_down_after_seconds,
+        max_lease_wait_seconds=arguments.max_lease_wait_seconds,
+    )
     server.serve()
 
 
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import threading
+from argparse import ArgumentParser
+from collections import deque
+from collections.abc import Callable
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from hashlib import md5
+from time import time
+from typing import Any, no_type_check
+from uuid import uuid4
+import requests
+from beartype import beartype
+
+
+# Tracing is on in servers and gateways unless REMOTE_DOCKER_SANDBOX_TRACING=0, and only
+# on in clients if REMOTE_DOCKER_SANDBOX_TRACING=1.
+TRACING_ENABLED = os.environ.get("REMOTE_DOCKER_SANDBOX_TRACING") == "1"
+SERVER_TRACING_ENABLED = os.environ.get("REMOTE_DOCKER_SANDBOX_TRACING", "1") != "0"
+DEFAULT_MAX_SPANS = int(os.environ.get("REMOTE_DOCKER_SANDBOX_TRACE_MAX_SPANS", "100000"))
+
+# Sent by the clients with every call, so that the spans of the client, the gateway and
+# the server for one call share a request id.
+REQUEST_ID_HEADER = "X-Request-Id"
+# When the client sent the call, in seconds since the epoch, for the server's queueing
+# span. Only meaningful if the clocks of the client and the server are in sync.
+REQUEST_SENT_AT_HEADER = "X-Request-Sent-At"
+
+# The request id of the call being handled, or made, in the current thread or task.
+current_request_id: ContextVar[str | None] = ContextVar(
+    "remote_docker_sandbox_request_id", default=None
+)
+
+
+@beartype
+def new_request_id() -> str:
+    return uuid4().hex
+
+
+@beartype
+def request_headers(request_id: str) -> dict[str, str]:
+    return {REQUEST_ID_HEADER: request_id, REQUEST_SENT_AT_HEADER: repr(time())}
+
+
+@beartype
+def with_current_request_id(function: Callable) -> Callable:
+    """
+    `function`, run with the current request id wherever it is called, e.g. by a thread
+    pool, so that its spans count for the request that submitted it.
+    """
+
+    request_id = current_request_id.get()
+
+    def run(*args, **kwargs):
+        token = current_request_id.set(request_id)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_request_id.reset(token)
+
+    return run
+
+
+@beartype
+@dataclass
+class Tracer:
+    """
+    Records spans, (name, request id, start, end, thread, attributes) tuples with times in
+    seconds since the epoch, in a ring buffer of the last `max_spans` of them, and exports
+    them as Chrome trace (chrome://tracing, Perfetto) or OTLP JSON.
+
+    Recording a span only takes two clock reads and an append, so servers trace unless
+    REMOTE_DOCKER_SANDBOX_TRACING=0 (see `JsonRESTServer.serve`). Clients only do if
+    REMOTE_DOCKER_SANDBOX_TRACING=1, not to keep spans nobody fetches.
+    """
+
+    enabled: bool = TRACING_ENABLED
+    max_spans: int = DEFAULT_MAX_SPANS
+    service_name: str = os.path.basename(sys.argv[0]) or "python"
+    _spans: Any = None
+    _lock: Any = field(default_factory=lambda: threading.Lock())
+
+    def __post_init__(self) -> None:
+        self._spans = deque(maxlen=self.max_spans)
+
+    # The methods called for every span aren't type checked, which would make them a few
+    # times slower.
+    @no_type_check
+    def span(self, name: str, **attributes: Any) -> "_Span":
+        """
+        A context manager recording a span from its start to its end, for the current
+        request id.
+        """
+
+        return _Span(self, name, attributes)
+
+    @no_type_check
+    def record(self, name: str, start: float, end: float, **attributes: Any) -> None:
+        if not self.enabled:
+            return
+        span = (
+            name,
+            current_request_id.get(),
+            start,
+            end,
+            threading.get_native_id(),
+            attributes,
+        )
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self, since: float | None = None) -> list[tuple]:
+        """
+        The recorded spans, only the ones that ended after `since` if given.
+        """
+
+        with self._lock:
+            spans = list(self._spans)
+        if since is not None:
+            spans = [span for span in spans if span[3] > since]
+        return spans
+
+    def chrome_trace(self, since: float | None = None) -> dict:
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "cat": self.service_name,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": pid,
+                    "tid": thread,
+                    "args": {"request_id": request_id, **attributes},
+                }
+                for name, request_id, start, end, thread, attributes in self.spans(since)
+            ]
+            + [
+                {
+                    "name": "process_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "args": {"name": f"{self.service_name} ({pid})"},
+                }
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def otlp_trace(self, since: float | None = None) -> dict:
+        """
+        The spans as an OTLP/JSON ExportTraceServiceRequest. The trace id comes from the
+        request id (see `otlp_trace_id`), and the spans of a trace have no parents, since
+        they are recorded separately in every process.
+        """
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            otlp_attribute("service.name", self.service_name),
+                            otlp_attribute("process.pid", os.getpid()),
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "remote_docker_sandbox"},
+                            "spans": [
+                                {
+                                    "traceId": otlp_trace_id(
+                                        request_id, f"{name}{start}{thread}"
+                                    ),
+                                    "spanId": md5(
+                                        f"{name}{request_id}{start}{thread}".encode()
+                                    ).hexdigest()[:16],
+                                    "name": name,
+                                    "kind": 1,
+                                    "startTimeUnixNano": str(int(start * 1e9)),
+                                    "endTimeUnixNano": str(int(end * 1e9)),
+                                    "attributes": [
+                                        otlp_attribute("thread.id", thread)
+                                    ]
+                                    + [
+                                        otlp_attribute(key, value)
+                                        for key, value in attributes.items()
+                                    ],
+                                }
+                                for name, request_id, start, end, thread, attributes in self.spans(
+                                    since
+                                )
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def trace(self, format: str = "chrome", since: float | None = None) -> dict:
+        if format == "chrome":
+            return self.chrome_trace(since)
+        if format == "otlp":
+            return self.otlp_trace(since)
+        raise ValueError(f'Invalid trace format "{format}". Must be one of "chrome", "otlp".')
+
+    def write(self, path: str, format: str = "chrome", since: float | None = None) -> None:
+        with open(path, "w") as f:
+            json.dump(self.trace(format, since), f)
+
+
+class _Span:
+    # Not type checked either.
+    __slots__ = ("tracer", "name", "attributes", "start")
+
+    def __init__(self, tracer: Tracer, name: str, attributes: dict) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start = 0.0
+
+    def __enter__(self) -> "_Span":
+        self.start = time()
+        return self
+
+    def __exit__(self, exception_type: Any, *exception_info: Any) -> None:
+        if exception_type is not None:
+            self.attributes["error"] = exception_type.__name__
+        self.tracer.record(self.name, self.start, time(), **self.attributes)
+
+
+@beartype
+def otlp_trace_id(request_id: str | None, span_key: str) -> str:
+    """
+    An OTLP trace id, 32 lowercase hex characters and not all zeros, for the spans of
+    `request_id`: the request id itself if it is one already, like the ids the clients
+    make, otherwise its md5 hash, since any X-Request-Id header is accepted. Spans without
+    a request id get a trace of their own, from `span_key`.
+    """
+
+    if request_id is None:
+        return md5(span_key.encode()).hexdigest()
+    if (
+        len(request_id) == 32
+        and all(c in "0123456789abcdef" for c in request_id)
+        and request_id != "0" * 32
+    ):
+        return request_id
+    return md5(request_id.encode()).hexdigest()
+
+
+@beartype
+def otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+@beartype
+def merge_traces(traces: list[dict], format: str = "chrome") -> dict:
+    """
+    One trace with the spans of `traces`, e.g. of a client and of the servers it used.
+    """
+
+    if format == "chrome":
+        return {
+            "traceEvents": [event for trace in traces for event in trace["traceEvents"]],
+            "displayTimeUnit": "ms",
+        }
+    return {
+        "resourceSpans": [
+            resource_spans
+            for trace in traces
+            for resource_spans in trace["resourceSpans"]
+        ]
+    }
+
+
+tracer = Tracer()
+
+
+@beartype
+def main() -> None:
+    parser = ArgumentParser(
+        description="Fetch the spans recorded by remote docker sandbox servers or gateways and write them to one trace file, to open in chrome://tracing or Perfetto, or to send to an OTLP collector."
+    )
+    parser.add_argument(
+        "--server-url", type=str, action="append", required=True, help="Can be repeated."
+    )
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--format", type=str, choices=["chrome", "otlp"], default="chrome")
+    parser.add_argument(
+        "--since", type=float, default=None, help="Only the spans that ended after this time, in seconds since the epoch."
+    )
+    arguments = parser.parse_args()
+
+    traces = []
+    for server_url in arguments.server_url:
+        params: dict[str, Any] = {"format": arguments.format}
+        if arguments.since is not None:
+            params["since"] = arguments.since
+        response = requests.get(f"{server_url}/get_trace", params=params, timeout=600)
+        response.raise_for_status()
+        traces.append(response.json())
+
+    with open(arguments.output, "w") as f:
+        json.dump(merge_traces(traces, format=arguments.format), f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+from threading import Lock, Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from collections.abc import Callable
+from time import monotonic
+from uuid import uuid4
+import traceback
+import atexit
+from typing import Any
+from beartype import beartype
+
+
+@beartype
+@dataclass(frozen=True)
+class ContainerShape:
+    memory_gb: int | float
+    cpus: int
+    image_name: str
+
+
+@beartype
+@dataclass
+class WarmContainerPool:
+    """
+    Keeps `size_per_shape` already running containers for every shape that was either
+    configured up front or requested recently, so that `claim` can hand one out without
+    paying for a cold `docker run`.
+
+    Since the shapes requested come from the clients, at most `max_learned_shapes` of
+    them are kept warm besides the configured `shapes`, and they are dropped once they
+    weren't claimed for `learned_shape_ttl_seconds`.
+
+    `create_container(name, shape)` must start a detached container and raise on failure.
+    `remove_container(name)` is used to get rid of unclaimed containers. If given, `fits()`
+    tells whether the containers of the pool, including the ones being created, fit in
+    the capacity left by the containers in use. No more are created while they don't.
+    """
+
+    create_container: Callable[[str, ContainerShape], None]
+    remove_container: Callable[[str], None]
+    size_per_shape: int = 0
+    shapes: list[ContainerShape] = field(default_factory=lambda: [])
+    max_learned_shapes: int = 8
+    learned_shape_ttl_seconds: int | float = 600
+    fits: Callable[[], bool] | None = None
+    refill_concurrency: int = 8
+    retry_after_failure_seconds: float = 5.0
+    hits: int = 0
+    misses: int = 0
+    failed_creations: int = 0
+    evictions: int = 0
+    _ready: dict[ContainerShape, list[str]] = field(default_factory=lambda: {})
+    _filling: dict[ContainerShape, int] = field(default_factory=lambda: {})
+    _last_claimed: dict[ContainerShape, float] = field(default_factory=lambda: {})
+    _lock: Any = field(default_factory=lambda: Lock())
+    _refill_needed: Any = field(default_factory=lambda: Event())
+    _stopped: Any = field(default_factory=lambda: Event())
+    _thread: Thread | None = None
+
+    def __post_init__(self) -> None:
+        for shape in self.shapes:
+            self._ready.setdefault(shape, [])
+            self._filling.setdefault(shape, 0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.size_per_shape > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = Thread(target=self._refill_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def claim(self, shape: ContainerShape) -> str | None:
+        """
+        Returns the name of a running container of the given shape, which the caller now
+        owns, or None if no warm container is available.
+        """
+
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if shape not in self._ready and len(self._ready) - len(
+                set(self.shapes)
+            ) < self.max_learned_shapes:
+                self._ready[shape] = []
+                self._filling.setdefault(shape, 0)
+            if shape in self._ready:
+                self._last_claimed[shape] = monotonic()
+            ready = self._ready.get(shape, [])
+            container_name = ready.pop() if len(ready) > 0 else None
+            if container_name is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        self._refill_needed.set()
+        return container_name
+
+    def reserved(self) -> tuple[int | float, int]:
+        """
+        The memory in GB and the cpus of the ready containers and of the ones being
+        created.
+        """
+
+        with self._lock:
+            counts = [
+                (shape, len(self._ready.get(shape, [])) + filling)
+                for shape, filling in self._filling.items()
+            ]
+        return (
+            sum(shape.memory_gb * count for shape, count in counts),
+            sum(shape.cpus * count for shape, count in counts),
+        )
+
+    def evict(
+        self, memory_gb: int | float, cpus: int | float, keep: ContainerShape | None = None
+    ) -> None:
+        """
+        Removes ready containers until at least `memory_gb` and `cpus` are freed, or none
+        is left but one of the `keep` shape, e.g. the one about to be claimed. The ones of
+        learned shapes go first.
+        """
+
+        to_remove = []
+        with self._lock:
+            shapes = sorted(self._ready.keys(), key=lambda shape: shape in self.shapes)
+            for shape in shapes:
+                ready = self._ready[shape]
+                while (memory_gb > 0 or cpus > 0) and len(ready) > (
+                    1 if shape == keep else 0
+                ):
+                    to_remove.append(ready.pop(0))
+                    memory_gb -= shape.memory_gb
+                    cpus -= shape.cpus
+            self.evictions += len(to_remove)
+        self._remove(to_remove)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size_per_shape": self.size_per_shape,
+                "hits": self.hits,
+                "misses": self.misses,
+                "failed_creations": self.failed_creations,
+                "evictions": self.evictions,
+                "shapes": [
+                    {
+                        "memory_gb": shape.memory_gb,
+                        "cpus": shape.cpus,
+                        "image_name": shape.image_name,
+                        "ready": len(self._ready[shape]),
+                        "filling": self._filling[shape],
+                    }
+                    for shape in self._ready.keys()
+                ],
+            }
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self._refill_needed.set()
+        with self._lock:
+            container_names = [
+                name for ready in self._ready.values() for name in ready
+            ]
+            for ready in self._ready.values():
+                ready.clear()
+        self._remove(container_names)
+
+    def _remove(self, container_names: list[str]) -> None:
+        for container_name in container_names:
+            try:
+                self.remove_container(container_name)
+            except Exception as e:
+                print(f"Error removing warm pool container {container_name}: {e}")
+
+    def _refill_loop(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.refill_concurrency) as executor:
+            while not self._stopped.is_set():
+                self._refill_needed.clear()
+                self._drop_expired_shapes()
+
+                with self._lock:
+                    to_create: list[ContainerShape] = []
+                    for shape, ready in self._ready.items():
+                        missing = self.size_per_shape - len(ready) - self._filling[shape]
+                        to_create += [shape] * max(missing, 0)
+
+                for shape in to_create:
+                    with self._lock:
+                        if shape not in self._ready:
+                            continue
+                        self._filling[shape] += 1
+                    if self.fits is not None and not self.fits():
+                        with self._lock:
+                            self._filling[shape] -= 1
+                        break
+                    executor.submit(self._create_one, shape)
+
+                self._refill_needed.wait(timeout=self.retry_after_failure_seconds)
+
+    def _drop_expired_shapes(self) -> None:
+        now = monotonic()
+        to_remove = []
+        with self._lock:
+            for shape in list(self._ready.keys()):
+                if (
+                    shape not in self.shapes
+                    and now - self._last_claimed.get(shape, now)
+                    > self.learned_shape_ttl_seconds
+                ):
+                    to_remove += self._ready.pop(shape)
+                    # The ones being created are removed once they are.
+                    if self._filling[shape] == 0:
+                        del self._filling[shape]
+                    del self._last_claimed[shape]
+        self._remove(to_remove)
+
+    def _create_one(self, shape: ContainerShape) -> None:
+        container_name = f"docker-sandbox-pool-{uuid4()}"
+        try:
+            self.create_container(container_name, shape)
+        except Exception as e:
+            print(
+                f"Error creating warm pool container of shape {shape}: {e}\n{traceback.format_exc()}"
+            )
+            with self._lock:
+                self._filling_done(shape)
+                self.failed_creations += 1
+            return
+
+        # Containers started since the creation began may have taken the capacity.
+        fits = self.fits is None or self.fits()
+        with self._lock:
+            self._filling_done(shape)
+            keep = fits and not self._stopped.is_set() and shape in self._ready
+            if keep:
+                self._ready[shape].append(container_name)
+
+        if not keep:
+            self._remove([container_name])
+
+    def _filling_done(self, shape: ContainerShape) -> None:
+        self._filling[shape] -= 1
+        # Of a shape dropped while the container was being created.
+        if self._filling[shape] == 0 and shape not in self._ready:
+            del self._filling[shape]
@@ -0,0 +1,255 @@
+import gzip
+import io
+import json
+import os
+from typing import Any
+from beartype import beartype
+
+# Both optional, installed with the "fast" extra: without them, bodies are json,
+# compressed with gzip only.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+# Smaller bodies are sent uncompressed, compressing them costs more time than it saves.
+COMPRESSION_THRESHOLD_BYTES = int(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_COMPRESSION_THRESHOLD_BYTES", "4096")
+)
+
+
+# Bodies that decompress to more than this are refused, so that a small compressed body
+# can't exhaust the memory of the process reading it.
+MAX_DECOMPRESSED_BYTES = int(
+    os.environ.get("REMOTE_DOCKER_SANDBOX_MAX_DECOMPRESSED_BYTES", str(1024**3))
+)
+
+DECOMPRESSION_CHUNK_BYTES = 2**20
+
+
+class UnsupportedWireFormat(ValueError):
+    pass
+
+
+class DecompressedBodyTooLarge(ValueError):
+    pass
+
+
+@beartype
+def supported_content_types() -> list[str]:
+    """
+    The body encodings this process can read and write, the preferred one first. msgpack
+    carries stdout and stderr as raw utf-8 instead of escaped json strings.
+    """
+
+    return ([MSGPACK_CONTENT_TYPE] if msgpack is not None else []) + [
+        JSON_CONTENT_TYPE
+    ]
+
+
+@beartype
+def supported_encodings() -> list[str]:
+    """
+    The compressions this process can read and write, the preferred one first.
+    """
+
+    return (["zstd"] if zstandard is not None else []) + ["gzip"]
+
+
+@beartype
+def parse_header_list(header: str | None) -> list[str]:
+    """
+    The values of a comma separated header like Accept or Accept-Encoding, in order and
+    without their parameters, leaving out the ones with q=0.
+    """
+
+    if header is None:
+        return []
+    values = []
+    for item in header.split(","):
+        value, *parameters = [part.strip() for part in item.split(";")]
+        if value == "":
+            continue
+        if any(quality(parameter) == 0 for parameter in parameters):
+            continue
+        values.append(value.lower())
+    return values
+
+
+@beartype
+def quality(parameter: str) -> float | None:
+    name, _, value = parameter.partition("=")
+    if name.strip().lower() != "q":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+@beartype
+def choose_content_type(accept: str | None) -> str:
+    """
+    msgpack if the peer asked for it explicitly, json otherwise, so that clients that
+    don't know about msgpack, which send no Accept header or */*, keep getting json.
+    """
+
+    accepted = parse_header_list(accept)
+    if (
+        MSGPACK_CONTENT_TYPE in accepted
+        and MSGPACK_CONTENT_TYPE in supported_content_types()
+    ):
+        return MSGPACK_CONTENT_TYPE
+    return JSON_CONTENT_TYPE
+
+
+@beartype
+def choose_encoding(accepted_encodings: list[str], size: int) -> str | None:
+    if size < COMPRESSION_THRESHOLD_BYTES:
+        return None
+    for encoding in supported_encodings():
+        if encoding in accepted_encodings:
+            return encoding
+    return None
+
+
+@beartype
+def dumps(obj: Any, content_type: str) -> bytes:
+    if content_type == MSGPACK_CONTENT_TYPE:
+        assert msgpack is not None
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj).encode()
+
+
+@beartype
+def loads(data: bytes, content_type: str | None) -> Any:
+    """
+    `content_type` is the value of a Content-Type header. Missing means json.
+    """
+
+    media_types = parse_header_list(content_type)
+    media_type = media_types[0] if len(media_types) > 0 else JSON_CONTENT_TYPE
+    if media_type == MSGPACK_CONTENT_TYPE:
+        if msgpack is None:
+            raise UnsupportedWireFormat(
+                "Received a msgpack body, but msgpack isn't installed."
+            )
+        return msgpack.unpackb(data, raw=False)
+    if media_type != JSON_CONTENT_TYPE:
+        raise UnsupportedWireFormat(
+            f'Unsupported content type "{media_type}". Must be one of {", ".join(supported_content_types())}.'
+        )
+    return json.loads(data)
+
+
+@beartype
+def compress(data: bytes, encoding: str | None) -> bytes:
+    if encoding is None:
+        return data
+    if encoding == "zstd":
+        assert zstandard is not None
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=5)
+    raise UnsupportedWireFormat(f'Unsupported content encoding "{encoding}".')
+
+
+@beartype
+def decompress(
+    data: bytes, encoding: str | None, max_bytes: int = MAX_DECOMPRESSED_BYTES
+) -> bytes:
+    """
+    `encoding` is the value of a Content-Encoding header. Raises
+    DecompressedBodyTooLarge as soon as more than `max_bytes` come out.
+    """
+
+    if encoding is None or encoding.strip().lower() in ["", "identity"]:
+        return data
+    encoding = encoding.strip().lower()
+    if encoding == "zstd" and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True
+        )
+    elif encoding in ["gzip", "x-gzip"]:
+        reader = gzip.GzipFile(fileobj=io.BytesIO(data))
+    else:
+        raise UnsupportedWireFormat(f'Unsupported content encoding "{encoding}".')
+
+    chunks = []
+    size = 0
+    with reader:
+        while True:
+            chunk = reader.read(DECOMPRESSION_CHUNK_BYTES)
+            if len(chunk) == 0:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise DecompressedBodyTooLarge(
+                    f"The {encoding} body decompresses to more than {max_bytes} bytes."
+                )
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+@beartype
+def encode_body(
+    obj: Any, content_type: str, accepted_encodings: list[str]
+) -> tuple[bytes, dict[str, str]]:
+    """
+    The body and the Content-Type and Content-Encoding headers for sending `obj` to a
+    peer that reads `accepted_encodings`.
+    """
+
+    body = dumps(obj, content_type)
+    encoding = choose_encoding(accepted_encodings, len(body))
+    headers = {"Content-Type": content_type}
+    if encoding is not None:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return body, headers
+
+
+@beartype
+def decode_body(
+    data: bytes, content_type: str | None, content_encoding: str | None
+) -> Any:
+    return loads(decompress(data, content_encoding), content_type)
+
+
+@beartype
+def accept_headers(encodings: list[str]) -> dict[str, str]:
+    """
+    The headers asking a server for the response formats this process reads, where
+    `encodings` are the compressions the http client can undo.
+    """
+
+    return {
+        "Accept": ", ".join(supported_content_types()),
+        "Accept-Encoding": ", ".join(
+            encoding for encoding in supported_encodings() if encoding in encodings
+        )
+        or "identity",
+    }
+
+
+# Server url -> the request body compressions the server advertised with an
+# Accept-Encoding response header. Servers that never did are sent plain json.
+_server_accept_encodings: dict[str, list[str]] = {}
+
+
+@beartype
+def remember_server_accept_encodings(server_url: str, header: str | None) -> None:
+    _server_accept_encodings[server_url] = parse_header_list(header)
+
+
+@beartype
+def server_accept_encodings(server_url: str) -> list[str]:
+    return _server_accept_encodings.get(server_url, [])
@@ -0,0 +1,89 @@
+import os
+import signal
+import socket
+import traceback
+from collections.abc import Callable
+from time import monotonic, sleep
+from typing import Any
+from beartype import beartype
+
+# Workers that exit sooner than this after being started are restarted only after this
+# long, so that a worker that can't start doesn't get forked in a tight loop.
+MIN_WORKER_LIFETIME_SECONDS = 1
+
+
+@beartype
+def serve_in_worker_processes(
+    serve_worker: Callable[[Any], None],
+    host: str,
+    port: int,
+    workers: int,
+    on_worker_exit: Callable[[int], None] = lambda pid: None,
+) -> None:
+    """
+    Binds `host`:`port` and forks `workers` processes that all accept the connections of
+    that socket, each running `serve_worker(listen_socket)`, so that requests are handled
+    by several Python interpreters instead of contending for one GIL.
+
+    A worker that exits while the server isn't shutting down is restarted, after
+    `on_worker_exit(pid)` is called with its pid. SIGTERM and SIGINT are forwarded to the
+    workers, which shut down gracefully, and this returns once they all exited.
+    """
+
+    listen_socket = socket.create_server((host, port))
+    worker_started_at: dict[int, float] = {}
+    stopping = False
+
+    def start_worker() -> None:
+        pid = os.fork()
+        if pid != 0:
+            worker_started_at[pid] = monotonic()
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            serve_worker(listen_socket)
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def handle_shutdown_signal(signal_number, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in worker_started_at:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+
+    print(f"Serving on http://{host}:{port} with {workers} worker processes.")
+    for _ in range(workers):
+        start_worker()
+
+    while len(worker_started_at) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started_at = worker_started_at.pop(pid, None)
+        if started_at is None:
+            continue
+        on_worker_exit(pid)
+        if stopping:
+            continue
+        print(
+            f"Worker process {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting it."
+        )
+        if monotonic() - started_at < MIN_WORKER_LIFETIME_SECONDS:
+            sleep(MIN_WORKER_LIFETIME_SECONDS)
+            if stopping:
+                continue
+        start_worker()
+
+    listen_socket.close()
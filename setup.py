@@ -4,6 +4,7 @@ setup(
     name="remote_docker_sandbox",
     version="0.1.0",
     packages=find_packages(),
-    install_requires=["Flask==3.1.0", "Requests==2.32.3", "beartype", "setuptools", "plotly"],
+    install_requires=["Flask==3.1.0", "Requests==2.32.3", "beartype", "setuptools", "plotly", "waitress"],
+    extras_require={"fast": ["msgpack>=1.0.0", "zstandard>=0.22.0"]},
     include_package_data=True,
 )
@@ -0,0 +1,68 @@
+import time
+from threading import Thread
+
+import pytest
+
+from remote_docker_sandbox.fake_docker_backend import FakeDockerBackend
+from remote_docker_sandbox.rest_server_base import ServerBusy
+from remote_docker_sandbox.server import DockerSandboxServer
+
+
+def wait_until(condition) -> None:
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_starts_are_admitted_in_order_and_time_out():
+    server = DockerSandboxServer(
+        docker=FakeDockerBackend(),
+        capacity_memory_gb=2,
+        max_admission_wait_seconds=2,
+        max_queued_starts=2,
+        busy_retry_after_seconds=7,
+        remove_orphans_at_startup=False,
+    )
+    server.start_background_tasks()
+    admitted: list[str] = []
+    errors: dict[str, Exception] = {}
+
+    def start(container_name: str, memory_gb: int) -> None:
+        try:
+            server.start_container(container_name, None, memory_gb=memory_gb, cpus=1)
+            admitted.append(container_name)
+        except Exception as e:
+            errors[container_name] = e
+
+    try:
+        start("running", memory_gb=1)
+        server._wait_until_started("running")
+
+        threads = []
+        for container_name, memory_gb in [("big", 2), ("small", 1)]:
+            threads.append(Thread(target=start, args=(container_name, memory_gb)))
+            threads[-1].start()
+            wait_until(lambda: len(server._admission_queue) == len(threads))
+        time.sleep(0.2)
+        # The small start would fit, but waits for the big one that came first.
+        assert admitted == ["running"]
+
+        # The queue is full.
+        with pytest.raises(ServerBusy) as rejected:
+            server.start_container("rejected", None, memory_gb=1, cpus=1)
+        assert rejected.value.retry_after_seconds == 7
+
+        server.stop_container("running")
+        wait_until(lambda: "big" in admitted)
+        # The big container takes the whole capacity, so the small start times out.
+        for thread in threads:
+            thread.join()
+        assert admitted == ["running", "big"]
+        assert isinstance(errors["small"], ServerBusy)
+        assert errors["small"].retry_after_seconds == 7
+        assert server.admission_rejections == 2
+        assert len(server._admission_queue) == 0
+        server.stop_container("big")
+    finally:
+        server.stop_background_tasks()
@@ -0,0 +1,26 @@
+import io
+import tarfile
+
+from remote_docker_sandbox import archive
+from remote_docker_sandbox.archive import read_archive, stream_archive
+
+
+def test_streamed_archive_is_a_valid_tar(monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_CHUNK_BYTES", 1000)
+    chunks = list(
+        stream_archive([("/app/big.bin", b"x" * 2500), ("/app/dir/empty", b"")])
+    )
+
+    # The header, then the content in slices.
+    assert [len(chunk) for chunk in chunks[:4]] == [512, 1000, 1000, 500]
+    data = b"".join(chunks)
+    assert len(data) % tarfile.RECORDSIZE == 0
+    assert read_archive(io.BytesIO(data)) == {
+        "/app/big.bin": b"x" * 2500,
+        "/app/dir/empty": b"",
+    }
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert [(member.name, member.mode) for member in tar] == [
+            ("app/big.bin", 0o644),
+            ("app/dir/empty", 0o644),
+        ]
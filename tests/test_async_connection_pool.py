@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from remote_docker_sandbox.async_rest_client_base import AsyncHTTPConnectionPool
+
+OK_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\nok"
+
+
+async def serve(answers: list[bytes]) -> tuple[asyncio.AbstractServer, list[bytes]]:
+    """
+    A server that reads requests and answers the i-th one with `answers[i]`, closing the
+    connection right after the answers that aren't a full response.
+    """
+
+    received: list[bytes] = []
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            try:
+                request = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            received.append(request)
+            answer = answers[len(received) - 1]
+            writer.write(answer)
+            await writer.drain()
+            if answer != OK_RESPONSE:
+                break
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, received
+
+
+async def request_twice(answers: list[bytes]) -> tuple[list[bytes], Exception | None]:
+    server, received = await serve(answers)
+    port = server.sockets[0].getsockname()[1]
+    pool = AsyncHTTPConnectionPool(server_url=f"http://127.0.0.1:{port}")
+    error = None
+    try:
+        assert (await pool.request("POST", "/process"))[2] == b"ok"
+        await pool.request("POST", "/process")
+    except Exception as e:
+        error = e
+    finally:
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+    return received, error
+
+
+def test_requests_closed_before_any_response_byte_are_retried():
+    # The second request finds the kept-alive connection closed by the server.
+    received, error = asyncio.run(request_twice([OK_RESPONSE, b"", OK_RESPONSE]))
+    assert error is None
+    assert len(received) == 3
+
+
+def test_requests_closed_during_the_response_are_not_sent_again():
+    received, error = asyncio.run(
+        request_twice([OK_RESPONSE, b"HTTP/1.1 200 OK\r\n", OK_RESPONSE])
+    )
+    assert isinstance(error, asyncio.IncompleteReadError)
+    # The server may have run the call, so it isn't sent a second time.
+    assert len(received) == 2
+
+
+def test_requests_on_new_connections_are_not_retried():
+    received, error = asyncio.run(request_twice([b"", OK_RESPONSE]))
+    assert isinstance(error, ConnectionError)
+    assert len(received) == 1
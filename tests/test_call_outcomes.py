@@ -0,0 +1,18 @@
+from remote_docker_sandbox.circuit_breaker import server_health
+from remote_docker_sandbox.client import record_call_outcome
+
+
+def test_call_outcomes_feed_the_server_health():
+    server_url = "http://call-outcomes.invalid:8080"
+
+    record_call_outcome(server_url, "run_command", 200)
+    record_call_outcome(server_url, "run_command", 503)
+    record_call_outcome(server_url, "run_command", 500)
+    record_call_outcome(server_url, "run_command", None, "Connection refused")
+    # Counted by should_retry_start instead.
+    record_call_outcome(server_url, "start_container", None, "Connection refused")
+
+    health = server_health.states([server_url])[server_url]
+    assert (health["successes"], health["failures"]) == (1, 2)
+    assert health["consecutive_failures"] == 2
+    assert health["last_error"] == "Connection refused"
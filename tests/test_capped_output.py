@@ -0,0 +1,34 @@
+from remote_docker_sandbox.capped_output import CappedOutput
+
+
+def test_characters_split_between_head_and_tail_stay_whole():
+    # "é" is 2 bytes, so with a head of 3 bytes the second one straddles the boundary.
+    output = CappedOutput(max_bytes=6)
+    streamed = output.append("ééé".encode())
+
+    assert output.text() == "ééé"
+    assert streamed + output.tail_text() == "ééé"
+
+
+def test_characters_split_by_the_truncation_are_dropped_with_it():
+    output = CappedOutput(max_bytes=6)
+    streamed = output.append("éééééé".encode())
+
+    assert output.text() == "é\n[... 8 bytes truncated ...]\né"
+    assert streamed + output.tail_text() == "é\n[... 8 bytes truncated ...]\né"
+
+
+def test_output_appended_byte_by_byte():
+    output = CappedOutput(max_bytes=100)
+    streamed = "".join(output.append(bytes([byte])) for byte in "héllo wörld".encode())
+
+    assert streamed + output.tail_text() == "héllo wörld"
+    assert output.text() == "héllo wörld"
+
+
+def test_uncapped_output():
+    output = CappedOutput()
+    streamed = output.append("é".encode()[:1]) + output.append("é".encode()[1:])
+
+    assert streamed + output.tail_text() == "é"
+    assert output.text() == "é"
@@ -0,0 +1,76 @@
+from remote_docker_sandbox.command_list_runner import TIMED_OUT_RESULT, run_command_list
+from remote_docker_sandbox.fake_docker_backend import FakeDockerBackend
+
+
+class ScriptedRunnerDockerBackend(FakeDockerBackend):
+    """
+    Answers the runner's exec with what `RUNNER_SCRIPT` would print for `outcomes`, one
+    (returncode, timed out, stdout, stderr) per command, in chunks of `chunk_size` bytes
+    that split the sentinels, and then times out if `exec_times_out`.
+    """
+
+    def __init__(self, outcomes, chunk_size: int, exec_times_out: bool = False) -> None:
+        super().__init__()
+        self.outcomes = outcomes
+        self.chunk_size = chunk_size
+        self.exec_times_out = exec_times_out
+
+    def exec_streaming(self, container_name, command, timeout_seconds=None):
+        sentinel = command[4].encode()
+        for returncode, timed_out, stdout, stderr in self.outcomes:
+            stdout += b"\n%s %d %d\n" % (sentinel, returncode, timed_out)
+            stderr += b"\n%s\n" % sentinel
+            for i in range(0, max(len(stdout), len(stderr)), self.chunk_size):
+                if i < len(stdout):
+                    yield "stdout", stdout[i : i + self.chunk_size]
+                if i < len(stderr):
+                    yield "stderr", stderr[i : i + self.chunk_size]
+        if self.exec_times_out:
+            raise TimeoutError(f"Command {command} in {container_name} timed out.")
+        yield "returncode", 0
+
+
+def run(docker: FakeDockerBackend, commands: list[str]) -> list[dict]:
+    return run_command_list(
+        docker.exec_streaming,
+        "docker-sandbox-1",
+        commands,
+        total_timeout_seconds=10,
+        per_command_timeout_seconds=5,
+    )
+
+
+def test_outputs_are_split_at_sentinels_across_chunks():
+    commands = [
+        "echo one",
+        "sleep 100",
+        "printf 'two\\nthree' >&2; exit 2",
+        "head -c 1000 /dev/zero | tr '\\0' x",
+    ]
+    outcomes = [
+        (0, 0, b"one\n", b""),
+        (137, 1, b"partial output", b""),
+        (2, 0, b"", b"two\nthree"),
+        # Longer than what is kept to find a sentinel in.
+        (0, 0, b"x" * 1000, b""),
+    ]
+    for chunk_size in [1, 3, 7, 1000]:
+        docker = ScriptedRunnerDockerBackend(outcomes, chunk_size=chunk_size)
+        assert run(docker, commands) == [
+            {"returncode": 0, "stdout": "one\n", "stderr": ""},
+            TIMED_OUT_RESULT,
+            {"returncode": 2, "stdout": "", "stderr": "two\nthree"},
+            {"returncode": 0, "stdout": "x" * 1000, "stderr": ""},
+        ]
+
+
+def test_commands_after_the_exec_timed_out_are_reported_as_timed_out():
+    commands = ["echo one", "sleep 100", "echo never"]
+    docker = ScriptedRunnerDockerBackend(
+        [(0, 0, b"one\n", b"")], chunk_size=5, exec_times_out=True
+    )
+    assert run(docker, commands) == [
+        {"returncode": 0, "stdout": "one\n", "stderr": ""},
+        TIMED_OUT_RESULT,
+        TIMED_OUT_RESULT,
+    ]
@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+from remote_docker_sandbox.compose_replica_pool import ComposeReplicaPool
+from remote_docker_sandbox.rest_server_base import ServerBusy
+
+
+class FakeService:
+    """
+    A docker compose service whose scale, reset and remove only update a list of names.
+    """
+
+    def __init__(self, leftover_replicas: list[str] | None = None) -> None:
+        self.replicas = list(leftover_replicas or [])
+        self.created = len(self.replicas)
+        self.resets: list[str] = []
+        self.removed: list[str] = []
+        self.failing_resets: set[str] = set()
+
+    def scale(self, replicas: int) -> list[str]:
+        while len(self.replicas) < replicas:
+            self.created += 1
+            self.replicas.append(f"replica-{self.created}")
+        return list(self.replicas)
+
+    def reset(self, replica_name: str) -> None:
+        self.resets.append(replica_name)
+        if replica_name in self.failing_resets:
+            raise Exception(f"Error resetting {replica_name}")
+
+    def remove(self, replica_names: list[str]) -> None:
+        self.removed += replica_names
+        self.replicas = [name for name in self.replicas if name not in replica_names]
+
+
+def make_pool(service: FakeService, **kwargs) -> ComposeReplicaPool:
+    """
+    A pool after its first scale, which the background thread would have done.
+    """
+
+    pool = ComposeReplicaPool(
+        scale=service.scale,
+        reset_replica=service.reset,
+        remove_replicas=service.remove,
+        **kwargs,
+    )
+    pool._scale_once(first_scale=True)
+    wait_until_reset(pool)
+    return pool
+
+
+def wait_until_reset(pool: ComposeReplicaPool) -> None:
+    deadline = time.monotonic() + 10
+    while pool.stats()["resetting"] > 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_leftover_replicas_are_reset_before_they_are_leased():
+    service = FakeService(leftover_replicas=["leftover-1", "leftover-2"])
+    pool = make_pool(service, spare_replicas=1)
+
+    assert sorted(service.resets) == ["leftover-1", "leftover-2"]
+    assert pool.stats()["free"] == 2
+    assert pool.lease() in ["leftover-1", "leftover-2"]
+
+
+def test_released_replicas_are_reset_and_leased_again_most_recently_used_first():
+    service = FakeService()
+    pool = make_pool(service, spare_replicas=2)
+
+    first = pool.lease()
+    second = pool.lease()
+    pool.release(first)
+    wait_until_reset(pool)
+    pool.release(second)
+    wait_until_reset(pool)
+    # Releasing twice does nothing.
+    pool.release(second)
+
+    assert service.resets[-2:] == [first, second]
+    assert pool.stats()["resets"] == 4
+    assert pool.lease() == second
+
+
+def test_replicas_whose_reset_fails_are_removed_and_recreated():
+    service = FakeService()
+    pool = make_pool(service, spare_replicas=1)
+
+    replica_name = pool.lease()
+    service.failing_resets.add(replica_name)
+    pool.release(replica_name)
+    wait_until_reset(pool)
+
+    assert service.removed == [replica_name]
+    assert pool.stats()["failed_resets"] == 1
+    assert pool.stats()["replicas"] == 0
+
+    pool._scale_once(first_scale=False)
+    assert pool.lease() != replica_name
+
+
+def test_the_service_grows_with_the_leases_up_to_max_replicas():
+    service = FakeService()
+    pool = make_pool(service, spare_replicas=1, max_replicas=3, max_lease_wait_seconds=0.1)
+    assert pool.stats()["replicas"] == 1
+
+    for _ in range(3):
+        pool.lease()
+        pool._scale_once(first_scale=False)
+    assert pool.stats()["replicas"] == 3
+    assert pool.stats()["leased"] == 3
+
+    with pytest.raises(ServerBusy):
+        pool.lease()
+    assert pool.stats()["rejected_leases"] == 1
+
+
+def test_the_least_recently_used_free_replicas_are_removed_when_not_needed():
+    service = FakeService()
+    pool = make_pool(service, spare_replicas=1, scale_down_after_seconds=0.1)
+
+    replica_names = []
+    for _ in range(3):
+        replica_names.append(pool.lease())
+        pool._scale_once(first_scale=False)
+    for replica_name in replica_names:
+        pool.release(replica_name)
+        wait_until_reset(pool)
+
+    # Bigger than needed, but not for long enough yet.
+    pool._scale_once(first_scale=False)
+    assert pool.stats()["replicas"] == 4
+
+    time.sleep(0.2)
+    pool._scale_once(first_scale=False)
+    assert pool.stats()["replicas"] == 1
+    assert pool.stats()["scale_downs"] == 1
+    # The last released replica is kept.
+    assert service.replicas == [replica_names[-1]]
@@ -0,0 +1,81 @@
+import multiprocessing
+import time
+
+import pytest
+
+from remote_docker_sandbox.container_state_store import ContainerStateStore
+
+
+def reserve_many(path: str, worker: int, barrier, reserved) -> None:
+    store = ContainerStateStore(path=path)
+    barrier.wait()
+    for i in range(20):
+        if store.reserve(
+            f"docker-sandbox-{worker}-{i}",
+            memory_gb=1,
+            cpus=1,
+            worker=worker,
+            capacity_memory_gb=10,
+            capacity_cpus=100,
+        ):
+            reserved.put(f"docker-sandbox-{worker}-{i}")
+
+
+def start_after(path: str, container_name: str, error: str | None) -> None:
+    store = ContainerStateStore(path=path)
+    time.sleep(0.3)
+    if error is None:
+        store.set_started(container_name)
+    else:
+        store.set_failed(container_name, error)
+
+
+def run_processes(target, args_list: list[tuple]) -> None:
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+
+def test_two_processes_reserve_no_more_than_the_capacity(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    ContainerStateStore(path=path)
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(2)
+    reserved = context.Queue()
+
+    run_processes(reserve_many, [(path, worker, barrier, reserved) for worker in [1, 2]])
+
+    names = [reserved.get(timeout=10) for _ in range(10)]
+    assert reserved.empty()
+    store = ContainerStateStore(path=path)
+    assert sorted(store.container_names()) == sorted(names)
+    load = store.load()
+    assert load["reserved_memory_gb"] == 10
+    assert load["pending_starts"] == 10
+
+
+@pytest.mark.parametrize("error", [None, "Error starting sandbox: no space left"])
+def test_wait_until_started_sees_starts_of_other_processes(tmp_path, error):
+    path = str(tmp_path / "state.sqlite")
+    store = ContainerStateStore(path=path)
+    assert store.reserve("docker-sandbox-1", memory_gb=1, cpus=1, worker=1)
+
+    context = multiprocessing.get_context("spawn")
+    starter = context.Process(target=start_after, args=(path, "docker-sandbox-1", error))
+    starter.start()
+    try:
+        with pytest.raises(TimeoutError):
+            store.wait_until_started("docker-sandbox-1", timeout_seconds=0.05)
+        if error is None:
+            store.wait_until_started("docker-sandbox-1", timeout_seconds=30)
+            assert store.state("docker-sandbox-1") == ("started", None)
+        else:
+            with pytest.raises(Exception, match="no space left"):
+                store.wait_until_started("docker-sandbox-1", timeout_seconds=30)
+    finally:
+        starter.join(timeout=60)
+    assert starter.exitcode == 0
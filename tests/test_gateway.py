@@ -0,0 +1,174 @@
+import time
+
+import pytest
+import requests
+
+from remote_docker_sandbox.benchmark import free_port, start_process, stop_server
+from remote_docker_sandbox.gateway import SandboxGateway
+
+
+@pytest.fixture(scope="module")
+def backend_urls():
+    processes = []
+    urls = []
+    try:
+        for _ in range(2):
+            port = free_port()
+            processes.append(
+                start_process(
+                    ["-m", "remote_docker_sandbox.benchmark", "--serve", "--port", str(port)],
+                    port=port,
+                    startup_timeout_seconds=60,
+                )
+            )
+            urls.append(f"http://127.0.0.1:{port}")
+        yield urls
+    finally:
+        for process in processes:
+            stop_server(process)
+
+
+def start(gateway: SandboxGateway, container_name: str) -> None:
+    gateway.start_container(
+        container_name=container_name, init_command=None, memory_gb=1, cpus=1
+    )
+
+
+def containers_of(gateway: SandboxGateway, backend_url: str) -> list[str]:
+    return gateway._call_backend(backend_url, {"function": "list_containers"})
+
+
+def test_calls_are_pinned_to_the_backend_of_the_start(backend_urls):
+    gateway = SandboxGateway(backend_urls=backend_urls)
+    start(gateway, "pinned")
+    backend_url = gateway.placements["pinned"]
+    assert "pinned" in containers_of(gateway, backend_url)
+
+    output = gateway.get_response(
+        "run_command", container_name="pinned", command="echo hi", timeout_seconds=10
+    )
+    assert output["returncode"] == 0
+
+    gateway.stop_container("pinned")
+    assert "pinned" not in gateway.placements
+    assert "pinned" not in containers_of(gateway, backend_url)
+
+
+def test_drained_backends_get_no_new_sandboxes(backend_urls):
+    gateway = SandboxGateway(backend_urls=backend_urls)
+    start(gateway, "before-drain")
+    drained_url = gateway.placements["before-drain"]
+    gateway.drain_backend(drained_url)
+
+    container_names = [f"after-drain-{i}" for i in range(10)]
+    for container_name in container_names:
+        start(gateway, container_name)
+    assert all(gateway.placements[name] != drained_url for name in container_names)
+    assert gateway.get_backends()[drained_url]["state"] == "draining"
+
+    # The sandbox already on the drained backend keeps working there.
+    output = gateway.get_response(
+        "run_command", container_name="before-drain", command="true", timeout_seconds=10
+    )
+    assert output["returncode"] == 0
+
+    for container_name in ["before-drain"] + container_names:
+        gateway.stop_container(container_name)
+
+
+def test_removed_backends_keep_their_sandboxes(backend_urls):
+    gateway = SandboxGateway(backend_urls=backend_urls)
+    start(gateway, "before-remove")
+    removed_url = gateway.placements["before-remove"]
+    gateway.remove_backend(removed_url)
+
+    removed_backend = gateway.get_backends()[removed_url]
+    assert (removed_backend["state"], removed_backend["containers"]) == ("removed", 1)
+    start(gateway, "after-remove")
+    assert gateway.placements["after-remove"] != removed_url
+
+    gateway.stop_container("before-remove")
+    assert "before-remove" not in containers_of(gateway, removed_url)
+    assert removed_url not in gateway.get_backends()
+    gateway.stop_container("after-remove")
+
+
+def test_starts_fail_over_from_backends_that_refuse_connections(backend_urls):
+    dead_url = f"http://127.0.0.1:{free_port()}"
+    gateway = SandboxGateway(backend_urls=[dead_url, backend_urls[0]])
+
+    container_names = [f"failover-{i}" for i in range(10)]
+    for container_name in container_names:
+        start(gateway, container_name)
+    assert all(gateway.placements[name] == backend_urls[0] for name in container_names)
+
+    for container_name in container_names:
+        gateway.stop_container(container_name)
+
+
+def test_ambiguous_start_failures_stop_the_container_before_failing_over(
+    backend_urls, monkeypatch
+):
+    gateway = SandboxGateway(backend_urls=backend_urls)
+    timed_out_url = gateway._placement_candidates("ambiguous")[0]
+    call_backend = gateway._call_backend
+
+    def time_out_after_the_start(backend_url, arguments, **kwargs):
+        result = call_backend(backend_url, arguments, **kwargs)
+        if backend_url == timed_out_url and arguments["function"] == "start_container":
+            raise requests.ReadTimeout("Read timed out.")
+        return result
+
+    monkeypatch.setattr(gateway, "_call_backend", time_out_after_the_start)
+    start(gateway, "ambiguous")
+
+    assert gateway.placements["ambiguous"] != timed_out_url
+    assert "ambiguous" not in containers_of(gateway, timed_out_url)
+    gateway.stop_container("ambiguous")
+
+
+def test_placements_are_rebuilt_from_the_backends(backend_urls):
+    gateway = SandboxGateway(backend_urls=backend_urls)
+    container_names = [f"rebuilt-{i}" for i in range(10)]
+    for container_name in container_names:
+        start(gateway, container_name)
+
+    restarted_gateway = SandboxGateway(backend_urls=backend_urls)
+    restarted_gateway.start_background_tasks()
+    assert {name: restarted_gateway.placements[name] for name in container_names} == {
+        name: gateway.placements[name] for name in container_names
+    }
+
+    for container_name in container_names:
+        restarted_gateway.stop_container(container_name)
+    restarted_gateway.stop_background_tasks()
+
+
+def test_containers_the_backends_removed_are_forgotten(backend_urls):
+    gateway = SandboxGateway(backend_urls=backend_urls)
+    for container_name in ["removed-1", "removed-2", "kept"]:
+        start(gateway, container_name)
+    # As if the backends stopped them themselves, e.g. when they were idle.
+    for container_name in ["removed-1", "removed-2"]:
+        gateway._call_backend(
+            gateway.placements[container_name],
+            {"function": "stop_container", "container_name": container_name},
+        )
+
+    deadline = time.monotonic() + 10
+    while "removed-1" in gateway.placements:
+        assert time.monotonic() < deadline
+        # Until the backend removed it in the background, the container still runs.
+        try:
+            gateway.get_response(
+                "run_command", container_name="removed-1", command="true", timeout_seconds=10
+            )
+        except Exception:
+            pass
+        time.sleep(0.05)
+    assert "removed-2" in gateway.placements
+
+    gateway.rebuild_placements()
+    assert "removed-2" not in gateway.placements
+    assert "kept" in gateway.placements
+    gateway.stop_container("kept")
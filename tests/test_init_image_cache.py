@@ -0,0 +1,84 @@
+import threading
+
+from remote_docker_sandbox.fake_docker_backend import FakeDockerBackend
+from remote_docker_sandbox.init_image_cache import InitImageCache
+from remote_docker_sandbox.server import DockerSandboxServer
+
+
+def test_leftover_images_are_removed():
+    docker = FakeDockerBackend(
+        images={
+            "bash-sandbox:abc": 100,
+            "bash-sandbox-init:0123456789abcdef-1234abcd": 10,
+            "bash-sandbox-init:fedcba9876543210-abcd1234": 10,
+        }
+    )
+    cache = InitImageCache(docker=docker, max_bytes=1000)
+
+    cache.remove_leftover_images()
+
+    assert list(docker.images) == ["bash-sandbox:abc"]
+
+
+def test_acquire_stops_waiting_for_a_stuck_populate():
+    cache = InitImageCache(
+        docker=FakeDockerBackend(), max_bytes=1000, max_populate_wait_seconds=0.1
+    )
+    key = InitImageCache.key("bash-sandbox:abc", "sleep infinity")
+
+    assert cache.acquire(key) == (None, True)
+    # Runs the init command uncached, and doesn't populate the cache.
+    assert cache.acquire(key) == (None, False)
+    assert cache.stats()["populate_wait_timeouts"] == 1
+
+
+def test_acquire_waits_for_the_populate():
+    docker = FakeDockerBackend(images={"bash-sandbox:abc": 100})
+    docker.containers["sandbox-1"] = "running"
+    cache = InitImageCache(docker=docker, max_bytes=1000)
+    key = InitImageCache.key("bash-sandbox:abc", "pip install numpy")
+    assert cache.acquire(key) == (None, True)
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(cache.acquire(key)))
+    waiter.start()
+    cache.add(key, "sandbox-1", base_image="bash-sandbox:abc")
+    waiter.join()
+
+    [(image, should_populate)] = results
+    assert image is not None and image.startswith("bash-sandbox-init:")
+    assert not should_populate
+
+
+class InitCountingDockerBackend(FakeDockerBackend):
+    def __init__(self) -> None:
+        super().__init__()
+        self.init_runs = 0
+
+    def exec_streaming(self, container_name, command, timeout_seconds=None):
+        if command[-1] == "service start":
+            self.init_runs += 1
+        return super().exec_streaming(container_name, command, timeout_seconds)
+
+
+def test_cache_init_false_always_runs_the_init_command():
+    docker = InitCountingDockerBackend()
+    server = DockerSandboxServer(
+        docker=docker, init_image_cache_bytes=1000, remove_orphans_at_startup=False
+    )
+    server.start_background_tasks()
+    try:
+        for i, cache_init in enumerate([True, True, False]):
+            server.start_container(
+                f"docker-sandbox-{i}",
+                "service start",
+                memory_gb=1,
+                cpus=1,
+                cache_init=cache_init,
+            )
+            server._wait_until_started(f"docker-sandbox-{i}")
+        # The second sandbox starts from the cached image, the third runs the command.
+        assert docker.init_runs == 2
+        assert server.init_image_cache.stats()["hits"] == 1
+    finally:
+        server.stop_background_tasks()
@@ -0,0 +1,259 @@
+import io
+import json
+import struct
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from remote_docker_sandbox.docker_backend import SocketDockerBackend
+
+
+class FakeDockerEngine(ThreadingMixIn, UnixStreamServer):
+    """
+    The few Docker Engine API endpoints SocketDockerBackend uses, on a unix socket.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str) -> None:
+        super().__init__(socket_path, FakeDockerEngineHandler)
+        self.requests: list[tuple[str, str]] = []
+        self.containers: dict[str, dict] = {}
+        self.execs: dict[str, dict] = {}
+        self.archives: dict[tuple[str, str], bytes] = {}
+        self.exec_output: list[tuple[int, bytes]] = []
+        self.exec_exit_code = 0
+        self.create_delay_seconds = 0.0
+        # Closes keep-alive connections right after answering, like an engine that
+        # dropped an idle connection.
+        self.close_after_response = False
+
+
+class FakeDockerEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeDockerEngine
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def do_PUT(self) -> None:
+        self._handle()
+
+    def do_DELETE(self) -> None:
+        self._handle()
+
+    def _handle(self) -> None:
+        url = urlsplit(self.path)
+        path = url.path.removeprefix("/v1.41")
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self._read_body()
+        self.server.requests.append((self.command, path))
+        parts = path.strip("/").split("/")
+
+        if self.command == "POST" and path == "/containers/create":
+            time.sleep(self.server.create_delay_seconds)
+            self.server.containers[query["name"]] = {
+                "config": json.loads(body),
+                "running": False,
+            }
+            self._reply(201, {"Id": query["name"]})
+        elif self.command == "POST" and parts[0] == "containers" and parts[2] == "start":
+            self.server.containers[parts[1]]["running"] = True
+            self._reply(204)
+        elif self.command == "POST" and parts[0] == "containers" and parts[2] == "exec":
+            exec_id = f"exec{len(self.server.execs)}"
+            self.server.execs[exec_id] = {"container": parts[1], **json.loads(body)}
+            self._reply(201, {"Id": exec_id})
+        elif self.command == "POST" and parts[0] == "exec" and parts[2] == "start":
+            # The engine hijacks the connection for the multiplexed output stream.
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.end_headers()
+            for stream, payload in self.server.exec_output:
+                self.wfile.write(struct.pack(">BxxxL", stream, len(payload)) + payload)
+            self.close_connection = True
+        elif self.command == "GET" and parts[0] == "exec" and parts[2] == "json":
+            self._reply(200, {"ExitCode": self.server.exec_exit_code, "Running": False})
+        elif self.command == "PUT" and parts[0] == "containers" and parts[2] == "archive":
+            self.server.archives[(parts[1], query["path"])] = body
+            self._reply(200)
+        elif self.command == "GET" and parts[0] == "containers" and parts[2] == "archive":
+            archive = self.server.archives.get((parts[1], query["path"]))
+            if archive is None:
+                self._reply(404, {"message": f"Could not find the file {query['path']}"})
+            else:
+                self._reply(200, archive, content_type="application/x-tar")
+        else:
+            self._reply(404, {"message": f"No such endpoint {self.command} {path}"})
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in [b"\r\n", b""]:
+                        pass
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", "0")))
+
+    def _reply(
+        self,
+        status: int,
+        body: dict | bytes | None = None,
+        content_type: str = "application/json",
+    ) -> None:
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+        if self.server.close_after_response:
+            self.close_connection = True
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = FakeDockerEngine(str(tmp_path / "docker.sock"))
+    thread = threading.Thread(
+        target=engine.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    yield engine
+    engine.shutdown()
+    engine.server_close()
+
+
+@pytest.fixture
+def backend(engine):
+    return SocketDockerBackend(socket_path=engine.server_address)
+
+
+def tar_with(name: str, content: bytes) -> bytes:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    return archive.getvalue()
+
+
+def test_create_and_start_container(engine, backend):
+    backend.create_and_start_container(
+        container_name="sandbox-1", image="bash-sandbox:abc", memory_gb=2, cpus=3
+    )
+
+    container = engine.containers["sandbox-1"]
+    assert container["running"]
+    assert container["config"]["Image"] == "bash-sandbox:abc"
+    assert container["config"]["HostConfig"] == {
+        "Memory": 2 * 1024**3,
+        "NanoCpus": 3 * 10**9,
+    }
+
+
+def test_exec_demultiplexes_the_output_stream(engine, backend):
+    engine.exec_output = [
+        (1, b"hello "),
+        (2, b"warning\n"),
+        (1, b"world\r\n"),
+        (1, b"last line\r"),
+    ]
+    engine.exec_exit_code = 3
+
+    chunks = list(backend.exec_streaming("sandbox-1", ["/bin/bash", "-c", "true"]))
+    assert chunks == [
+        ("stdout", b"hello "),
+        ("stderr", b"warning\n"),
+        ("stdout", b"world\r\n"),
+        ("stdout", b"last line\r"),
+        ("returncode", 3),
+    ]
+    assert engine.execs["exec0"]["Cmd"] == ["/bin/bash", "-c", "true"]
+
+    # Newlines are translated like the docker CLI's output read in text mode was.
+    assert backend.exec("sandbox-1", ["/bin/bash", "-c", "true"]) == {
+        "returncode": 3,
+        "stdout": "hello world\nlast line\n",
+        "stderr": "warning\n",
+    }
+
+
+def test_exec_caps_output(engine, backend):
+    engine.exec_output = [(1, b"x" * 1000)]
+
+    output = backend.exec("sandbox-1", ["/bin/bash", "-c", "true"], max_bytes=100)
+    assert output["stdout"].startswith("x" * 50)
+    assert output["stdout"].endswith("x" * 50)
+    assert "900 bytes truncated" in output["stdout"]
+
+
+def test_put_and_get_archive(engine, backend):
+    archive = tar_with("hello.txt", b"hi there")
+
+    backend.put_archive("sandbox-1", "/app", io.BytesIO(archive))
+    assert engine.archives[("sandbox-1", "/app")] == archive
+
+    assert b"".join(backend.get_archive("sandbox-1", "/app")) == archive
+
+
+def test_get_archive_of_a_missing_path_raises_right_away(engine, backend):
+    with pytest.raises(Exception, match="Could not find the file /missing"):
+        backend.get_archive("sandbox-1", "/missing")
+
+
+def test_keep_alive_connections_are_reused(engine, backend):
+    backend.create_container(
+        container_name="sandbox-1", image="bash-sandbox:abc", memory_gb=1, cpus=1
+    )
+    backend.start_container("sandbox-1")
+    backend.create_container(
+        container_name="sandbox-2", image="bash-sandbox:abc", memory_gb=1, cpus=1
+    )
+
+    assert backend._idle_connections.qsize() == 1
+
+
+def test_connections_closed_by_the_engine_are_not_reused(engine, backend):
+    engine.close_after_response = True
+    backend.create_container(
+        container_name="sandbox-1", image="bash-sandbox:abc", memory_gb=1, cpus=1
+    )
+    backend.create_container(
+        container_name="sandbox-2", image="bash-sandbox:abc", memory_gb=1, cpus=1
+    )
+
+    assert engine.requests == [
+        ("POST", "/containers/create"),
+        ("POST", "/containers/create"),
+    ]
+
+
+def test_timed_out_requests_are_not_retried(engine, backend):
+    backend.request_timeout_seconds = 0.2
+    # Puts a connection in the pool, which the create then reuses.
+    backend.image_exists("bash-sandbox:abc")
+    engine.create_delay_seconds = 1
+
+    with pytest.raises(TimeoutError):
+        backend.create_container(
+            container_name="sandbox-1", image="bash-sandbox:abc", memory_gb=1, cpus=1
+        )
+    time.sleep(1)
+    assert engine.requests.count(("POST", "/containers/create")) == 1
@@ -0,0 +1,62 @@
+import asyncio
+
+from remote_docker_sandbox.async_client import AsyncRemoteDockerSandbox
+from remote_docker_sandbox.client import RemoteDockerSandbox
+
+
+def fake_call_server(calls: list[tuple[str, str]], failing_server_url: str):
+    """
+    A call_server whose start fails on `failing_server_url` and works everywhere else,
+    recording (server url, function) of every call.
+    """
+
+    def call_server(self, **kwargs):
+        calls.append((self.server_url, kwargs["function"]))
+        if kwargs["function"] == "start_container" and self.server_url == failing_server_url:
+            return {"error": "Error communicating with server: Read timed out."}
+        return None
+
+    return call_server
+
+
+def test_failed_starts_are_stopped_before_trying_another_server(monkeypatch):
+    server_urls = ["http://start-failover-a.invalid", "http://start-failover-b.invalid"]
+    calls: list[tuple[str, str]] = []
+    monkeypatch.setattr(
+        RemoteDockerSandbox, "call_server", fake_call_server(calls, server_urls[0])
+    )
+    # The servers are taken in turn, so one of the two sandboxes starts on the failing one.
+    sandboxes = [RemoteDockerSandbox(server_urls=server_urls) for _ in range(2)]
+
+    failed = calls.index((server_urls[0], "start_container"))
+    assert calls[failed + 1 : failed + 3] == [
+        (server_urls[0], "stop_container"),
+        (server_urls[1], "start_container"),
+    ]
+    assert all(sandbox.server_url == server_urls[1] for sandbox in sandboxes)
+
+
+def test_failed_async_starts_are_stopped_before_trying_another_server(monkeypatch):
+    server_urls = ["http://start-failover-c.invalid", "http://start-failover-d.invalid"]
+    calls: list[tuple[str, str]] = []
+    call_server = fake_call_server(calls, server_urls[0])
+
+    async def async_call_server(self, **kwargs):
+        return call_server(self, **kwargs)
+
+    monkeypatch.setattr(AsyncRemoteDockerSandbox, "call_server", async_call_server)
+
+    async def start_sandboxes() -> list[AsyncRemoteDockerSandbox]:
+        sandboxes = [AsyncRemoteDockerSandbox(server_urls=server_urls) for _ in range(2)]
+        for sandbox in sandboxes:
+            await sandbox.start()
+        return sandboxes
+
+    sandboxes = asyncio.run(start_sandboxes())
+
+    failed = calls.index((server_urls[0], "start_container"))
+    assert calls[failed + 1 : failed + 3] == [
+        (server_urls[0], "stop_container"),
+        (server_urls[1], "start_container"),
+    ]
+    assert all(sandbox.server_url == server_urls[1] for sandbox in sandboxes)
@@ -0,0 +1,40 @@
+import os
+import re
+
+import pytest
+
+from remote_docker_sandbox.tracing import Tracer, current_request_id, new_request_id
+
+
+def trace_ids(request_ids: list[str | None]) -> list[str]:
+    tracer = Tracer(enabled=True)
+    for i, request_id in enumerate(request_ids):
+        token = current_request_id.set(request_id)
+        try:
+            tracer.record("span", float(i), float(i) + 1)
+        finally:
+            current_request_id.reset(token)
+    spans = tracer.otlp_trace()["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    return [span["traceId"] for span in spans]
+
+
+def test_otlp_trace_ids_are_valid_for_any_request_id():
+    client_request_id = new_request_id()
+    request_ids = [client_request_id, "my-request/1", "0" * 32, "A" * 32, None, None]
+
+    ids = trace_ids(request_ids)
+
+    assert all(re.fullmatch("[0-9a-f]{32}", id) and id != "0" * 32 for id in ids)
+    # The ids made by the clients are kept, so that they can be searched for.
+    assert ids[0] == client_request_id
+    # Spans without a request id don't all end up in one trace.
+    assert ids[4] != ids[5]
+    assert trace_ids(["my-request/1"]) == [ids[1]]
+
+
+@pytest.mark.skipif(
+    "REMOTE_DOCKER_SANDBOX_TRACING" in os.environ,
+    reason="Only the default is tested.",
+)
+def test_tracing_is_off_in_clients_by_default():
+    assert not Tracer().enabled
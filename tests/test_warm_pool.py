@@ -0,0 +1,96 @@
+import time
+
+from remote_docker_sandbox.warm_pool import WarmContainerPool, ContainerShape
+
+
+class FakeContainers:
+    def __init__(self) -> None:
+        self.running: dict[str, ContainerShape] = {}
+
+    def create(self, container_name: str, shape: ContainerShape) -> None:
+        self.running[container_name] = shape
+
+    def remove(self, container_name: str) -> None:
+        del self.running[container_name]
+
+
+def shape(memory_gb: int) -> ContainerShape:
+    return ContainerShape(memory_gb=memory_gb, cpus=1, image_name="bash-sandbox:abc")
+
+
+def wait_until(condition) -> None:
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_learned_shapes_are_capped_and_expire():
+    containers = FakeContainers()
+    pool = WarmContainerPool(
+        create_container=containers.create,
+        remove_container=containers.remove,
+        size_per_shape=1,
+        shapes=[shape(1)],
+        max_learned_shapes=2,
+        learned_shape_ttl_seconds=0.5,
+        retry_after_failure_seconds=0.05,
+    )
+    pool.start()
+    try:
+        for memory_gb in [2, 3, 4]:
+            assert pool.claim(shape(memory_gb)) is None
+        wait_until(lambda: len(containers.running) == 3)
+        assert sorted(s.memory_gb for s in containers.running.values()) == [1, 2, 3]
+
+        # Only the configured shape is left once the learned ones weren't claimed.
+        wait_until(lambda: len(containers.running) == 1)
+        assert list(containers.running.values()) == [shape(1)]
+        assert [s["memory_gb"] for s in pool.stats()["shapes"]] == [1]
+    finally:
+        pool.shutdown()
+    assert containers.running == {}
+
+
+def test_no_more_containers_are_created_than_fit():
+    containers = FakeContainers()
+    capacity_memory_gb = 3
+    pool = WarmContainerPool(
+        create_container=containers.create,
+        remove_container=containers.remove,
+        size_per_shape=2,
+        shapes=[shape(1), shape(2)],
+        retry_after_failure_seconds=0.05,
+    )
+    pool.fits = lambda: pool.reserved()[0] <= capacity_memory_gb
+    pool.start()
+    try:
+        wait_until(lambda: len(containers.running) == 2)
+        time.sleep(0.2)
+        # The 2 GB containers don't fit next to the two 1 GB ones.
+        assert sorted(s.memory_gb for s in containers.running.values()) == [1, 1]
+    finally:
+        pool.shutdown()
+
+
+def test_evict_frees_capacity_but_keeps_the_shape_about_to_be_claimed():
+    containers = FakeContainers()
+    pool = WarmContainerPool(
+        create_container=containers.create,
+        remove_container=containers.remove,
+        size_per_shape=2,
+        shapes=[shape(1), shape(2)],
+        retry_after_failure_seconds=0.05,
+    )
+    pool.start()
+    try:
+        wait_until(lambda: pool.reserved() == (6, 4) and len(containers.running) == 4)
+        pool._stopped.set()
+
+        pool.evict(memory_gb=3, cpus=0, keep=shape(1))
+        # A container of the shape about to be claimed is kept.
+        assert sorted(s.memory_gb for s in containers.running.values()) == [1, 2]
+        assert pool.stats()["evictions"] == 2
+        assert pool.claim(shape(1)) is not None
+    finally:
+        pool.shutdown()